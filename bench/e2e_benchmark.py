@@ -0,0 +1,285 @@
+"""Сквозной бенчмарк бота без Telegram: фейковый Bot API + сценарии администраторов.
+
+Бот работает как в проде (getUpdates -> диспетчер -> обработчики -> PostgreSQL ->
+очередь исходящих сообщений),
+только Bot API подменен локальным сервером из bench/fake_telegram.py.
+Несколько администраторов параллельно проходят типичную сессию: добавляют
+сотрудника, отмечают присутствие (в том числе через поиск), смотрят список
+и отчеты.
+
+    python bench/e2e_benchmark.py --database-url postgresql://bench@localhost/bench
+    python bench/e2e_benchmark.py --pgserver --sessions 20 --rounds 5
+    python bench/e2e_benchmark.py --max-p99-ms 200 --max-queries-per-update 4
+
+Нужна настоящая PostgreSQL: SQL бота (триггеры сводок, generate_series,
+серверные курсоры) в SQLite не выполняется. --pgserver поднимает временный
+экземпляр через пакет pgserver (pip install pgserver). Внимание: бенчмарк
+пишет в базу сотрудников и отметки - не запускайте его на рабочей БД.
+
+Код выхода 1, если превышены пороги --max-p99-ms / --max-queries-per-update.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_telegram import FakeTelegram  # noqa: E402
+
+FIRST_USER_ID = 900000
+
+
+def start_pgserver():
+    try:
+        import pgserver
+    except ImportError:
+        sys.exit('❌ Для --pgserver установите пакет: pip install pgserver')
+    server = pgserver.get_server(tempfile.mkdtemp(prefix='bench-pg-'), cleanup_mode='delete')
+    return server, server.get_uri()
+
+
+def import_bot(database_url, admin_id):
+    os.environ['DATABASE_URL'] = database_url
+    os.environ.setdefault('BOT_TOKEN', '0:benchmark')
+    os.environ.setdefault('ADMIN_ID', str(admin_id))
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    # Лимиты Bot API фейковому серверу не нужны: меряем бота, а не ожидание в очереди отправки.
+    # Чтобы проверить сам ограничитель, задайте OUTBOX_* явно
+    os.environ.setdefault('OUTBOX_GLOBAL_RATE', '100000')
+    os.environ.setdefault('OUTBOX_CHAT_RATE', '100000')
+    os.environ.setdefault('OUTBOX_CHAT_BURST', '100000')
+    os.environ.setdefault('MARK_JOURNAL_PATH', os.path.join(tempfile.mkdtemp(prefix='bench-journal-'), 'marks.db'))
+    sys.path.insert(0, ROOT)
+    import bot
+    return bot
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    k = min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))
+    return values[k]
+
+
+class Harness:
+    """Отправляет обновления от имени пользователя и ждет, пока бот их обработает"""
+
+    def __init__(self, bot, fake):
+        self.bot = bot
+        self.fake = fake
+        self._done = {}
+        self._cond = threading.Condition()
+        self.latencies = {}  # шаг сценария -> список задержек, сек
+        self.updates = 0
+        # Оборачиваем обработчик диспетчера, чтобы знать момент окончания обработки
+        bot.dispatcher = bot.UpdateDispatcher(self._handle, bot.UPDATE_WORKERS, bot.UPDATE_QUEUE_SIZE)
+
+    def _handle(self, updates):
+        try:
+            self.bot.bot.process_new_updates(updates)
+        finally:
+            with self._cond:
+                self._done.update((update.update_id, True) for update in updates)
+                self._cond.notify_all()
+
+    def _wait(self, update_id, chat_id, started, step, timeout=60):
+        """Ждет обработки обновления и отправки всех ответов бота в чат"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while update_id not in self._done:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f'Обновление {update_id} ({step}) не обработано за {timeout} с')
+                self._cond.wait(remaining)
+            del self._done[update_id]
+        if not self.bot.outbox.wait_idle(chat_id, max(0, deadline - time.monotonic())):
+            raise TimeoutError(f'Ответы на {step} не отправлены за {timeout} с')
+        with self._cond:
+            self.latencies.setdefault(step, []).append(time.perf_counter() - started)
+            self.updates += 1
+
+    def send(self, user_id, text, step=None):
+        """Отправляет сообщение; возвращает ответы бота в этот чат"""
+        seq = self.fake.count_calls()
+        started = time.perf_counter()
+        self._wait(self.fake.push_message(user_id, text), user_id, started, step or text)
+        return self.fake.calls_since(seq, user_id)
+
+    def press(self, user_id, data, step):
+        """Нажимает inline-кнопку; возвращает ответы бота в этот чат"""
+        seq = self.fake.count_calls()
+        started = time.perf_counter()
+        self._wait(self.fake.push_callback(user_id, data), user_id, started, step)
+        return self.fake.calls_since(seq, user_id)
+
+
+def callbacks(replies, prefix):
+    """callback_data inline-кнопок последнего ответа с inline-клавиатурой"""
+    for _, _, params in reversed(replies):
+        markup = json.loads(params.get('reply_markup') or '{}')
+        rows = markup.get('inline_keyboard')
+        if rows:
+            return [button['callback_data'] for row in rows for button in row
+                    if button.get('callback_data', '').startswith(prefix)]
+    return []
+
+
+def admin_session(harness, user_id, round_no):
+    """Типичная сессия администратора"""
+    harness.send(user_id, '/start')
+
+    harness.send(user_id, '👥 Сотрудники')
+    harness.send(user_id, '➕ Добавить сотрудника')
+    harness.send(user_id, f'Сотрудник {user_id} {round_no}', step='ввод ФИО')
+    harness.send(user_id, 'Инженер', step='ввод должности')
+    replies = harness.send(user_id, '📋 Список сотрудников')
+    for data in callbacks(replies, 'emp:next:'):
+        harness.press(user_id, data, step='следующая страница списка')
+    harness.send(user_id, '🔙 Главное меню')
+
+    replies = harness.send(user_id, '✅ Отметить сегодня')
+    toggles = callbacks(replies, 'att:t:')
+    for data in toggles[:3]:
+        harness.press(user_id, data, step='выбор сотрудника')
+    replies = harness.send(user_id, f'Сотрудник {user_id}', step='поиск при отметке')
+    for data in callbacks(replies, 'att:t:')[:1]:
+        harness.press(user_id, data, step='выбор сотрудника')
+    harness.press(user_id, 'att:ok', step='подтверждение отметки')
+
+    harness.send(user_id, '📊 Отчеты')
+    harness.send(user_id, '📈 Общий отчет')
+    replies = harness.send(user_id, '👤 Отчет по сотруднику')
+    picks = callbacks(replies, 'rep:e:')
+    if picks:
+        harness.press(user_id, picks[round_no % len(picks)], step='выбор сотрудника для отчета')
+    harness.send(user_id, '👤 Отчет по сотруднику')
+    harness.send(user_id, f'Сотрудник {user_id} {round_no}', step='поиск сотрудника для отчета')
+    harness.send(user_id, '📅 Отчет за период')
+    harness.send(user_id, '📅 Этот месяц', step='выбор периода')
+    harness.send(user_id, '🔙 Назад')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--pgserver', action='store_true', help='поднять временную PostgreSQL через pgserver')
+    parser.add_argument('--sessions', type=int, default=10, help='параллельных администраторов')
+    parser.add_argument('--rounds', type=int, default=3, help='сессий на администратора')
+    parser.add_argument('--max-p99-ms', type=float, help='порог p99 задержки ответа, мс')
+    parser.add_argument('--max-queries-per-update', type=float, help='порог запросов к БД на обновление')
+    parser.add_argument('--json', action='store_true', help='вывести итог в JSON')
+    args = parser.parse_args()
+
+    server = None
+    if args.pgserver:
+        server, args.database_url = start_pgserver()
+    if not args.database_url:
+        parser.error('укажите --database-url, DATABASE_URL или --pgserver')
+
+    fake = FakeTelegram().start()
+    bot = import_bot(args.database_url, FIRST_USER_ID)
+    import telebot
+    telebot.apihelper.API_URL = fake.api_url
+
+    bot.init_db()
+    bot.db_pool.warm_up()
+    users = [FIRST_USER_ID + i for i in range(args.sessions)]
+    for user_id in users:
+        bot.add_admin(user_id, bot.DEFAULT_ORG_ID)
+    bot.admin_cache.refresh()
+    bot.state_store.load()
+    bot.state_store.start()
+    bot.outbox.start()
+    if bot.mark_journal is not None:
+        bot.mark_journal.start()
+    bot.coordinator.start()
+
+    harness = Harness(bot, fake)
+    bot.dispatcher.start()
+    threading.Thread(target=bot.poll_updates, daemon=True).start()
+
+    # Прогрев: первый сотрудник и кэши, чтобы не мерить холодный старт
+    admin_session(harness, users[0], 0)
+    harness.latencies.clear()
+    harness.updates = 0
+    queries_before = bot.DB_QUERY_LATENCY.count()
+    calls_before = fake.count_calls()
+
+    errors = []
+
+    def worker(user_id):
+        try:
+            for round_no in range(1, args.rounds + 1):
+                admin_session(harness, user_id, round_no)
+        except Exception as e:
+            errors.append(f'{user_id}: {e}')
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(user_id,)) for user_id in users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    updates = harness.updates
+    all_latencies = [v for values in harness.latencies.values() for v in values]
+    summary = {
+        'sessions': args.sessions,
+        'rounds': args.rounds,
+        'updates': updates,
+        'seconds': round(elapsed, 3),
+        'updates_per_sec': round(updates / elapsed, 1) if elapsed else None,
+        'p50_ms': round(percentile(all_latencies, 50) * 1000, 2),
+        'p99_ms': round(percentile(all_latencies, 99) * 1000, 2),
+        'db_queries_per_update': round((bot.DB_QUERY_LATENCY.count() - queries_before) / max(updates, 1), 2),
+        'api_calls_per_update': round((fake.count_calls() - calls_before) / max(updates, 1), 2),
+        'steps': {
+            step: {
+                'count': len(values),
+                'p50_ms': round(percentile(values, 50) * 1000, 2),
+                'p99_ms': round(percentile(values, 99) * 1000, 2),
+            }
+            for step, values in sorted(harness.latencies.items())
+        },
+        'errors': errors,
+    }
+
+    if args.json:
+        print(json.dumps(summary, ensure_ascii=False, indent=2))
+    else:
+        print(f"{'шаг':<32}{'n':>6}{'p50 мс':>10}{'p99 мс':>10}")
+        for step, stats in summary['steps'].items():
+            print(f"{step:<32}{stats['count']:>6}{stats['p50_ms']:>10}{stats['p99_ms']:>10}")
+        print()
+        print(f"обновлений: {updates} за {summary['seconds']} с ({summary['updates_per_sec']}/с)")
+        print(f"задержка ответа: p50 {summary['p50_ms']} мс, p99 {summary['p99_ms']} мс")
+        print(f"запросов к БД на обновление: {summary['db_queries_per_update']}")
+        print(f"вызовов Bot API на обновление: {summary['api_calls_per_update']}")
+        for error in errors:
+            print(f"❌ {error}")
+
+    failed = bool(errors)
+    if args.max_p99_ms is not None and summary['p99_ms'] > args.max_p99_ms:
+        print(f"❌ p99 {summary['p99_ms']} мс превышает порог {args.max_p99_ms} мс")
+        failed = True
+    if args.max_queries_per_update is not None and summary['db_queries_per_update'] > args.max_queries_per_update:
+        print(f"❌ {summary['db_queries_per_update']} запросов на обновление превышает порог "
+              f"{args.max_queries_per_update}")
+        failed = True
+
+    bot.state_store.flush()
+    fake.stop()
+    if server is not None:
+        server.cleanup()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""Бенчмарк потоковой выгрузки посещаемости: строк в секунду и пиковая память.
+
+Каждый формат замеряется в отдельном процессе, чтобы пик RSS не смешивался.
+
+    python bench/export_benchmark.py --rows 500000
+    python bench/export_benchmark.py --from-db --start 01.01.2025 --end 31.12.2025 --org-id 1
+
+С --from-db строки читаются из DATABASE_URL через серверный курсор бота,
+иначе генерируются синтетически (год отметок для ростера нужного размера).
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_bot():
+    # bot.py проверяет переменные окружения при импорте; для синтетического
+    # прогона подойдут любые значения - соединение с БД открывается лениво
+    os.environ.setdefault('BOT_TOKEN', '0:benchmark')
+    os.environ.setdefault('DATABASE_URL', 'postgresql://bench@localhost/bench')
+    os.environ.setdefault('ADMIN_ID', '0')
+    sys.path.insert(0, ROOT)
+    import logging
+    logging.disable(logging.INFO)
+    import bot
+    return bot
+
+
+def synthetic_rows(total, roster=2000):
+    """Год отметок: roster сотрудников по дням, пока не наберется total строк"""
+    day = date.today() - timedelta(days=365)
+    produced = 0
+    while produced < total:
+        marked = datetime.combine(day, datetime.min.time()) + timedelta(hours=9)
+        for i in range(min(roster, total - produced)):
+            yield day, f"Сотрудник {i:05d}", "Должность", marked
+        produced += roster
+        day += timedelta(days=1)
+
+
+def max_rss_mb():
+    # На Linux ru_maxrss в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_case(args):
+    bot = import_bot()
+    writer = {'csv': bot.write_csv, 'xlsx': bot.write_xlsx}[args.case]
+    if args.case == 'xlsx' and bot.openpyxl is None:
+        print(json.dumps({'case': args.case, 'error': 'openpyxl не установлен'}))
+        return
+
+    if args.from_db:
+        start_date = datetime.strptime(args.start, '%d.%m.%Y').date()
+        end_date = datetime.strptime(args.end, '%d.%m.%Y').date()
+        rows = bot.stream_attendance_rows(args.org_id, start_date, end_date)
+    else:
+        rows = synthetic_rows(args.rows, args.roster)
+
+    baseline = max_rss_mb()
+    fd, path = tempfile.mkstemp(suffix=f'.{args.case}')
+    os.close(fd)
+    try:
+        started = time.perf_counter()
+        count = writer(rows, path)
+        elapsed = time.perf_counter() - started
+        size = os.path.getsize(path)
+    finally:
+        os.remove(path)
+
+    print(json.dumps({
+        'case': args.case,
+        'rows': count,
+        'seconds': round(elapsed, 3),
+        'rows_per_sec': round(count / elapsed) if elapsed else None,
+        'file_mb': round(size / 2 ** 20, 2),
+        'baseline_rss_mb': round(baseline, 1),
+        'peak_rss_mb': round(max_rss_mb(), 1),
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=200000, help='число синтетических строк')
+    parser.add_argument('--roster', type=int, default=2000, help='размер синтетического ростера')
+    parser.add_argument('--formats', default='csv,xlsx')
+    parser.add_argument('--from-db', action='store_true', help='читать строки из DATABASE_URL')
+    parser.add_argument('--org-id', type=int, default=1, help='организация для --from-db')
+    parser.add_argument('--start', default=(date.today() - timedelta(days=365)).strftime('%d.%m.%Y'))
+    parser.add_argument('--end', default=date.today().strftime('%d.%m.%Y'))
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        run_case(args)
+        return
+
+    print(f"{'формат':<8}{'строк':>10}{'сек':>9}{'строк/с':>11}{'файл МБ':>10}{'RSS до':>9}{'пик RSS':>9}")
+    for case in args.formats.split(','):
+        cmd = [sys.executable, os.path.abspath(__file__), '--case', case,
+               '--rows', str(args.rows), '--roster', str(args.roster),
+               '--start', args.start, '--end', args.end]
+        if args.from_db:
+            cmd += ['--from-db', '--org-id', str(args.org_id)]
+        output = subprocess.run(cmd, capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        if 'error' in result:
+            print(f"{case:<8}{result['error']}")
+            continue
+        print(f"{case:<8}{result['rows']:>10}{result['seconds']:>9}{result['rows_per_sec']:>11}"
+              f"{result['file_mb']:>10}{result['baseline_rss_mb']:>9}{result['peak_rss_mb']:>9}")
+
+
+if __name__ == '__main__':
+    main()
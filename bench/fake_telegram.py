@@ -0,0 +1,150 @@
+"""Локальная подмена Telegram Bot API для бенчмарков.
+
+Поднимает HTTP-сервер с методами, которые вызывает бот (getUpdates с long
+polling, sendMessage, editMessageText и т.д.), выдает боту заранее
+подготовленные обновления и записывает все его ответы.
+
+    server = FakeTelegram()
+    server.start()
+    telebot.apihelper.API_URL = server.api_url
+"""
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+
+class FakeTelegram:
+    def __init__(self, host='127.0.0.1', port=0):
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._cond = threading.Condition()
+        self._updates = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1000)
+        self.calls = []  # (seq, метод, параметры)
+
+    @property
+    def api_url(self):
+        host, port = self._server.server_address
+        return f'http://{host}:{port}/bot{{0}}/{{1}}'
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+
+    # Обновления для бота
+
+    def _push(self, payload):
+        with self._cond:
+            update_id = next(self._update_ids)
+            self._updates.append({'update_id': update_id, **payload})
+            self._cond.notify_all()
+            return update_id
+
+    def push_message(self, user_id, text):
+        """Ставит в очередь текстовое сообщение; возвращает update_id"""
+        return self._push({'message': {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'Admin {user_id}'},
+            'text': text,
+        }})
+
+    def push_callback(self, user_id, data, message_id=1):
+        """Ставит в очередь нажатие inline-кнопки; возвращает update_id"""
+        return self._push({'callback_query': {
+            'id': str(next(self._message_ids)),
+            'chat_instance': str(user_id),
+            'data': data,
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'Admin {user_id}'},
+            'message': {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'text': '',
+            },
+        }})
+
+    def calls_since(self, seq, chat_id=None):
+        """Вызовы API начиная с номера seq, при необходимости только в чат chat_id"""
+        with self._cond:
+            calls = self.calls[seq:]
+        if chat_id is None:
+            return calls
+        return [c for c in calls if str(c[2].get('chat_id')) == str(chat_id)]
+
+    def count_calls(self):
+        with self._cond:
+            return len(self.calls)
+
+    # HTTP
+
+    def _get_updates(self, params):
+        offset = int(params.get('offset', 0) or 0)
+        timeout = float(params.get('timeout', 0) or 0)
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            if offset < 0:
+                # offset=-1: бот пропускает накопившиеся обновления
+                pending = self._updates[-1:]
+                return pending
+            self._updates = [u for u in self._updates if u['update_id'] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._cond.wait(deadline - time.monotonic())
+            return list(self._updates[:100])
+
+    def _record(self, method, params):
+        with self._cond:
+            self.calls.append((len(self.calls), method, params))
+
+    def _result(self, method, params):
+        if method == 'getUpdates':
+            return self._get_updates(params)
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        self._record(method, params)
+        if method in ('sendMessage', 'sendDocument', 'editMessageText', 'editMessageReplyMarkup'):
+            chat_id = int(params.get('chat_id', 0) or 0)
+            message = {
+                'message_id': int(params.get('message_id') or next(self._message_ids)),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': params.get('text', ''),
+            }
+            return message
+        return True
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _handle(self):
+                url = urlparse(self.path)
+                method = url.path.rsplit('/', 1)[-1]
+                params = dict(parse_qsl(url.query))
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    body = self.rfile.read(length)
+                    if self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+                        params.update(parse_qsl(body.decode()))
+                data = json.dumps({'ok': True, 'result': fake._result(method, params)}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = _handle
+            do_POST = _handle
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,164 @@
+"""Микробенчмарк запросов горячего пути: разовое выполнение против подготовленного.
+
+Для каждого запроса из реестра бота (bot.queries) на одном соединении замеряется
+цикл conn.run(sql) - сервер каждый раз разбирает и планирует текст - и цикл
+по подготовленному запросу, который выполняется по имени.
+
+    python bench/query_benchmark.py --database-url postgresql://bench@localhost/bench
+    python bench/query_benchmark.py --pgserver --iterations 5000 --employees 500
+
+Нужна настоящая PostgreSQL; --pgserver поднимает временный экземпляр
+(pip install pgserver). Бенчмарк добавляет в базу сотрудников и отметки -
+не запускайте его на рабочей БД.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def start_pgserver():
+    try:
+        import pgserver
+    except ImportError:
+        sys.exit('❌ Для --pgserver установите пакет: pip install pgserver')
+    server = pgserver.get_server(tempfile.mkdtemp(prefix='bench-pg-'), cleanup_mode='delete')
+    return server, server.get_uri()
+
+
+def import_bot(database_url):
+    os.environ['DATABASE_URL'] = database_url
+    os.environ.setdefault('BOT_TOKEN', '0:benchmark')
+    os.environ.setdefault('ADMIN_ID', '0')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    sys.path.insert(0, ROOT)
+    import bot
+    return bot
+
+
+def seed(conn, org_id, employees):
+    """Сотрудники организации и месяц их отметок; возвращает id сотрудников"""
+    ids = [row[0] for row in conn.run(
+        '''
+        INSERT INTO employees (org_id, full_name, position)
+        SELECT :org_id, 'Сотрудник ' || lpad(g::text, 5, '0'), 'Инженер'
+        FROM generate_series(1, :n) g
+        RETURNING id
+        ''',
+        org_id=org_id, n=employees
+    )]
+    conn.run(
+        '''
+        INSERT INTO attendance (org_id, employee_id, check_date)
+        SELECT :org_id, e, d::date
+        FROM unnest(:ids::int[]) e, generate_series(CURRENT_DATE - 30, CURRENT_DATE, INTERVAL '1 day') d
+        WHERE EXTRACT(ISODOW FROM d) < 6
+        ON CONFLICT (employee_id, check_date) DO NOTHING
+        ''',
+        org_id=org_id, ids=ids
+    )
+    return ids
+
+
+def cases(org_id, ids):
+    """Запрос реестра -> параметры; записи идемпотентны, кроме employee_insert (он идет последним)"""
+    today = date.today()
+    marked = ids[:5]
+    return {
+        'ready': {},
+        'admins_all': {},
+        'cache_notify': {'channel': 'bench_cache', 'payload': str(org_id)},
+        'roster_load': {'org_id': org_id},
+        'employees_page_first': {'org_id': org_id, 'limit': 21},
+        'employees_page_next': {'org_id': org_id, 'anchor_id': ids[len(ids) // 2], 'limit': 21},
+        'employees_page_prev': {'org_id': org_id, 'anchor_id': ids[len(ids) // 2], 'limit': 21},
+        'attendance_mark_batch': {'org_id': org_id, 'employee_ids': marked, 'check_date': today},
+        'attendance_journal_flush': {
+            'org_ids': [org_id] * len(marked), 'employee_ids': marked,
+            'check_dates': [today] * len(marked), 'marked_at': [time.time()] * len(marked),
+        },
+        'scheduler_claim': {'job_name': 'benchmark', 'next_run': today + timedelta(days=1)},
+        'digest_daily': {'today': today},
+        'report_daily_totals': {'org_id': org_id, 'days': 6},
+        'report_employee': {'org_id': org_id, 'employee_id': ids[0]},
+        'report_general': {'org_id': org_id},
+        'report_period': {'org_id': org_id, 'start_date': today - timedelta(days=30), 'end_date': today},
+        # Добавляет сотрудника на каждом выполнении - поэтому после запросов, читающих список
+        'employee_insert': {'org_id': org_id, 'full_name': 'Сотрудник вставки', 'position': 'Инженер'},
+    }
+
+
+def measure(run, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        run()
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--pgserver', action='store_true', help='поднять временную PostgreSQL через pgserver')
+    parser.add_argument('--iterations', type=int, default=2000, help='выполнений каждого запроса')
+    parser.add_argument('--employees', type=int, default=200, help='сотрудников в тестовой организации')
+    parser.add_argument('--json', action='store_true', help='вывести итог в JSON')
+    args = parser.parse_args()
+
+    server = None
+    if args.pgserver:
+        server, args.database_url = start_pgserver()
+    if not args.database_url:
+        parser.error('укажите --database-url, DATABASE_URL или --pgserver')
+
+    bot = import_bot(args.database_url)
+    bot.init_db()
+    conn = bot.get_connection()
+    conn.autocommit = True
+    org_id = conn.run("INSERT INTO organizations (name) VALUES ('Бенчмарк запросов') RETURNING id")[0][0]
+    ids = seed(conn, org_id, args.employees)
+
+    benchmarks = cases(org_id, ids)
+    # Новый запрос в реестре без параметров здесь - ошибка бенчмарка, а не тихий пропуск
+    missing = set(bot.queries.names()) - set(benchmarks)
+    if missing:
+        sys.exit(f"❌ Нет параметров для запросов: {', '.join(sorted(missing))}")
+
+    results = {}
+    for name, params in benchmarks.items():
+        sql = bot.queries.sql(name)
+        statement = bot.queries.statement(conn, name)
+        # Прогрев: кэш страниц и каталога, чтобы первым вариантом не платить за холодный старт
+        for _ in range(min(50, args.iterations)):
+            conn.run(sql, **params)
+            statement.run(**params)
+        adhoc = measure(lambda: conn.run(sql, **params), args.iterations)
+        prepared = measure(lambda: statement.run(**params), args.iterations)
+        results[name] = {
+            'adhoc_per_sec': round(args.iterations / adhoc),
+            'prepared_per_sec': round(args.iterations / prepared),
+            'adhoc_us': round(adhoc / args.iterations * 1e6, 1),
+            'prepared_us': round(prepared / args.iterations * 1e6, 1),
+            'speedup': round(adhoc / prepared, 2),
+        }
+    conn.close()
+
+    if args.json:
+        print(json.dumps({'iterations': args.iterations, 'employees': args.employees, 'queries': results},
+                         ensure_ascii=False, indent=2))
+    else:
+        print(f"{'запрос':<26}{'разово/с':>10}{'подгот./с':>11}{'разово мкс':>12}{'подгот. мкс':>13}{'ускорение':>11}")
+        for name, r in results.items():
+            print(f"{name:<26}{r['adhoc_per_sec']:>10}{r['prepared_per_sec']:>11}"
+                  f"{r['adhoc_us']:>12}{r['prepared_us']:>13}{r['speedup']:>10}x")
+
+    if server is not None:
+        server.cleanup()
+
+
+if __name__ == '__main__':
+    main()
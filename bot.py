@@ -2,12 +2,32 @@ import os
 import logging
 import sys
 import time
+import asyncio
+import atexit
+import bisect
+import codecs
+import csv
+import difflib
+import functools
+import heapq
+import hmac
+import io
+import json
+import queue
+import random
+import re
+import secrets
+import sqlite3
+import tempfile
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import date, datetime, timedelta
 
-# Детальная настройка логирования
+# Настройка логирования (LOG_LEVEL=DEBUG - с текстами SQL-запросов)
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.DEBUG
+    level=os.environ.get('LOG_LEVEL', 'INFO').upper()
 )
 logger = logging.getLogger(__name__)
 
@@ -41,22 +61,419 @@ try:
     import pg8000
     import telebot
     from telebot import types
-    from flask import Flask
+    from flask import Flask, request
     import threading
-    from urllib.parse import urlparse
+    from urllib.parse import parse_qs, urlparse
     logger.info("✅ Все модули успешно импортированы")
 except ImportError as e:
     logger.error(f"❌ Ошибка импорта: {e}")
     sys.exit(1)
 
+# Необязательные модули
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+    logger.warning("⚠️ openpyxl не установлен - выгрузка в Excel недоступна")
+
+try:
+    # Нужны только для RUNTIME=asyncio
+    from aiohttp import web
+    from telebot.async_telebot import AsyncTeleBot
+except ImportError:
+    web = AsyncTeleBot = None
+
 # Инициализируем бота
 try:
-    bot = telebot.TeleBot(BOT_TOKEN)
+    # Обработчики вызываются прямо в потоках UpdateDispatcher, без пула telebot
+    bot = telebot.TeleBot(BOT_TOKEN, threaded=False)
     logger.info("✅ Бот инициализирован")
 except Exception as e:
     logger.error(f"❌ Ошибка инициализации бота: {e}")
     sys.exit(1)
 
+# Метрики в формате Prometheus (отдаются на /metrics)
+METRICS = []
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SLOW_QUERY_SECONDS = float(os.environ.get('SLOW_QUERY_SECONDS', 0.5))
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+def format_labels(names, values, le=None):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Counter:
+    """Монотонный счетчик с метками"""
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(label, '') for label in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f'{self.name}{format_labels(self.labels, key)} {value}')
+        return lines
+
+class Histogram:
+    """Гистограмма длительностей с метками"""
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}  # метки -> [счетчики по корзинам, сумма, количество]
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(label, '') for label in self.labels)
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                data = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[0][i] += 1
+                    break
+            data[1] += value
+            data[2] += 1
+
+    def count(self):
+        """Общее число наблюдений по всем меткам"""
+        with self._lock:
+            return sum(data[2] for data in self._values.values())
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = sorted((key, [list(data[0]), data[1], data[2]]) for key, data in self._values.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{format_labels(self.labels, key, bound)} {cumulative}')
+            lines.append(f'{self.name}_bucket{format_labels(self.labels, key, "+Inf")} {count}')
+            lines.append(f'{self.name}_sum{format_labels(self.labels, key)} {total}')
+            lines.append(f'{self.name}_count{format_labels(self.labels, key)} {count}')
+        return lines
+
+class CallbackMetric:
+    """Значение, которое вычисляется в момент запроса /metrics"""
+
+    def __init__(self, name, help_text, fn, metric_type='gauge'):
+        self.name = name
+        self.help = help_text
+        self.fn = fn
+        self.type = metric_type
+        METRICS.append(self)
+
+    def render(self):
+        try:
+            value = self.fn()
+        except Exception:
+            return []
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}', f'{self.name} {value}']
+
+def render_metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+HANDLER_LATENCY = Histogram('bot_handler_duration_seconds', 'Время обработки по обработчикам', ('handler',))
+HANDLER_ERRORS = Counter('bot_handler_errors_total', 'Исключения в обработчиках', ('handler',))
+DB_QUERY_LATENCY = Histogram('bot_db_query_duration_seconds', 'Время выполнения SQL-запросов', ('query',))
+DB_QUERY_ROWS = Counter('bot_db_query_rows_total', 'Строк возвращено SQL-запросами', ('query',))
+DB_QUERY_ERRORS = Counter('bot_db_query_errors_total', 'Ошибки SQL-запросов', ('query',))
+TELEGRAM_LATENCY = Histogram('bot_telegram_api_duration_seconds', 'Время вызовов Telegram Bot API', ('method',))
+TELEGRAM_ERRORS = Counter('bot_telegram_api_errors_total', 'Сетевые ошибки вызовов Telegram Bot API', ('method',))
+UPDATES_RECEIVED = Counter('bot_updates_total', 'Получено обновлений от Telegram', ('source',))
+
+@contextmanager
+def measure_handler(name):
+    """Замеряет время выполнения блока как обработчика name"""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        HANDLER_ERRORS.inc(handler=name)
+        raise
+    finally:
+        HANDLER_LATENCY.observe(time.perf_counter() - started, handler=name)
+
+def timed_handler(name):
+    """Декоратор: пишет время работы обработчика в метрики"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with measure_handler(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+@functools.lru_cache(maxsize=512)
+def query_label(query):
+    """Короткое имя запроса для метрик: операция и основная таблица"""
+    words = query.split()
+    verb = words[0].lower() if words else 'unknown'
+    match = re.search(r'\b(?:FROM|INTO|UPDATE)\s+([a-z_]+)\b(?!\()', query, re.IGNORECASE)
+    return f'{verb} {match.group(1).lower()}' if match else verb
+
+def timed_request_sender(method, url, **kwargs):
+    """Отправляет запрос к Bot API, замеряя время по имени метода"""
+    api_method = url.rsplit('/', 1)[-1]
+    started = time.perf_counter()
+    try:
+        return telebot.apihelper._get_req_session().request(method, url, **kwargs)
+    except Exception:
+        TELEGRAM_ERRORS.inc(method=api_method)
+        raise
+    finally:
+        TELEGRAM_LATENCY.observe(time.perf_counter() - started, method=api_method)
+
+telebot.apihelper.CUSTOM_REQUEST_SENDER = timed_request_sender
+
+# Исходящие сообщения идут через очередь с ограничением скорости (лимиты Bot API:
+# около 30 сообщений в секунду на бота и около 1 в секунду в один чат)
+OUTBOX_GLOBAL_RATE = float(os.environ.get('OUTBOX_GLOBAL_RATE', 30))
+OUTBOX_CHAT_RATE = float(os.environ.get('OUTBOX_CHAT_RATE', 1))
+OUTBOX_CHAT_BURST = int(os.environ.get('OUTBOX_CHAT_BURST', 5))
+OUTBOX_SENDERS = int(os.environ.get('OUTBOX_SENDERS', 4))
+OUTBOX_MAX_ATTEMPTS = 5
+
+# Полосы приоритета: ответы пользователю раньше массовых уведомлений
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+OUTBOX_COALESCED = Counter('bot_outbox_coalesced_total', 'Повторные меню, замененные до отправки')
+OUTBOX_RATE_LIMITED = Counter('bot_outbox_rate_limited_total', 'Ответы 429 от Bot API')
+OUTBOX_FAILED = Counter('bot_outbox_failed_total', 'Сообщения, которые не удалось отправить')
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не больше burst подряд"""
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def delay(self, now):
+        """Сколько ждать до следующего токена; 0 - можно отправлять"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+class OutboundCall:
+    """Отложенный вызов Bot API в конкретный чат"""
+    __slots__ = ('chat_id', 'method', 'args', 'kwargs', 'coalesce', 'done', 'result', 'error')
+
+    def __init__(self, chat_id, method, args, kwargs, coalesce=None):
+        self.chat_id = chat_id
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.coalesce = coalesce
+        self.done = None
+        self.result = None
+        self.error = None
+
+class Outbox:
+    """Очередь исходящих вызовов: общий и початовый лимит скорости, полосы приоритета,
+    повтор после 429 с учетом retry_after. Вызовы в один чат уходят строго по порядку."""
+
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=5, senders=4):
+        self._cond = threading.Condition()
+        self._lanes = (OrderedDict(), OrderedDict())  # по приоритету: id чата -> очередь вызовов
+        self._global = TokenBucket(global_rate, max(1, int(global_rate)))
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._chat_buckets = {}
+        self._busy = set()  # чаты, в которые сейчас идет запрос
+        self._paused_until = 0
+        self._pruned_at = time.monotonic()
+        self._senders = max(1, senders)
+        self._started = False
+
+    def start(self):
+        with self._cond:
+            if self._started:
+                return
+            for i in range(self._senders):
+                threading.Thread(target=self._sender, name=f'outbox-sender-{i}', daemon=True).start()
+            self._started = True
+        atexit.register(self.wait_idle, timeout=5)
+        logger.info(f"✅ Очередь исходящих сообщений запущена: {self._senders} потоков")
+
+    def submit(self, chat_id, method, *args, priority=PRIORITY_INTERACTIVE, coalesce=None, wait=False, **kwargs):
+        """Ставит вызов method(*args, **kwargs) в очередь чата.
+        
+        coalesce - ключ склейки: если последний еще не отправленный вызов в этот чат
+        с тем же ключом, он заменяется новым. wait=True - дождаться отправки и вернуть
+        результат (или пробросить ошибку).
+        """
+        call = OutboundCall(chat_id, method, args, kwargs, coalesce)
+        if wait:
+            call.done = threading.Event()
+        with self._cond:
+            pending = self._lanes[priority].setdefault(chat_id, deque())
+            if coalesce and pending and pending[-1].coalesce == coalesce and pending[-1].done is None:
+                pending[-1] = call
+                OUTBOX_COALESCED.inc()
+            else:
+                pending.append(call)
+            self._cond.notify()
+        
+        if not wait:
+            return None
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def depth(self, priority=None):
+        lanes = self._lanes if priority is None else (self._lanes[priority],)
+        with self._cond:
+            return sum(len(pending) for lane in lanes for pending in lane.values())
+
+    def wait_below(self, priority, limit, timeout=None):
+        """Ждет, пока в полосе priority останется меньше limit вызовов"""
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: sum(len(pending) for pending in self._lanes[priority].values()) < limit, timeout
+            )
+
+    def idle(self, chat_id=None):
+        """Нет ни ожидающих, ни отправляемых вызовов (во все чаты или в chat_id)"""
+        if chat_id is None:
+            return not self._busy and not any(self._lanes)
+        return chat_id not in self._busy and not any(chat_id in lane for lane in self._lanes)
+
+    def wait_idle(self, chat_id=None, timeout=None):
+        """Ждет, пока очередь (или очередь чата) опустеет; False - не дождались"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self.idle(chat_id), timeout)
+
+    def _bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self._chat_rate, self._chat_burst)
+        return bucket
+
+    def _prune(self, now):
+        # Полные корзины чатов без очереди ничего не ограничивают - удаляем их
+        for chat_id in list(self._chat_buckets):
+            bucket = self._chat_buckets[chat_id]
+            if chat_id not in self._busy and bucket.delay(now) == 0 and bucket.tokens >= bucket.burst \
+                    and not any(chat_id in lane for lane in self._lanes):
+                del self._chat_buckets[chat_id]
+        self._pruned_at = now
+
+    def _pick(self, now):
+        """Следующий вызов, который можно отправить сейчас, или (None, сколько ждать)"""
+        if now - self._pruned_at > 60:
+            self._prune(now)
+        if self._paused_until > now:
+            return None, self._paused_until - now
+        wait = None
+        global_delay = self._global.delay(now)
+        for lane in self._lanes:
+            for chat_id, pending in lane.items():
+                if chat_id in self._busy:
+                    continue
+                if global_delay:
+                    return None, global_delay
+                delay = self._bucket(chat_id).delay(now)
+                if delay:
+                    wait = delay if wait is None else min(wait, delay)
+                    continue
+                call = pending.popleft()
+                if pending:
+                    # Чаты обслуживаются по кругу
+                    lane.move_to_end(chat_id)
+                else:
+                    del lane[chat_id]
+                self._bucket(chat_id).take()
+                self._global.take()
+                self._busy.add(chat_id)
+                return call, 0
+        return None, wait
+
+    def _sender(self):
+        while True:
+            with self._cond:
+                while True:
+                    call, wait = self._pick(time.monotonic())
+                    if call is not None:
+                        break
+                    self._cond.wait(wait)
+            try:
+                self._deliver(call)
+            finally:
+                with self._cond:
+                    self._busy.discard(call.chat_id)
+                    self._cond.notify_all()
+                if call.done is not None:
+                    call.done.set()
+
+    def _deliver(self, call):
+        for attempt in range(OUTBOX_MAX_ATTEMPTS):
+            try:
+                call.result = call.method(*call.args, **call.kwargs)
+                return
+            except telebot.apihelper.ApiTelegramException as e:
+                if e.error_code != 429:
+                    call.error = e
+                    break
+                retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 1)
+                OUTBOX_RATE_LIMITED.inc()
+                logger.warning(f"⚠️ Bot API 429: пауза {retry_after} с")
+                # Пауза для всех отправителей; этот поток держит чат, чтобы не нарушить порядок
+                with self._cond:
+                    self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                time.sleep(retry_after)
+            except Exception as e:
+                call.error = e
+                break
+        else:
+            call.error = RuntimeError(f"превышено число попыток ({OUTBOX_MAX_ATTEMPTS})")
+        
+        OUTBOX_FAILED.inc()
+        logger.error(f"❌ Не удалось отправить в чат {call.chat_id}: {call.error}")
+
+outbox = Outbox(OUTBOX_GLOBAL_RATE, OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST, OUTBOX_SENDERS)
+
+def send_message(chat_id, text, priority=PRIORITY_INTERACTIVE, coalesce=None, **kwargs):
+    """Отправляет сообщение через очередь; обработчик не ждет Bot API"""
+    outbox.submit(chat_id, bot.send_message, chat_id, text, priority=priority, coalesce=coalesce, **kwargs)
+
+def edit_message_text(text, chat_id, message_id, **kwargs):
+    outbox.submit(chat_id, bot.edit_message_text, text, chat_id, message_id, **kwargs)
+
+def edit_message_reply_markup(chat_id, message_id, **kwargs):
+    outbox.submit(chat_id, bot.edit_message_reply_markup, chat_id, message_id, **kwargs)
+
 # Flask app для поддержания активности
 app = Flask(__name__)
 
@@ -68,155 +485,1453 @@ def home():
 def ping():
     return "pong", 200
 
+@app.route('/metrics')
+def metrics():
+    return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+# Готовность к работе: Flask стартует сразу, а платформа ждет 200 на /ready
+readiness = {'db': False, 'bot': False}
+
+def readiness_report(db_alive=None):
+    """Тело и HTTP-статус ответа /ready (общие для Flask и aiohttp).
+    
+    db_alive - результат проверки базы, если вызывающий уже выполнил ее сам (асинхронно).
+    """
+    state = dict(readiness)
+    if state['db']:
+        # База могла отвалиться уже после старта - проверяем ее при каждом запросе
+        state['db'] = db_alive if db_alive is not None else bool(execute_prepared('ready', fetch=True))
+    status = 200 if all(state.values()) else 503
+    # Резервная реплика тоже готова: она принимает webhook и заменит лидера
+    state['role'] = 'leader' if coordinator.is_leader() else 'standby'
+    return json.dumps(state), status
+
+@app.route('/ready')
+def ready():
+    body, status = readiness_report()
+    return body, status, {'Content-Type': 'application/json'}
+
+PORT = int(os.environ.get('PORT', 8080))
+
 def run_flask():
-    port = int(os.environ.get('PORT', 8080))
-    app.run(host='0.0.0.0', port=port, debug=False, use_reloader=False)
+    app.run(host='0.0.0.0', port=PORT, debug=False, use_reloader=False)
+
+# Режим webhook: Telegram сам присылает обновления POST-запросами
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+WEBHOOK_PATH = '/webhook'
+UPDATE_QUEUE_SIZE = int(os.environ.get('UPDATE_QUEUE_SIZE', 1000))
+UPDATE_WORKERS = int(os.environ.get('UPDATE_WORKERS', 4))
+UPDATE_DEDUP_SIZE = int(os.environ.get('UPDATE_DEDUP_SIZE', 10000))
+
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    WEBHOOK_SECRET = secrets.token_urlsafe(32)
+    logger.warning("⚠️ WEBHOOK_SECRET не задан - сгенерирован случайный токен")
+
+def update_chat_id(update):
+    """Возвращает id чата, к которому относится обновление"""
+    for message in (update.message, update.edited_message, update.channel_post):
+        if message is not None:
+            return message.chat.id
+    if update.callback_query is not None:
+        call = update.callback_query
+        return call.message.chat.id if call.message else call.from_user.id
+    return 0
+
+class UpdateDispatcher:
+    """Пул рабочих потоков: разные чаты обрабатываются параллельно,
+    обновления одного чата - строго по порядку"""
+
+    def __init__(self, handler, workers=4, queue_size=1000):
+        self._handler = handler
+        workers = max(1, workers)
+        # У каждого потока своя очередь: чат всегда попадает в одну и ту же
+        shard_size = max(1, queue_size // workers)
+        self._queues = [queue.Queue(maxsize=shard_size) for _ in range(workers)]
+        self._started = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            for i, shard in enumerate(self._queues):
+                threading.Thread(
+                    target=self._worker, args=(shard,), name=f'update-worker-{i}', daemon=True
+                ).start()
+            self._started = True
+        logger.info(f"✅ Запущено обработчиков обновлений: {len(self._queues)}")
+
+    def submit(self, update, block=True, timeout=None):
+        """Ставит обновление в очередь; False - очередь чата переполнена"""
+        shard = self._queues[update_chat_id(update) % len(self._queues)]
+        try:
+            shard.put(update, block=block, timeout=timeout)
+            return True
+        except queue.Full:
+            return False
+
+    def depth(self):
+        return sum(shard.qsize() for shard in self._queues)
+
+    def _worker(self, shard):
+        while True:
+            update = shard.get()
+            try:
+                self._handler([update])
+            except Exception as e:
+                logger.error(f"❌ Ошибка обработки обновления {update.update_id}: {e}")
+            finally:
+                shard.task_done()
+
+dispatcher = UpdateDispatcher(bot.process_new_updates, UPDATE_WORKERS, UPDATE_QUEUE_SIZE)
+
+class RecentUpdates:
+    """Помнит последние update_id, чтобы не обрабатывать повторные доставки"""
+
+    def __init__(self, size):
+        self.size = size
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, update_id):
+        """Запоминает update_id; возвращает False, если он уже встречался"""
+        with self._lock:
+            if update_id in self._ids:
+                return False
+            self._ids[update_id] = None
+            if len(self._ids) > self.size:
+                self._ids.popitem(last=False)
+            return True
+
+    def discard(self, update_id):
+        with self._lock:
+            self._ids.pop(update_id, None)
+
+recent_updates = RecentUpdates(UPDATE_DEDUP_SIZE)
+
+def accept_webhook_update(token, body, submit):
+    """Проверяет и ставит в очередь обновление из webhook; возвращает (текст, HTTP-статус).
+    
+    submit(update) -> bool - постановка без ожидания (у Flask и aiohttp свои диспетчеры).
+    """
+    if not WEBHOOK_URL:
+        return "Not found", 404
+    
+    if not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+        logger.warning("⚠️ Webhook: неверный секретный токен")
+        return "Forbidden", 403
+    
+    try:
+        update = types.Update.de_json(body)
+    except Exception as e:
+        logger.error(f"❌ Webhook: некорректное обновление: {e}")
+        return "Bad request", 400
+    
+    if not recent_updates.add(update.update_id):
+        logger.debug("🔁 Повторное обновление %s пропущено", update.update_id)
+        return "ok", 200
+    UPDATES_RECEIVED.inc(source='webhook')
+    
+    if not submit(update):
+        # Telegram повторит доставку позже - забываем id, чтобы принять повтор
+        recent_updates.discard(update.update_id)
+        logger.warning("⚠️ Очередь обновлений переполнена")
+        return "Busy", 503
+    
+    return "ok", 200
 
-user_states = {}
+@app.route(WEBHOOK_PATH, methods=['POST'])
+def webhook():
+    return accept_webhook_update(
+        request.headers.get('X-Telegram-Bot-Api-Secret-Token', ''),
+        request.get_data(as_text=True),
+        lambda update: dispatcher.submit(update, block=False)
+    )
 
 def parse_db_url(db_url):
     """Парсит DATABASE_URL для pg8000"""
     try:
         parsed = urlparse(db_url)
+        query = parse_qs(parsed.query)
+        # Как в libpq: ?host=/каталог - unix-сокет, ?sslmode=disable - без TLS (локальная БД)
+        socket_dir = query.get('host', [None])[0]
+        port = parsed.port or 5432
         return {
             'host': parsed.hostname,
-            'port': parsed.port or 5432,
+            'port': port,
             'user': parsed.username,
             'password': parsed.password,
-            'database': parsed.path[1:] if parsed.path else None
+            'database': parsed.path[1:] if parsed.path else None,
+            'unix_sock': f"{socket_dir}/.s.PGSQL.{port}" if socket_dir else None,
+            'ssl': query.get('sslmode', ['require'])[0] != 'disable'
         }
     except Exception as e:
         logger.error(f"❌ Ошибка парсинга DATABASE_URL: {e}")
         return None
 
-def get_connection():
-    """Создает соединение с PostgreSQL через pg8000"""
+def get_connection(timeout=None):
+    """Создает соединение с PostgreSQL через pg8000 (timeout - таймаут сокета, сек)"""
     try:
         db_config = parse_db_url(DATABASE_URL)
         if not db_config:
             return None
         
+        if db_config['unix_sock']:
+            return pg8000.connect(
+                unix_sock=db_config['unix_sock'],
+                user=db_config['user'],
+                password=db_config['password'],
+                database=db_config['database'],
+                timeout=timeout
+            )
+        
         conn = pg8000.connect(
             host=db_config['host'],
             port=db_config['port'],
             user=db_config['user'],
             password=db_config['password'],
             database=db_config['database'],
-            ssl_context=True
+            ssl_context=True if db_config['ssl'] else None,
+            timeout=timeout
         )
         return conn
     except Exception as e:
         logger.error(f"❌ Ошибка подключения к БД: {e}")
         return None
 
-def execute_query(query, params=None, fetch=False):
-    """Универсальная функция выполнения запросов"""
-    logger.debug(f"🎯 ВЫПОЛНЕНИЕ ЗАПРОСА: {query}")
-    if params:
-        logger.debug(f"🎯 ПАРАМЕТРЫ: {params}")
+# Настройки пула соединений с БД
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', 1))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', 5))
+DB_POOL_IDLE_TIMEOUT = int(os.environ.get('DB_POOL_IDLE_TIMEOUT', 300))
+DB_POOL_CHECK_INTERVAL = int(os.environ.get('DB_POOL_CHECK_INTERVAL', 30))
+DB_POOL_ACQUIRE_TIMEOUT = int(os.environ.get('DB_POOL_ACQUIRE_TIMEOUT', 10))
+
+class ConnectionPool:
+    """Потокобезопасный пул долгоживущих соединений с PostgreSQL"""
+
+    def __init__(self, connect, min_size=1, max_size=5, idle_timeout=300,
+                 check_interval=30, acquire_timeout=10):
+        self._connect = connect
+        self.max_size = max(1, max_size)
+        self.min_size = max(0, min(min_size, self.max_size))
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.acquire_timeout = acquire_timeout
+        self._idle = []  # стек (conn, время возврата): свежие соединения берем первыми
+        self._size = 0
+        self._cond = threading.Condition()
+        self.on_close = None  # on_close(conn) - соединение закрыто пулом
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def idle_count(self):
+        return len(self._idle)
+
+    def _open(self):
+        """Открывает новое соединение в режиме autocommit"""
+        conn = self._connect()
+        if conn is not None:
+            # Каждый запрос - отдельная транзакция, без лишних BEGIN/COMMIT
+            conn.autocommit = True
+        return conn
+
+    def _close(self, conn):
+        if self.on_close is not None:
+            self.on_close(conn)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_healthy(self, conn):
+        """Проверяет, что соединение живо"""
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+                cursor.fetchall()
+            return True
+        except Exception as e:
+            logger.warning(f"⚠️ Соединение из пула не прошло проверку: {e}")
+            return False
+
+    def _evict_idle(self, now):
+        """Забирает из пула простаивающие соединения сверх min_size (под блокировкой)"""
+        expired = []
+        while (self._idle and self._size > self.min_size
+               and now - self._idle[0][1] > self.idle_timeout):
+            conn, _ = self._idle.pop(0)
+            self._size -= 1
+            expired.append(conn)
+        return expired
+
+    def acquire(self):
+        """Выдает соединение из пула или None, если БД недоступна"""
+        deadline = time.monotonic() + self.acquire_timeout
+        conn = None
+        reserved = False
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                expired = self._evict_idle(now)
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    reserved = True
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    last_used = now
+                    reserved = True
+                    break
+                if now >= deadline:
+                    break
+                self._cond.wait(deadline - now)
+
+        for old in expired:
+            self._close(old)
+        if not reserved:
+            logger.error("❌ Пул соединений исчерпан")
+            return None
+
+        if conn is not None and time.monotonic() - last_used > self.check_interval:
+            if not self._is_healthy(conn):
+                self._close(conn)
+                conn = None
+        if conn is None:
+            conn = self._open()
+            if conn is None:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+        return conn
+
+    def release(self, conn, broken=False):
+        """Возвращает соединение в пул; сломанное соединение закрывается"""
+        if conn is None:
+            return
+        if broken:
+            self._close(conn)
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def discard_idle(self):
+        """Закрывает все простаивающие соединения (например, после рестарта БД)"""
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._close(conn)
+
+    def warm_up(self):
+        """Заранее открывает min_size соединений"""
+        conns = [self.acquire() for _ in range(self.min_size)]
+        for conn in conns:
+            self.release(conn)
+
+    def close_all(self):
+        self.discard_idle()
+
+    @contextmanager
+    def connection(self):
+        """Выдает соединение на время блока with"""
+        conn = self.acquire()
+        try:
+            yield conn
+        except pg8000.InterfaceError:
+            self.release(conn, broken=True)
+            conn = None
+            raise
+        finally:
+            if conn is not None:
+                self.release(conn)
+
+db_pool = ConnectionPool(
+    get_connection,
+    min_size=DB_POOL_MIN_SIZE,
+    max_size=DB_POOL_MAX_SIZE,
+    idle_timeout=DB_POOL_IDLE_TIMEOUT,
+    check_interval=DB_POOL_CHECK_INTERVAL,
+    acquire_timeout=DB_POOL_ACQUIRE_TIMEOUT
+)
+
+def execute_query(query, params=None, fetch=False, name=None, retry=False):
+    """Универсальная функция выполнения запросов (name - метка запроса в метриках).
     
-    conn = get_connection()
-    if not conn:
-        logger.error("❌ Нет соединения с БД")
-        return None
+    retry=True - только для чтения и идемпотентных записей: их можно повторить при обрыве соединения.
+    """
+    label = name or query_label(query)
+    logger.debug("🎯 ВЫПОЛНЕНИЕ ЗАПРОСА [%s]: %s %s", label, query, params or '')
     
-    try:
+    def run(conn):
         with conn.cursor() as cursor:
-            cursor.execute(query, params)
+            cursor.execute(query, params or ())
+            return cursor.fetchall() if fetch else True
+    
+    return run_with_retry(label, run, query, params, retry=retry)
+
+def run_with_retry(label, run, query, params, on_error=None, retry=False):
+    """Выполняет run(conn) на соединении из пула: метрики, журнал ошибок и повтор при обрыве.
+    
+    run возвращает строки или True; on_error(conn) вызывается после ошибки запроса.
+    """
+    # Вторая попытка - на случай, если соединение из пула оборвалось (рестарт БД, прокси).
+    # Обрыв мог случиться уже после коммита на сервере, поэтому неидемпотентные записи
+    # (INSERT без ON CONFLICT, pg_notify) не повторяем: дубль хуже ошибки
+    for attempt in range(2 if retry else 1):
+        conn = db_pool.acquire()
+        if not conn:
+            logger.error("❌ Нет соединения с БД")
+            DB_QUERY_ERRORS.inc(query=label)
+            return None
+        
+        started = time.perf_counter()
+        try:
+            result = run(conn)
+            if result is not True:
+                DB_QUERY_ROWS.inc(len(result), query=label)
             
-            if fetch:
-                result = cursor.fetchall()
-                logger.debug(f"✅ Запрос выполнен (fetch). Найдено записей: {len(result)}")
-                if result:
-                    logger.debug(f"📊 РЕЗУЛЬТАТ: {result}")
-                else:
-                    logger.debug("📊 РЕЗУЛЬТАТ: ПУСТОЙ РЕЗУЛЬТАТ")
-            else:
-                conn.commit()
-                result = True
-                logger.debug("✅ Запрос выполнен (insert/update)")
-                
+            elapsed = time.perf_counter() - started
+            DB_QUERY_LATENCY.observe(elapsed, query=label)
+            if elapsed > SLOW_QUERY_SECONDS:
+                logger.warning(f"🐢 Медленный запрос [{label}]: {elapsed:.2f} с")
+            db_pool.release(conn)
             return result
-    except Exception as e:
-        logger.error(f"❌ Ошибка выполнения запроса: {e}")
-        logger.error(f"❌ Запрос: {query}")
-        logger.error(f"❌ Параметры: {params}")
-        conn.rollback()
-        return None
-    finally:
-        conn.close()
+        except pg8000.InterfaceError as e:
+            logger.warning(f"⚠️ Соединение с БД разорвано: {e}")
+            db_pool.release(conn, broken=True)
+            db_pool.discard_idle()
+        except Exception as e:
+            DB_QUERY_ERRORS.inc(query=label)
+            logger.error(f"❌ Ошибка выполнения запроса [{label}]: {e}")
+            logger.error(f"❌ Запрос: {query}")
+            logger.error(f"❌ Параметры: {params}")
+            if on_error is not None:
+                on_error(conn)
+            db_pool.release(conn)
+            return None
+    
+    DB_QUERY_ERRORS.inc(query=label)
+    logger.error(f"❌ Ошибка выполнения запроса [{label}]: соединение с БД потеряно")
+    logger.error(f"❌ Запрос: {query}")
+    return None
 
-def init_db():
-    """Инициализация базы данных"""
-    logger.info("🔄 ИНИЦИАЛИЗАЦИЯ БАЗЫ ДАННЫХ...")
+# Реестр запросов горячего пути: у каждого запроса есть имя, на каждом соединении пула он
+# готовится (Parse) один раз при первом использовании и дальше выполняется по имени - сервер
+# не разбирает и не планирует его заново. Параметры именованные (:org_id), типы неоднозначных
+# параметров указываются в тексте запроса (:ids::int[])
+class QueryRegistry:
+    """Именованные запросы и их подготовленные версии на соединениях пула"""
+
+    def __init__(self):
+        self._sql = {}
+        self._retry = set()  # запросы, которые можно повторить после обрыва соединения
+        self._prepared = {}  # соединение -> {имя: PreparedStatement}
+        self._lock = threading.Lock()
+
+    def register(self, name, sql, retry=False):
+        """retry=True - чтение или идемпотентная запись (см. execute_query)"""
+        if name in self._sql:
+            raise ValueError(f"Запрос {name} уже зарегистрирован")
+        self._sql[name] = sql
+        if retry:
+            self._retry.add(name)
+        return name
+
+    def sql(self, name):
+        return self._sql[name]
+
+    def retryable(self, name):
+        return name in self._retry
+
+    def names(self):
+        return list(self._sql)
+
+    def statement(self, conn, name):
+        """Подготовленный запрос на соединении; готовится при первом обращении"""
+        with self._lock:
+            statements = self._prepared.setdefault(conn, {})
+            statement = statements.get(name)
+        if statement is None:
+            # Соединение в каждый момент занято одним потоком - гонки за один запрос нет
+            statement = conn.prepare(self._sql[name])
+            with self._lock:
+                statements[name] = statement
+        return statement
+
+    def discard(self, conn, name):
+        """Забывает подготовленный запрос (после ошибки, например смены схемы): следующий вызов подготовит заново"""
+        with self._lock:
+            statement = self._prepared.get(conn, {}).pop(name, None)
+        if statement is not None:
+            try:
+                statement.close()
+            except Exception:
+                pass
+
+    def forget(self, conn):
+        """Забывает все запросы соединения - пул его закрыл"""
+        with self._lock:
+            self._prepared.pop(conn, None)
+
+    def prepared_count(self):
+        with self._lock:
+            return sum(len(statements) for statements in self._prepared.values())
+
+queries = QueryRegistry()
+db_pool.on_close = queries.forget
+queries.register('ready', 'SELECT 1', retry=True)  # проверка готовности в /ready
+
+def execute_prepared(query_name, /, fetch=False, **params):
+    """Выполняет запрос из реестра по имени с тем же контрактом, что и execute_query.
     
-    conn = get_connection()
-    if not conn:
-        logger.error("❌ Не удалось подключиться к БД для инициализации")
-        return False
+    Имя запроса - только позиционный аргумент: параметр запроса может называться как угодно.
+    """
+    logger.debug("🎯 ВЫПОЛНЕНИЕ ЗАПРОСА [%s] %s", query_name, params)
     
-    try:
+    def run(conn):
+        rows = queries.statement(conn, query_name).run(**params)
+        return list(rows) if fetch else True
+    
+    return run_with_retry(query_name, run, queries.sql(query_name), params,
+        on_error=lambda conn: queries.discard(conn, query_name),
+        retry=queries.retryable(query_name)
+    )
+
+# Доступ к данным для корутин (RUNTIME=asyncio). pg8000 блокирующий, поэтому запрос выполняет
+# тот же синхронный код (пул, подготовленные запросы, правила повтора) в отдельном пуле потоков
+# размером с пул соединений, а корутина ждет результат, не занимая цикл событий.
+# Через этот слой к базе обращается сам цикл событий; обработчики обновлений, очередь исходящих,
+# журнал отметок и планировщик работают в своих потоках и вызывают синхронные функции напрямую
+db_executor = ThreadPoolExecutor(max_workers=DB_POOL_MAX_SIZE, thread_name_prefix='db')
+
+async def execute_query_async(query, params=None, fetch=False, name=None, retry=False):
+    """Асинхронная версия execute_query с тем же контрактом"""
+    return await asyncio.get_running_loop().run_in_executor(
+        db_executor, functools.partial(execute_query, query, params, fetch, name, retry)
+    )
+
+async def execute_prepared_async(query_name, /, fetch=False, **params):
+    """Асинхронная версия execute_prepared с тем же контрактом"""
+    return await asyncio.get_running_loop().run_in_executor(
+        db_executor, functools.partial(execute_prepared, query_name, fetch=fetch, **params)
+    )
+
+# Несколько реплик: у каждой есть выделенное соединение координации. Через него реплика
+# держит advisory lock лидера (лидер один: он читает getUpdates и выполняет плановые задачи)
+# и слушает LISTEN - другие реплики сообщают об изменениях, после которых надо сбросить кэш.
+# Сессия лидера живет на сервере не дольше LEADER_LEASE_SECONDS без запросов
+# (idle_session_timeout), поэтому блокировка упавшего лидера освобождается за секунды
+LEADER_LOCK_ID = 7_265_111
+LEADER_CHECK_INTERVAL = float(os.environ.get('LEADER_CHECK_INTERVAL', 2))
+LEADER_LEASE_SECONDS = int(os.environ.get('LEADER_LEASE_SECONDS', 10))
+CACHE_CHANNEL = 'bot_cache'
+
+class Coordinator:
+    """Выборы лидера через advisory lock и рассылка сброса кэшей через LISTEN/NOTIFY"""
+
+    def __init__(self, lock_id, interval=2, lease=10):
+        self.lock_id = lock_id
+        self.interval = interval
+        self.lease = lease
+        self._conn = None
+        self._leader = threading.Event()
+        self._subscribers = {}  # вид изменения -> обработчики(значение)
+        self._leader_callbacks = []
+        self._thread = None
+
+    def is_leader(self):
+        return self._leader.is_set()
+
+    def wait_leader(self, timeout=None):
+        """Ждет, пока реплика станет лидером; True - стала"""
+        return self._leader.wait(timeout)
+
+    def subscribe(self, kind, callback):
+        """callback(значение) вызывается при каждом publish(kind, значение) на любой реплике"""
+        self._subscribers.setdefault(kind, []).append(callback)
+
+    def on_leader(self, callback):
+        """callback() вызывается, когда реплика становится лидером; он не должен блокировать"""
+        self._leader_callbacks.append(callback)
+
+    def publish(self, kind, value=''):
+        """Сообщает всем репликам (включая эту) об изменении данных"""
+        return execute_prepared('cache_notify', channel=CACHE_CHANNEL, payload=f'{kind}:{value}')
+
+    def _connect(self):
+        # Таймаут сокета меньше аренды: зависший лидер сложит полномочия раньше,
+        # чем сервер отдаст блокировку другой реплике
+        conn = get_connection(timeout=self.lease / 2)
+        if conn is None:
+            return None
+        conn.autocommit = True
         with conn.cursor() as cursor:
-            # Таблица сотрудников
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS employees (
-                    id SERIAL PRIMARY KEY,
-                    full_name TEXT NOT NULL,
-                    position TEXT,
-                    is_active BOOLEAN DEFAULT TRUE,
-                    registered_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            # Таблица посещаемости
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS attendance (
-                    id SERIAL PRIMARY KEY,
-                    employee_id INTEGER REFERENCES employees(id),
-                    check_date DATE NOT NULL,
-                    marked_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE(employee_id, check_date)
-                )
-            ''')
-            
-            # Таблица администраторов
+            try:
+                cursor.execute(f"SET idle_session_timeout = '{int(self.lease)}s'")
+            except Exception as e:
+                logger.warning(f"⚠️ idle_session_timeout не поддерживается (PostgreSQL < 14): {e}")
+            cursor.execute(f'LISTEN {CACHE_CHANNEL}')
+        return conn
+
+    def _drop(self, reason):
+        if self._leader.is_set():
+            self._leader.clear()
+            logger.warning(f"⚠️ Реплика больше не лидер: {reason}")
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+    def _tick(self):
+        """Один шаг: пытаемся взять блокировку (лидер - просто отмечается) и разбираем уведомления"""
+        if self._conn is None:
+            self._conn = self._connect()
+            if self._conn is None:
+                return
+            # После переподключения уведомления могли потеряться - сбрасываем все кэши
+            self._dispatch('*', '')
+        
+        with self._conn.cursor() as cursor:
+            if self._leader.is_set():
+                cursor.execute('SELECT TRUE')
+            else:
+                cursor.execute('SELECT pg_try_advisory_lock(%s)', (self.lock_id,))
+            acquired = cursor.fetchone()[0]
+        if acquired and not self._leader.is_set():
+            logger.info("👑 Реплика стала лидером")
+            self._leader.set()
+            for callback in self._leader_callbacks:
+                try:
+                    callback()
+                except Exception as e:
+                    logger.error(f"❌ Ошибка обработчика перехода в лидеры: {e}")
+        
+        notifications = self._conn.notifications
+        overflow = len(notifications) == notifications.maxlen
+        while notifications:
+            _, _, payload = notifications.popleft()
+            kind, _, value = payload.partition(':')
+            self._dispatch(kind, value)
+        if overflow:
+            self._dispatch('*', '')
+
+    def _dispatch(self, kind, value):
+        kinds = self._subscribers if kind == '*' else (kind,)
+        for name in kinds:
+            for callback in self._subscribers.get(name, ()):
+                try:
+                    callback(value if kind != '*' else None)
+                except Exception as e:
+                    logger.error(f"❌ Ошибка обработки уведомления {name}: {e}")
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self._tick()
+            except Exception as e:
+                self._drop(e)
+
+    def start(self):
+        """Первый шаг выполняется сразу: к возврату уже известно, лидер ли реплика"""
+        if self._thread is not None:
+            return
+        try:
+            self._tick()
+        except Exception as e:
+            self._drop(e)
+        self._thread = threading.Thread(target=self._loop, name='coordinator', daemon=True)
+        self._thread.start()
+        logger.info(f"✅ Координация реплик запущена ({'лидер' if self.is_leader() else 'резерв'})")
+
+coordinator = Coordinator(LEADER_LOCK_ID, interval=LEADER_CHECK_INTERVAL, lease=LEADER_LEASE_SECONDS)
+queries.register('cache_notify', 'SELECT pg_notify(:channel, :payload)')
+
+# Триггеры и пересчет в том виде, в каком их применила миграция 2 (до организаций).
+# Вышедшие миграции не меняются: актуальные версии ниже, их применяет миграция 8
+ROLLUP_TRIGGER_SQL_V2 = [
+    '''
+    CREATE OR REPLACE FUNCTION attendance_rollup() RETURNS trigger AS $$
+    DECLARE
+        delta INTEGER := CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE -1 END;
+    BEGIN
+        INSERT INTO attendance_daily (check_date, present)
+        SELECT check_date, delta * COUNT(*) FROM changed_rows GROUP BY check_date
+        ON CONFLICT (check_date)
+        DO UPDATE SET present = attendance_daily.present + EXCLUDED.present;
+        
+        INSERT INTO attendance_monthly (employee_id, month, days_present)
+        SELECT employee_id, date_trunc('month', check_date)::date, delta * COUNT(*)
+        FROM changed_rows
+        GROUP BY employee_id, date_trunc('month', check_date)
+        ON CONFLICT (employee_id, month)
+        DO UPDATE SET days_present = attendance_monthly.days_present + EXCLUDED.days_present;
+        
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    ''',
+    'DROP TRIGGER IF EXISTS attendance_rollup_insert ON attendance',
+    '''
+    CREATE TRIGGER attendance_rollup_insert AFTER INSERT ON attendance
+    REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION attendance_rollup()
+    ''',
+    'DROP TRIGGER IF EXISTS attendance_rollup_delete ON attendance',
+    '''
+    CREATE TRIGGER attendance_rollup_delete AFTER DELETE ON attendance
+    REFERENCING OLD TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION attendance_rollup()
+    ''',
+]
+
+ROLLUP_REBUILD_SQL_V2 = [
+    # Блокируем запись в attendance, чтобы агрегаты не разошлись с данными во время пересчета
+    'LOCK TABLE attendance IN SHARE MODE',
+    'TRUNCATE attendance_daily, attendance_monthly',
+    '''
+    INSERT INTO attendance_daily (check_date, present)
+    SELECT check_date, COUNT(*) FROM attendance GROUP BY check_date
+    ''',
+    '''
+    INSERT INTO attendance_monthly (employee_id, month, days_present)
+    SELECT employee_id, date_trunc('month', check_date)::date, COUNT(*)
+    FROM attendance
+    GROUP BY employee_id, date_trunc('month', check_date)
+    ''',
+]
+
+# Агрегаты посещаемости поддерживаются триггерами на уровне оператора:
+# пакетная отметка обновляет каждую строку агрегата один раз
+ROLLUP_TRIGGER_SQL = [
+    '''
+    CREATE OR REPLACE FUNCTION attendance_rollup() RETURNS trigger AS $$
+    DECLARE
+        delta INTEGER := CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE -1 END;
+    BEGIN
+        INSERT INTO attendance_daily (org_id, check_date, present)
+        SELECT org_id, check_date, delta * COUNT(*) FROM changed_rows GROUP BY org_id, check_date
+        ON CONFLICT (org_id, check_date)
+        DO UPDATE SET present = attendance_daily.present + EXCLUDED.present;
+        
+        INSERT INTO attendance_monthly (org_id, employee_id, month, days_present)
+        SELECT org_id, employee_id, date_trunc('month', check_date)::date, delta * COUNT(*)
+        FROM changed_rows
+        GROUP BY org_id, employee_id, date_trunc('month', check_date)
+        ON CONFLICT (employee_id, month)
+        DO UPDATE SET days_present = attendance_monthly.days_present + EXCLUDED.days_present;
+        
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    ''',
+    'DROP TRIGGER IF EXISTS attendance_rollup_insert ON attendance',
+    '''
+    CREATE TRIGGER attendance_rollup_insert AFTER INSERT ON attendance
+    REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION attendance_rollup()
+    ''',
+    'DROP TRIGGER IF EXISTS attendance_rollup_delete ON attendance',
+    '''
+    CREATE TRIGGER attendance_rollup_delete AFTER DELETE ON attendance
+    REFERENCING OLD TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION attendance_rollup()
+    ''',
+]
+
+ROLLUP_REBUILD_SQL = [
+    # Блокируем запись в attendance, чтобы агрегаты не разошлись с данными во время пересчета
+    'LOCK TABLE attendance IN SHARE MODE',
+    'TRUNCATE attendance_daily, attendance_monthly',
+    '''
+    INSERT INTO attendance_daily (org_id, check_date, present)
+    SELECT org_id, check_date, COUNT(*) FROM attendance GROUP BY org_id, check_date
+    ''',
+    '''
+    INSERT INTO attendance_monthly (org_id, employee_id, month, days_present)
+    SELECT org_id, employee_id, date_trunc('month', check_date)::date, COUNT(*)
+    FROM attendance
+    GROUP BY org_id, employee_id, date_trunc('month', check_date)
+    ''',
+]
+
+def rebuild_rollups():
+    """Пересчитывает агрегаты посещаемости по таблице attendance"""
+    logger.info("🔄 Пересчет агрегатов посещаемости...")
+    try:
+        with db_pool.connection() as conn:
+            if not conn:
+                logger.error("❌ Нет соединения с БД")
+                return False
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute('BEGIN')
+                    for statement in ROLLUP_REBUILD_SQL:
+                        cursor.execute(statement)
+                conn.commit()
+            except pg8000.InterfaceError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Ошибка пересчета агрегатов: {e}")
+                conn.rollback()
+                return False
+    except pg8000.InterfaceError as e:
+        logger.error(f"❌ Соединение с БД разорвано при пересчете агрегатов: {e}")
+        return False
+    
+    logger.info("✅ Агрегаты посещаемости пересчитаны")
+    return True
+
+# Организация, к которой относятся данные, созданные до появления организаций, и ADMIN_ID
+DEFAULT_ORG_ID = 1
+
+# Миграции схемы: (версия, описание, запросы). Применяются по порядку один раз,
+# каждая в своей транзакции. Запросы идемпотентны, чтобы первая миграция прошла
+# и на базах, созданных до появления schema_migrations.
+MIGRATIONS = [
+    (1, 'базовые таблицы', [
+        '''
+        CREATE TABLE IF NOT EXISTS employees (
+            id SERIAL PRIMARY KEY,
+            full_name TEXT NOT NULL,
+            position TEXT,
+            is_active BOOLEAN DEFAULT TRUE,
+            registered_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS attendance (
+            id SERIAL PRIMARY KEY,
+            employee_id INTEGER REFERENCES employees(id),
+            check_date DATE NOT NULL,
+            marked_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(employee_id, check_date)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS admins (
+            user_id INTEGER UNIQUE
+        )
+        ''',
+    ]),
+    (2, 'агрегаты посещаемости', [
+        # Итоги по дням и по сотрудникам за месяц, поддерживаются триггерами
+        '''
+        CREATE TABLE IF NOT EXISTS attendance_daily (
+            check_date DATE PRIMARY KEY,
+            present INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS attendance_monthly (
+            employee_id INTEGER NOT NULL REFERENCES employees(id),
+            month DATE NOT NULL,
+            days_present INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (employee_id, month)
+        )
+        ''',
+        *ROLLUP_TRIGGER_SQL_V2,
+        *ROLLUP_REBUILD_SQL_V2,
+    ]),
+    (3, 'состояния диалогов', [
+        # Незавершенные сценарии переживают перезапуск
+        '''
+        CREATE TABLE IF NOT EXISTS user_states (
+            user_id BIGINT PRIMARY KEY,
+            step TEXT NOT NULL,
+            payload TEXT,
+            updated_at TIMESTAMPTZ NOT NULL
+        )
+        ''',
+    ]),
+    (4, 'id администраторов BIGINT', [
+        # id пользователей Telegram уже не помещаются в INTEGER
+        'ALTER TABLE admins ALTER COLUMN user_id TYPE BIGINT',
+    ]),
+    (5, 'индексы горячих запросов', [
+        # Ростер: активные сотрудники по алфавиту
+        'CREATE INDEX IF NOT EXISTS employees_active_name_idx ON employees (full_name, id) WHERE is_active = TRUE',
+        # Отчеты и выгрузка за период, отметки за день
+        'CREATE INDEX IF NOT EXISTS attendance_check_date_idx ON attendance (check_date, employee_id)',
+        # Отчет за период по месячным агрегатам всех сотрудников
+        'CREATE INDEX IF NOT EXISTS attendance_monthly_month_idx ON attendance_monthly (month)',
+    ]),
+    (6, 'постраничный список сотрудников', [
+        # Без NULL в is_active сравнение ключей (NOT is_active, full_name, id) однозначно
+        'UPDATE employees SET is_active = TRUE WHERE is_active IS NULL',
+        'ALTER TABLE employees ALTER COLUMN is_active SET NOT NULL',
+        'CREATE INDEX IF NOT EXISTS employees_list_idx ON employees ((NOT is_active), full_name, id)',
+    ]),
+    (7, 'плановые задачи', [
+        '''
+        CREATE TABLE IF NOT EXISTS scheduled_jobs (
+            name TEXT PRIMARY KEY,
+            next_run TIMESTAMPTZ NOT NULL,
+            last_run TIMESTAMPTZ
+        )
+        ''',
+    ]),
+    (8, 'организации', [
+        '''
+        CREATE TABLE IF NOT EXISTS organizations (
+            id SERIAL PRIMARY KEY,
+            name TEXT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        ''',
+        # Все существующие данные принадлежат первой организации
+        f"INSERT INTO organizations (id, name) VALUES ({DEFAULT_ORG_ID}, 'Основная организация') "
+        "ON CONFLICT (id) DO NOTHING",
+        "SELECT setval(pg_get_serial_sequence('organizations', 'id'), MAX(id)) FROM organizations",
+        *[
+            statement
+            for table in ('employees', 'attendance', 'admins', 'attendance_daily', 'attendance_monthly')
+            for statement in (
+                f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS org_id INTEGER NOT NULL '
+                f'DEFAULT {DEFAULT_ORG_ID} REFERENCES organizations(id)',
+                # Без значения по умолчанию запись без организации - ошибка, а не данные чужой команды
+                f'ALTER TABLE {table} ALTER COLUMN org_id DROP DEFAULT',
+            )
+        ],
+        'ALTER TABLE attendance_daily DROP CONSTRAINT IF EXISTS attendance_daily_pkey',
+        'ALTER TABLE attendance_daily ADD PRIMARY KEY (org_id, check_date)',
+        # Индексы начинаются с организации: запросы команды читают только ее диапазон индекса,
+        # и размер чужих команд на них не влияет
+        'DROP INDEX IF EXISTS employees_active_name_idx',
+        'CREATE INDEX employees_active_name_idx ON employees (org_id, full_name, id) WHERE is_active = TRUE',
+        'DROP INDEX IF EXISTS employees_list_idx',
+        'CREATE INDEX employees_list_idx ON employees (org_id, (NOT is_active), full_name, id)',
+        'DROP INDEX IF EXISTS attendance_check_date_idx',
+        'CREATE INDEX attendance_check_date_idx ON attendance (org_id, check_date, employee_id)',
+        'DROP INDEX IF EXISTS attendance_monthly_month_idx',
+        'CREATE INDEX attendance_monthly_month_idx ON attendance_monthly (org_id, month)',
+        'CREATE INDEX IF NOT EXISTS admins_org_idx ON admins (org_id, user_id)',
+        # Триггеры миграции 2 не знают об org_id: заменяем их и пересчитываем агрегаты по организациям
+        *ROLLUP_TRIGGER_SQL,
+        *ROLLUP_REBUILD_SQL,
+    ]),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+# Ключ advisory lock: несколько реплик не применяют миграции одновременно
+MIGRATION_LOCK_ID = 7_265_110
+
+def get_schema_version(cursor):
+    """Текущая версия схемы; 0 - миграции еще не применялись"""
+    cursor.execute("SELECT to_regclass('schema_migrations') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        return 0
+    cursor.execute('SELECT COALESCE(MAX(version), 0) FROM schema_migrations')
+    return cursor.fetchone()[0]
+
+def apply_migrations(conn):
+    """Применяет недостающие миграции под advisory lock"""
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_lock(%s)', (MIGRATION_LOCK_ID,))
+        try:
             cursor.execute('''
-                CREATE TABLE IF NOT EXISTS admins (
-                    user_id INTEGER UNIQUE
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
                 )
             ''')
+            # Перечитываем под блокировкой: другая реплика могла успеть раньше
+            cursor.execute('SELECT version FROM schema_migrations')
+            applied = {row[0] for row in cursor.fetchall()}
             
-            # Добавляем администратора
-            cursor.execute(
-                'INSERT INTO admins (user_id) VALUES (%s) ON CONFLICT (user_id) DO NOTHING', 
-                (int(ADMIN_ID),)
-            )
-            
-        conn.commit()
-        logger.info("✅ База данных инициализирована")
-        return True
-            
-    except Exception as e:
-        logger.error(f"❌ Ошибка инициализации БД: {e}")
-        conn.rollback()
+            for version, name, statements in MIGRATIONS:
+                if version in applied:
+                    continue
+                logger.info(f"🔄 Миграция {version}: {name}")
+                cursor.execute('BEGIN')
+                try:
+                    for statement in statements:
+                        cursor.execute(statement)
+                    cursor.execute(
+                        'INSERT INTO schema_migrations (version, name) VALUES (%s, %s)',
+                        (version, name)
+                    )
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+        finally:
+            cursor.execute('SELECT pg_advisory_unlock(%s)', (MIGRATION_LOCK_ID,))
+
+def init_db():
+    """Приводит схему БД к последней версии и добавляет администратора"""
+    logger.info("🔄 ИНИЦИАЛИЗАЦИЯ БАЗЫ ДАННЫХ...")
+    
+    try:
+        with db_pool.connection() as conn:
+            if not conn:
+                logger.error("❌ Не удалось подключиться к БД для инициализации")
+                return False
+        
+            try:
+                with conn.cursor() as cursor:
+                    version = get_schema_version(cursor)
+                
+                if version < SCHEMA_VERSION:
+                    apply_migrations(conn)
+                    logger.info(f"✅ Схема БД обновлена: версия {version} → {SCHEMA_VERSION}")
+                else:
+                    logger.info(f"✅ Схема БД актуальна (версия {version})")
+                
+                with conn.cursor() as cursor:
+                    # Добавляем администратора
+                    cursor.execute(
+                        'INSERT INTO admins (user_id, org_id) VALUES (%s, %s) ON CONFLICT (user_id) DO NOTHING', 
+                        (int(ADMIN_ID), DEFAULT_ORG_ID)
+                    )
+                
+                invalidate_admin_cache()
+                logger.info("✅ База данных инициализирована")
+                return True
+                
+            except pg8000.InterfaceError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Ошибка инициализации БД: {e}")
+                return False
+    except pg8000.InterfaceError as e:
+        logger.error(f"❌ Соединение с БД разорвано при инициализации: {e}")
         return False
-    finally:
-        conn.close()
 
-def is_admin(user_id):
-    """Проверяет, является ли пользователь администратором"""
-    result = execute_query(
-        'SELECT * FROM admins WHERE user_id = %s', 
-        (user_id,), 
-        fetch=True
-    )
-    return bool(result)
+# Кэш администраторов
+ADMIN_CACHE_TTL = int(os.environ.get('ADMIN_CACHE_TTL', 300))
 
-def create_main_menu():
-    """Создает основное меню"""
-    keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-    buttons = [
-        "👥 Сотрудники",
+class AdminCache:
+    """Администраторы и их организации в памяти процесса с обновлением по TTL"""
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._admins = {}  # user_id -> org_id; заменяется целиком, не изменяется
+        self._loaded_at = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _is_stale(self):
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl
+
+    def refresh(self):
+        """Перечитывает таблицу admins; при ошибке БД оставляет прежний список"""
+        rows = execute_prepared('admins_all', fetch=True)
+        if rows is None:
+            logger.warning("⚠️ Не удалось обновить кэш администраторов")
+            return False
+        self._admins = dict(rows)
+        self._loaded_at = time.monotonic()
+        logger.info(f"✅ Кэш администраторов обновлен: {len(self._admins)}")
+        return True
+
+    def invalidate(self):
+        """Помечает кэш устаревшим - следующая проверка перечитает таблицу"""
+        self._loaded_at = None
+
+    def org_of(self, user_id):
+        """Организация администратора или None, если пользователь не администратор"""
+        if self._is_stale():
+            with self._lock:
+                # Перечитываем один раз, даже если ждали несколько потоков
+                if self._is_stale():
+                    self.misses += 1
+                    self.refresh()
+                else:
+                    self.hits += 1
+        else:
+            self.hits += 1
+        return self._admins.get(user_id)
+
+    def org_ids(self):
+        """Организации, у которых есть администраторы"""
+        if self._is_stale():
+            self.refresh()
+        return set(self._admins.values())
+
+    def stats(self):
+        return {'size': len(self._admins), 'hits': self.hits, 'misses': self.misses}
+
+queries.register('admins_all', 'SELECT user_id, org_id FROM admins', retry=True)
+admin_cache = AdminCache(ttl=ADMIN_CACHE_TTL)
+coordinator.subscribe('admins', lambda _: admin_cache.invalidate())
+
+def user_org(user_id):
+    """Организация, с данными которой работает администратор"""
+    return admin_cache.org_of(user_id)
+
+def invalidate_admin_cache():
+    """Сбрасывает кэш администраторов после изменения таблицы admins (на всех репликах)"""
+    admin_cache.invalidate()
+    coordinator.publish('admins')
+
+def add_admin(user_id, org_id):
+    """Добавляет администратора организации; False, если он уже администратор другой"""
+    result = execute_query(
+        '''
+        INSERT INTO admins (user_id, org_id) VALUES (%s, %s)
+        ON CONFLICT (user_id) DO UPDATE SET org_id = EXCLUDED.org_id WHERE admins.org_id = EXCLUDED.org_id
+        RETURNING user_id
+        ''',
+        (user_id, org_id),
+        fetch=True,
+        retry=True
+    )
+    invalidate_admin_cache()
+    return bool(result)
+
+def remove_admin(user_id, org_id):
+    """Удаляет администратора своей организации"""
+    result = execute_query(
+        'DELETE FROM admins WHERE user_id = %s AND org_id = %s RETURNING user_id',
+        (user_id, org_id),
+        fetch=True
+    )
+    invalidate_admin_cache()
+    return bool(result)
+
+def create_organization(name, admin_id):
+    """Создает организацию с первым администратором; возвращает ее id или None"""
+    result = execute_query(
+        '''
+        WITH org AS (
+            INSERT INTO organizations (name) SELECT %s
+            WHERE NOT EXISTS (SELECT 1 FROM admins WHERE user_id = %s)
+            RETURNING id
+        )
+        INSERT INTO admins (user_id, org_id) SELECT %s, id FROM org
+        RETURNING org_id
+        ''',
+        (name, admin_id, admin_id),
+        fetch=True
+    )
+    invalidate_admin_cache()
+    return result[0][0] if result else None
+
+# Состояния диалогов
+STATE_BACKEND = os.environ.get('STATE_BACKEND', 'postgres')  # postgres, sqlite или memory
+STATE_SQLITE_PATH = os.environ.get('STATE_SQLITE_PATH', os.path.join(os.getcwd(), 'data', 'states.db'))
+STATE_TTL = int(os.environ.get('STATE_TTL', 86400))
+STATE_MAX_USERS = int(os.environ.get('STATE_MAX_USERS', 10000))
+STATE_FLUSH_INTERVAL = float(os.environ.get('STATE_FLUSH_INTERVAL', 2))
+# Обновления принимают несколько реплик (webhook): диалог, начатый на одной, продолжается на другой.
+# Тогда состояние пользователя перечитывается из хранилища в начале каждого обновления и пишется сразу
+STATE_SHARED = os.environ.get('STATE_SHARED', '1' if WEBHOOK_URL else '0') != '0'
+
+class UserState:
+    """Состояние диалога одного пользователя: текущий шаг и данные шага"""
+    __slots__ = ('step', 'data', 'updated_at')
+
+    def __init__(self, step, data=None, updated_at=None):
+        self.step = step
+        self.data = data or None
+        self.updated_at = updated_at or time.time()
+
+class PostgresStateBackend:
+    """Хранит состояния в таблице user_states"""
+
+    def load(self, since):
+        rows = execute_query(
+            'SELECT user_id, step, payload, EXTRACT(EPOCH FROM updated_at) '
+            'FROM user_states WHERE updated_at > to_timestamp(%s)',
+            (since,),
+            fetch=True,
+            retry=True
+        )
+        return rows or []
+
+    def get(self, user_id):
+        """Строки (step, payload, updated_at) пользователя; None - хранилище недоступно"""
+        return execute_query(
+            'SELECT step, payload, EXTRACT(EPOCH FROM updated_at) FROM user_states WHERE user_id = %s',
+            (user_id,),
+            fetch=True,
+            name='state_get',
+            retry=True
+        )
+
+    def save(self, records):
+        """records - список (user_id, step, payload, updated_at)"""
+        values = ', '.join(['(%s, %s, %s, to_timestamp(%s))'] * len(records))
+        params = tuple(value for record in records for value in record)
+        return execute_query(
+            f'INSERT INTO user_states (user_id, step, payload, updated_at) VALUES {values} '
+            'ON CONFLICT (user_id) DO UPDATE SET step = EXCLUDED.step, '
+            'payload = EXCLUDED.payload, updated_at = EXCLUDED.updated_at',
+            params,
+            name='state_save',
+            retry=True
+        )
+
+    def delete(self, user_ids):
+        return execute_query('DELETE FROM user_states WHERE user_id = ANY(%s)', (list(user_ids),), retry=True)
+
+    def purge(self, before):
+        return execute_query('DELETE FROM user_states WHERE updated_at < to_timestamp(%s)', (before,), retry=True)
+
+class SqliteStateBackend:
+    """Хранит состояния в локальном файле SQLite"""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS user_states (
+                    user_id INTEGER PRIMARY KEY,
+                    step TEXT NOT NULL,
+                    payload TEXT,
+                    updated_at REAL NOT NULL
+                )
+            ''')
+
+    def load(self, since):
+        with self._lock:
+            return self._conn.execute(
+                'SELECT user_id, step, payload, updated_at FROM user_states WHERE updated_at > ?',
+                (since,)
+            ).fetchall()
+
+    def get(self, user_id):
+        with self._lock:
+            return self._conn.execute(
+                'SELECT step, payload, updated_at FROM user_states WHERE user_id = ?', (user_id,)
+            ).fetchall()
+
+    def save(self, records):
+        with self._lock, self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO user_states VALUES (?, ?, ?, ?)', records)
+        return True
+
+    def delete(self, user_ids):
+        with self._lock, self._conn:
+            self._conn.executemany('DELETE FROM user_states WHERE user_id = ?', [(uid,) for uid in user_ids])
+        return True
+
+    def purge(self, before):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM user_states WHERE updated_at < ?', (before,))
+        return True
+
+class StateStore:
+    """Состояния диалогов в памяти с TTL, лимитом размера и отложенной записью в хранилище.
+    
+    shared=True - хранилище общее для нескольких реплик: refresh() перечитывает диалог
+    пользователя из него, а изменения записываются сразу, а не фоновым сбросом.
+    """
+
+    def __init__(self, backend=None, ttl=86400, max_users=10000, flush_interval=2, shared=False):
+        self.backend = backend
+        self.shared = shared and backend is not None
+        self.ttl = ttl
+        self.max_users = max_users
+        self.flush_interval = flush_interval
+        self._states = OrderedDict()  # user_id -> UserState, от давно измененных к свежим
+        self._dirty = set()
+        self._deleted = set()
+        self._lock = threading.RLock()
+        self._flusher = None
+
+    def _touch(self, user_id, state):
+        state.updated_at = time.time()
+        self._states[user_id] = state
+        self._states.move_to_end(user_id)
+        self._deleted.discard(user_id)
+        self._dirty.add(user_id)
+        while len(self._states) > self.max_users:
+            old_id, _ = self._states.popitem(last=False)
+            logger.warning(f"⚠️ Превышен лимит состояний - сброшен диалог пользователя {old_id}")
+            self._dirty.discard(old_id)
+            self._deleted.add(old_id)
+
+    def get(self, user_id):
+        """Возвращает UserState или None"""
+        with self._lock:
+            state = self._states.get(user_id)
+            if state is not None and time.time() - state.updated_at > self.ttl:
+                self._drop(user_id)
+                return None
+            return state
+
+    def refresh(self, user_id):
+        """Перечитывает диалог пользователя из общего хранилища: его могла продолжить другая реплика"""
+        if not self.shared:
+            return
+        rows = self.backend.get(user_id)
+        if rows is None:
+            return  # Хранилище недоступно - продолжаем с тем, что в памяти
+        with self._lock:
+            if user_id in self._dirty or user_id in self._deleted:
+                return  # Своя запись еще не дошла до хранилища - она новее
+            self._states.pop(user_id, None)
+            for step, payload, updated_at in rows:
+                data = json.loads(payload) if payload else None
+                self._states[user_id] = UserState(step, data, float(updated_at))
+
+    def _write_through(self):
+        if self.shared:
+            self.flush()
+
+    def set_step(self, user_id, step):
+        with self._lock:
+            state = self.get(user_id) or UserState(step)
+            state.step = step
+            self._touch(user_id, state)
+        self._write_through()
+
+    def get_data(self, user_id, key, default=None):
+        with self._lock:
+            state = self.get(user_id)
+            if state is None or not state.data:
+                return default
+            return state.data.get(key, default)
+
+    def set_data(self, user_id, key, value):
+        with self._lock:
+            state = self.get(user_id)
+            if state is None:
+                return
+            if state.data is None:
+                state.data = {}
+            state.data[key] = value
+            self._touch(user_id, state)
+        self._write_through()
+
+    def _drop(self, user_id):
+        if self._states.pop(user_id, None) is not None:
+            self._dirty.discard(user_id)
+            self._deleted.add(user_id)
+
+    def clear(self, user_id):
+        with self._lock:
+            self._drop(user_id)
+        self._write_through()
+
+    def __len__(self):
+        return len(self._states)
+
+    def sweep(self):
+        """Удаляет диалоги, брошенные дольше TTL"""
+        deadline = time.time() - self.ttl
+        with self._lock:
+            expired = [uid for uid, state in self._states.items() if state.updated_at < deadline]
+            for uid in expired:
+                self._drop(uid)
+        return len(expired)
+
+    def load(self):
+        """Восстанавливает незавершенные диалоги после перезапуска"""
+        if self.backend is None:
+            return 0
+        since = time.time() - self.ttl
+        rows = self.backend.load(since)
+        with self._lock:
+            for user_id, step, payload, updated_at in rows:
+                if user_id in self._states:
+                    continue
+                data = json.loads(payload) if payload else None
+                self._states[user_id] = UserState(step, data, float(updated_at))
+            # Восстанавливаем порядок вытеснения по времени изменения
+            for user_id, _ in sorted(self._states.items(), key=lambda item: item[1].updated_at):
+                self._states.move_to_end(user_id)
+        logger.info(f"✅ Восстановлено состояний диалогов: {len(rows)}")
+        return len(rows)
+
+    def flush(self):
+        """Записывает накопленные изменения в хранилище"""
+        if self.backend is None:
+            return
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            deleted, self._deleted = self._deleted, set()
+            records = []
+            for user_id in dirty:
+                state = self._states.get(user_id)
+                if state is not None:
+                    payload = json.dumps(state.data, ensure_ascii=False) if state.data else None
+                    records.append((user_id, state.step, payload, state.updated_at))
+        
+        if records and not self.backend.save(records):
+            with self._lock:
+                # Не записалось - повторим при следующем сбросе, если запись не изменилась
+                self._dirty.update(uid for uid, *_ in records if uid in self._states)
+        if deleted and not self.backend.delete(deleted):
+            with self._lock:
+                self._deleted.update(uid for uid in deleted if uid not in self._states)
+
+    def _flush_loop(self):
+        last_sweep = time.monotonic()
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                if time.monotonic() - last_sweep > 60:
+                    self.sweep()
+                    self.backend.purge(time.time() - self.ttl)
+                    last_sweep = time.monotonic()
+                self.flush()
+            except Exception as e:
+                logger.error(f"❌ Ошибка записи состояний диалогов: {e}")
+
+    def start(self):
+        """Запускает фоновую запись изменений"""
+        if self.backend is None or self._flusher is not None:
+            return
+        self._flusher = threading.Thread(target=self._flush_loop, name='state-flusher', daemon=True)
+        self._flusher.start()
+        atexit.register(self.flush)
+
+def create_state_backend():
+    if STATE_BACKEND == 'sqlite':
+        return SqliteStateBackend(STATE_SQLITE_PATH)
+    if STATE_BACKEND == 'memory':
+        return None
+    return PostgresStateBackend()
+
+state_store = StateStore(
+    create_state_backend(),
+    ttl=STATE_TTL,
+    max_users=STATE_MAX_USERS,
+    flush_interval=STATE_FLUSH_INTERVAL,
+    shared=STATE_SHARED
+)
+
+def get_user_state(user_id):
+    state = state_store.get(user_id)
+    return state.step if state is not None else None
+
+def set_user_state(user_id, step):
+    state_store.set_step(user_id, step)
+
+def get_user_data(user_id, key, default=None):
+    return state_store.get_data(user_id, key, default)
+
+def set_user_data(user_id, key, value):
+    state_store.set_data(user_id, key, value)
+
+def clear_user_state(user_id):
+    """Удаляет состояние пользователя вместе с временными данными"""
+    state_store.clear(user_id)
+
+def create_main_menu():
+    """Создает основное меню"""
+    keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
+    buttons = [
+        "👥 Сотрудники",
         "✅ Отметить сегодня", 
         "📊 Отчеты",
         "📅 Отметить за дату",
@@ -231,6 +1946,7 @@ def create_employees_menu():
     buttons = [
         "➕ Добавить сотрудника",
         "📋 Список сотрудников",
+        "📥 Импорт сотрудников",
         "🔙 Главное меню"
     ]
     keyboard.add(*buttons)
@@ -243,6 +1959,7 @@ def create_reports_menu():
         "📈 Общий отчет",
         "👤 Отчет по сотруднику", 
         "📅 Отчет за период",
+        "📤 Выгрузка",
         "🔙 Главное меню"
     ]
     keyboard.add(*buttons)
@@ -260,383 +1977,2454 @@ def create_cancel_menu():
     keyboard.add("❌ Отмена")
     return keyboard
 
-def create_employees_keyboard():
-    """Создает клавиатуру со списком сотрудников"""
-    logger.debug("🔧 СОЗДАНИЕ КЛАВИАТУРЫ СОТРУДНИКОВ...")
-    employees = execute_query(
-        'SELECT id, full_name FROM employees WHERE is_active = TRUE ORDER BY full_name', 
-        fetch=True
-    )
-    
-    logger.debug(f"🔧 РЕЗУЛЬТАТ ЗАПРОСА ДЛЯ КЛАВИАТУРЫ: {employees}")
-    
-    if not employees:
-        logger.warning("⚠️ Нет сотрудников для создания клавиатуры")
-        return None
+# Тексты кнопок меню: в режимах поиска они не считаются запросом, а переключают раздел
+MENU_BUTTONS = frozenset(
+    button['text']
+    for keyboard in (create_main_menu(), create_employees_menu(), create_reports_menu())
+    for row in keyboard.keyboard
+    for button in row
+)
+
+def normalize_name(text):
+    """Приводит ФИО к виду для поиска: регистр, ё → е, одиночные пробелы"""
+    return ' '.join(text.casefold().replace('ё', 'е').split())
+
+class EmployeeIndex:
+    """Индекс активных сотрудников по ФИО: поиск по началу любого слова и нечеткий поиск"""
+
+    FUZZY_CANDIDATES = 500
+
+    def __init__(self, employees):
+        self.names = dict(employees)
+        self._order = {emp_id: i for i, (emp_id, _) in enumerate(employees)}
+        # Ключ - ФИО начиная с каждого слова: «иванов петр», «петр»; поиск - bisect по префиксу
+        keys = []
+        for emp_id, full_name in employees:
+            words = normalize_name(full_name).split(' ')
+            for i in range(len(words)):
+                keys.append((' '.join(words[i:]), emp_id))
+        keys.sort()
+        self._keys = [key for key, _ in keys]
+        self._ids = [emp_id for _, emp_id in keys]
+
+    def __len__(self):
+        return len(self.names)
+
+    def _prefix_range(self, prefix):
+        start = bisect.bisect_left(self._keys, prefix)
+        end = bisect.bisect_left(self._keys, prefix + '\uffff', start)
+        return start, end
+
+    def _fuzzy(self, query, limit):
+        # Опечатки ищем среди ключей на ту же букву и не больше FUZZY_CANDIDATES соседей
+        # запроса в алфавитном порядке, чтобы время поиска не росло вместе со штатом
+        start, end = self._prefix_range(query[0])
+        pos = bisect.bisect_left(self._keys, query, start, end)
+        start = max(start, pos - self.FUZZY_CANDIDATES // 2)
+        end = min(end, start + self.FUZZY_CANDIDATES)
+        # Сравниваем с началом ключа той же длины (+1 на пропущенную букву)
+        candidates = [key[:len(query) + 1] for key in self._keys[start:end]]
+        matches = set(difflib.get_close_matches(query, candidates, n=limit, cutoff=0.75))
+        return [self._ids[start + i] for i, key in enumerate(candidates) if key in matches]
+
+    def search(self, query, limit=10):
+        """Возвращает (найдено всего, до limit пар (id, ФИО) в алфавитном порядке)"""
+        query = normalize_name(query)
+        if not query:
+            return 0, []
+        start, end = self._prefix_range(query)
+        ids = set(self._ids[start:end])
+        if not ids:
+            ids = set(self._fuzzy(query, limit))
+        found = heapq.nsmallest(limit, ids, key=self._order.get)
+        return len(ids), [(emp_id, self.names[emp_id]) for emp_id in found]
+
+ROSTER_CACHE_ORGS = int(os.environ.get('ROSTER_CACHE_ORGS', 1000))
+
+queries.register('roster_load', '''
+    SELECT id, full_name FROM employees
+    WHERE org_id = :org_id AND is_active = TRUE
+    ORDER BY full_name
+''', retry=True)
+
+class RosterCache:
+    """Кэш активных сотрудников и индекса для поиска по ФИО, отдельно для каждой организации.
+    
+    Изменение штата одной организации сбрасывает только ее запись; при превышении
+    max_orgs вытесняются организации, к которым дольше всего не обращались.
+    """
+
+    def __init__(self, max_orgs=1000):
+        self.max_orgs = max_orgs
+        self._lock = threading.Lock()
+        self._versions = {}  # org_id -> номер изменения штата
+        self._entries = OrderedDict()  # org_id -> (сотрудники, индекс), от давних к свежим
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self, org_id):
+        """Сбрасывает кэш организации после изменения ее сотрудников"""
+        with self._lock:
+            self._versions[org_id] = self._versions.get(org_id, 0) + 1
+            self._entries.pop(org_id, None)
+
+    def clear(self):
+        """Сбрасывает кэш всех организаций"""
+        with self._lock:
+            for org_id in self._versions:
+                self._versions[org_id] += 1
+            self._entries.clear()
+
+    def _load(self, org_id):
+        version = self._versions.get(org_id, 0)
+        employees = execute_prepared('roster_load', fetch=True, org_id=org_id)
+        if employees is None:
+            return None, None
+        
+        employees = [tuple(emp) for emp in employees]
+        index = EmployeeIndex(employees)
+        with self._lock:
+            # Если пока мы читали, штат изменили - результат не кэшируем
+            if version == self._versions.get(org_id, 0):
+                self._entries[org_id] = (employees, index)
+                while len(self._entries) > self.max_orgs:
+                    self._entries.popitem(last=False)
+        logger.info(f"✅ Кэш сотрудников организации {org_id} загружен: {len(employees)}")
+        return employees, index
+
+    def get(self, org_id):
+        """Возвращает (список (id, full_name), индекс по ФИО) организации"""
+        with self._lock:
+            entry = self._entries.get(org_id)
+            if entry is not None:
+                self._entries.move_to_end(org_id)
+                self.hits += 1
+                return entry
+            self.misses += 1
+        return self._load(org_id)
+
+    def employees(self, org_id):
+        return self.get(org_id)[0] or []
+
+    def warm(self, org_ids):
+        """Загружает организации, которых нет в кэше (не больше max_orgs); возвращает число загруженных"""
+        loaded = 0
+        for org_id in sorted(org_ids)[:self.max_orgs]:
+            with self._lock:
+                if org_id in self._entries:
+                    continue
+            if self._load(org_id)[0] is not None:
+                loaded += 1
+        return loaded
+
+    def index(self, org_id):
+        return self.get(org_id)[1] or EmployeeIndex([])
+
+    def stats(self):
+        with self._lock:
+            size = sum(len(employees) for employees, _ in self._entries.values())
+            return {'orgs': len(self._entries), 'size': size, 'hits': self.hits, 'misses': self.misses}
+
+roster_cache = RosterCache(max_orgs=ROSTER_CACHE_ORGS)
+
+def warm_roster_cache():
+    """Загружает сотрудников всех организаций с администраторами, которых еще нет в кэше"""
+    started = time.perf_counter()
+    loaded = roster_cache.warm(admin_cache.org_ids())
+    if loaded:
+        logger.info(f"✅ Кэш сотрудников прогрет: организаций {loaded} за {time.perf_counter() - started:.2f} с")
+
+class BackgroundTask:
+    """Запускает action в фоновом потоке по запросу; запрос во время выполнения
+    не запускает второй поток, а повторяет action после текущего прохода"""
+
+    def __init__(self, action, name):
+        self.action = action
+        self.name = name
+        self._lock = threading.Lock()
+        self._running = False
+        self._again = False
+
+    def request(self):
+        with self._lock:
+            if self._running:
+                self._again = True
+                return
+            self._running = True
+        threading.Thread(target=self._run, name=self.name, daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                self.action()
+            except Exception as e:
+                logger.error(f"❌ Ошибка фоновой задачи {self.name}: {e}")
+            with self._lock:
+                if not self._again:
+                    self._running = False
+                    return
+                self._again = False
+
+# Резервная реплика должна принять работу без холодного кэша: прогреваем его после полного
+# сброса (переподключение координации, потерянные уведомления) и при переходе в лидеры
+roster_warmup = BackgroundTask(warm_roster_cache, 'roster-warmup')
+
+def reset_roster_cache(org_id):
+    # None - уведомления могли потеряться: сбрасываем кэш всех организаций и прогреваем заново
+    if org_id:
+        roster_cache.invalidate(int(org_id))
+    else:
+        roster_cache.clear()
+        roster_warmup.request()
+
+coordinator.subscribe('roster', reset_roster_cache)
+coordinator.on_leader(roster_warmup.request)
+
+def invalidate_roster_cache(org_id):
+    """Сбрасывает кэш сотрудников организации после изменения таблицы employees (на всех репликах)"""
+    roster_cache.invalidate(org_id)
+    coordinator.publish('roster', org_id)
+
+PICKER_PAGE_SIZE = int(os.environ.get('PICKER_PAGE_SIZE', 10))
+
+def create_employee_picker(employees, prefix, page=0, total=None):
+    """Inline-выбор одного сотрудника: страница списка, в callback_data - id.
+    
+    total задается для результатов поиска - тогда страниц нет.
+    """
+    keyboard = types.InlineKeyboardMarkup(row_width=1)
+    if total is None:
+        pages = max(1, (len(employees) + PICKER_PAGE_SIZE - 1) // PICKER_PAGE_SIZE)
+        page = min(max(page, 0), pages - 1)
+        employees = employees[page * PICKER_PAGE_SIZE:(page + 1) * PICKER_PAGE_SIZE]
+    else:
+        pages = 1
+    
+    keyboard.add(*[
+        types.InlineKeyboardButton(f"👤 {full_name}", callback_data=f"{prefix}:e:{emp_id}")
+        for emp_id, full_name in employees
+    ])
+    if pages > 1:
+        keyboard.row(
+            types.InlineKeyboardButton("◀️", callback_data=f"{prefix}:p:{(page - 1) % pages}"),
+            types.InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=f"{prefix}:noop"),
+            types.InlineKeyboardButton("▶️", callback_data=f"{prefix}:p:{(page + 1) % pages}")
+        )
+    elif total is not None:
+        keyboard.row(types.InlineKeyboardButton("📋 Весь список", callback_data=f"{prefix}:p:0"))
+    keyboard.row(types.InlineKeyboardButton("❌ Отмена", callback_data=f"{prefix}:cancel"))
+    return keyboard
+
+def create_date_keyboard():
+    """Создает клавиатуру с датами"""
+    keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=3)
+    
+    today = date.today()
+    yesterday = today - timedelta(days=1)
+    day_before = today - timedelta(days=2)
+    
+    buttons = [
+        f"📅 {today.strftime('%d.%m.%Y')}",
+        f"📅 {yesterday.strftime('%d.%m.%Y')}",
+        f"📅 {day_before.strftime('%d.%m.%Y')}",
+        "📅 Другая дата"
+    ]
+    keyboard.add(*buttons)
+    keyboard.add("❌ Отмена")
+    
+    return keyboard
+
+MARK_PAGE_SIZE = int(os.environ.get('MARK_PAGE_SIZE', 20))
+
+def create_marking_keyboard(employees, selected, page=0, query=None):
+    """Создает inline-клавиатуру множественного выбора сотрудников для отметки"""
+    keyboard = types.InlineKeyboardMarkup(row_width=2)
+    pages = max(1, (len(employees) + MARK_PAGE_SIZE - 1) // MARK_PAGE_SIZE)
+    page = min(max(page, 0), pages - 1)
+    
+    buttons = []
+    for emp_id, full_name in employees[page * MARK_PAGE_SIZE:(page + 1) * MARK_PAGE_SIZE]:
+        mark = "✅" if emp_id in selected else "▫️"
+        buttons.append(types.InlineKeyboardButton(f"{mark} {full_name}", callback_data=f"att:t:{emp_id}:{page}"))
+    keyboard.add(*buttons)
+    
+    if pages > 1:
+        keyboard.row(
+            types.InlineKeyboardButton("◀️", callback_data=f"att:p:{(page - 1) % pages}"),
+            types.InlineKeyboardButton(f"{page + 1}/{pages}", callback_data="att:noop"),
+            types.InlineKeyboardButton("▶️", callback_data=f"att:p:{(page + 1) % pages}")
+        )
+    keyboard.row(
+        types.InlineKeyboardButton("☑️ Отметить всех", callback_data=f"att:all:{page}"),
+        types.InlineKeyboardButton("🔄 Снять все", callback_data=f"att:none:{page}")
+    )
+    if query:
+        keyboard.row(types.InlineKeyboardButton("📋 Весь список", callback_data="att:q:0"))
+    keyboard.row(
+        types.InlineKeyboardButton(f"💾 Подтвердить ({len(selected)})", callback_data="att:ok"),
+        types.InlineKeyboardButton("❌ Отмена", callback_data="att:cancel")
+    )
+    return keyboard
+
+def parse_date(text):
+    """Разбирает дату вида ДД.ММ.ГГГГ (можно с префиксом 📅)"""
+    try:
+        return datetime.strptime(text.replace("📅", "").strip(), '%d.%m.%Y').date()
+    except ValueError:
+        return None
+
+def create_period_keyboard():
+    """Создает клавиатуру выбора периода отчета"""
+    keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=3)
+    keyboard.add("📅 Эта неделя", "📅 Этот месяц", "📅 Прошлый месяц", "📅 Этот год")
+    keyboard.add("❌ Отмена")
+    return keyboard
+
+# Маршрутизация: команды, кнопки меню и префиксы callback_data ищутся по словарю за O(1),
+# шаги многошаговых диалогов - по шагу состояния. Общая для всех обновлений работа (ошибки,
+# замер времени, доступ, загрузка состояния) - промежуточные обработчики; их цепочка
+# собирается один раз при регистрации, а не на каждом обновлении
+STATE_ESCAPE = frozenset({"❌ Отмена"})
+
+class Route:
+    __slots__ = ('name', 'handler', 'public', 'escape')
+
+    def __init__(self, name, handler, public=False, escape=None):
+        self.name = name
+        self.handler = handler
+        self.public = public  # доступен не только администраторам
+        self.escape = escape  # escape(text) - текст выходит из диалога (для маршрутов состояний)
+
+class Request:
+    """Обновление на пути через маршрутизатор: kind - message, command, document или callback"""
+    __slots__ = ('kind', 'message', 'call', 'user_id', 'chat_id', 'text', 'org_id', 'state', 'route')
+
+    def __init__(self, kind, user_id, chat_id, text, message=None, call=None):
+        self.kind = kind
+        self.message = message
+        self.call = call
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.text = text
+        self.org_id = None
+        self.state = None
+        self.route = None
+
+    @property
+    def route_name(self):
+        return self.route.name if self.route is not None else 'unrouted'
+
+    def notify(self, text):
+        """Короткий ответ: всплывающее уведомление на callback или сообщение в чат"""
+        if self.call is not None:
+            bot.answer_callback_query(self.call.id, text)
+        else:
+            send_message(self.chat_id, text)
+
+class Router:
+    """Таблицы маршрутов сообщений и callback-запросов и цепочка промежуточных обработчиков"""
+
+    def __init__(self):
+        self._commands = {}
+        self._texts = {}
+        self._callbacks = {}
+        self._states = {}
+        self._document = None
+        self._fallback = None
+        self._middleware = []
+        self._pipeline = self._dispatch
+
+    def _add(self, table, key, route):
+        if key in table:
+            raise ValueError(f"Маршрут {key} уже зарегистрирован")
+        table[key] = route
+        return route.handler
+
+    def command(self, name, public=False):
+        return lambda handler: self._add(self._commands, name, Route(handler.__name__, handler, public))
+
+    def text(self, *labels):
+        def decorator(handler):
+            for label in labels:
+                self._add(self._texts, label, Route(handler.__name__, handler))
+            return handler
+        return decorator
+
+    def callback(self, prefix):
+        """Маршрут по префиксу callback_data до первого двоеточия"""
+        return lambda handler: self._add(self._callbacks, prefix, Route(handler.__name__, handler))
+
+    def state(self, step, escape=None):
+        """Маршрут шага диалога; «Отмена» и тексты, для которых escape(text) истинно,
+        завершают диалог и обрабатываются как обычное сообщение"""
+        return lambda handler: self._add(self._states, step, Route(f'state:{step}', handler, escape=escape))
+
+    def document(self, handler):
+        """Маршрут для присланных файлов"""
+        self._document = Route(handler.__name__, handler)
+        return handler
+
+    def fallback(self, handler):
+        self._fallback = Route(handler.__name__, handler)
+        return handler
+
+    def use(self, middleware):
+        """Добавляет промежуточный обработчик middleware(req, call_next); первый добавленный - внешний"""
+        self._middleware.append(middleware)
+        pipeline = self._dispatch
+        for outer in reversed(self._middleware):
+            pipeline = functools.partial(outer, call_next=pipeline)
+        self._pipeline = pipeline
+        return middleware
+
+    def handle_message(self, message):
+        if message.content_type == 'document':
+            req = Request('document', message.from_user.id, message.chat.id, message.caption or '', message=message)
+            req.route = self._document
+            self._pipeline(req)
+            return
+        
+        text = (message.text or '').strip()
+        req = Request('message', message.from_user.id, message.chat.id, text, message=message)
+        if text.startswith('/'):
+            # /команда@имя_бота аргументы
+            req.route = self._commands.get(text.split(maxsplit=1)[0][1:].split('@', 1)[0])
+            if req.route is not None:
+                req.kind = 'command'
+        if req.route is None:
+            req.route = self._texts.get(text)
+        self._pipeline(req)
+
+    def handle_callback(self, call):
+        chat_id = call.message.chat.id if call.message else call.from_user.id
+        req = Request('callback', call.from_user.id, chat_id, call.data or '', call=call)
+        req.route = self._callbacks.get(req.text.split(':', 1)[0])
+        self._pipeline(req)
+
+    def _dispatch(self, req):
+        # Команды работают в любом шаге диалога, остальной текст сначала получает шаг
+        if req.kind == 'message' and req.state is not None:
+            route = self._states.get(req.state)
+            if route is not None:
+                if req.text in STATE_ESCAPE or (route.escape is not None and route.escape(req.text)):
+                    clear_user_state(req.user_id)
+                    req.state = None
+                else:
+                    req.route = route
+        if req.route is None and req.kind == 'message':
+            req.route = self._fallback
+        
+        if req.route is not None:
+            req.route.handler(req)
+        elif req.call is not None:
+            bot.answer_callback_query(req.call.id)
+
+def error_middleware(req, call_next):
+    """Ошибка обработчика не роняет воркер: пишется в журнал, пользователь получает ответ"""
+    try:
+        call_next(req)
+    except Exception as e:
+        logger.exception(f"❌ Ошибка обработчика [{req.route_name}]: {e}")
+        try:
+            req.notify("❌ Произошла ошибка, попробуйте еще раз")
+        except Exception:
+            pass
+
+def timing_middleware(req, call_next):
+    """Время обработки и ошибки - в метрики по имени маршрута"""
+    started = time.perf_counter()
+    try:
+        call_next(req)
+    except Exception:
+        HANDLER_ERRORS.inc(handler=req.route_name)
+        raise
+    finally:
+        HANDLER_LATENCY.observe(time.perf_counter() - started, handler=req.route_name)
+
+def auth_middleware(req, call_next):
+    """Пускает только администраторов; их организация - в req.org_id"""
+    req.org_id = user_org(req.user_id)
+    if req.org_id is None and not (req.route is not None and req.route.public):
+        req.notify("❌ У вас нет доступа к этому боту")
+        return
+    call_next(req)
+
+def state_middleware(req, call_next):
+    """Шаг диалога пользователя - в req.state; с общим хранилищем (STATE_SHARED) диалог перечитывается из него"""
+    state_store.refresh(req.user_id)
+    req.state = get_user_state(req.user_id)
+    call_next(req)
+
+router = Router()
+router.use(error_middleware)
+router.use(timing_middleware)
+router.use(auth_middleware)
+router.use(state_middleware)
+bot.message_handler(content_types=['text', 'document'])(router.handle_message)
+bot.callback_query_handler(func=lambda call: True)(router.handle_callback)
+
+@router.command('start')
+def start(req):
+    show_main_menu(req.chat_id)
+
+@router.command('debug')
+def debug_db(req):
+    """Команда для отладки базы данных"""
+    org_id = req.org_id
+    logger.info("🔧 ЗАПУСК КОМАНДЫ DEBUG")
+    
+    # Проверяем сотрудников организации РАЗНЫМИ способами
+    employees1 = execute_query('SELECT * FROM employees WHERE org_id = %s', (org_id,), fetch=True)
+    employees2 = execute_query('SELECT id, full_name FROM employees WHERE org_id = %s', (org_id,), fetch=True)
+    employees3 = execute_query('SELECT COUNT(*) FROM employees WHERE org_id = %s', (org_id,), fetch=True)
+    
+    # Проверяем таблицы
+    tables = execute_query("""
+        SELECT table_name 
+        FROM information_schema.tables 
+        WHERE table_schema = 'public'
+    """, fetch=True)
+    
+    # Формируем отчет
+    report = f"🔧 ДЕТАЛЬНЫЙ ОТЧЕТ ОТЛАДКИ\n\n🏢 Организация: {org_id}\n"
+    
+    if employees1:
+        report += f"✅ Способ 1 - Все поля: {len(employees1)} сотрудников\n"
+        for emp in employees1:
+            report += f"   👤 ID:{emp[0]}, Имя:'{emp[1]}', Должность:'{emp[2]}', Активен:{emp[3]}\n"
+    else:
+        report += "❌ Способ 1 - Все поля: 0 сотрудников\n"
+    
+    if employees2:
+        report += f"✅ Способ 2 - Только имя: {len(employees2)} сотрудников\n"
+        for emp in employees2:
+            report += f"   👤 ID:{emp[0]}, Имя:'{emp[1]}'\n"
+    else:
+        report += "❌ Способ 2 - Только имя: 0 сотрудников\n"
+    
+    if employees3:
+        report += f"✅ Способ 3 - COUNT: {employees3[0][0]} сотрудников\n"
+    else:
+        report += "❌ Способ 3 - COUNT: ошибка\n"
+    
+    if tables:
+        table_names = [table[0] for table in tables]
+        report += f"✅ Таблицы в БД: {', '.join(table_names)}\n"
+    else:
+        report += "❌ Таблицы в БД: не найдены\n"
+    
+    # Проверяем конкретного сотрудника с ID=7
+    employee_7 = execute_query('SELECT * FROM employees WHERE id = 7 AND org_id = %s', (org_id,), fetch=True)
+    if employee_7:
+        report += f"✅ Сотрудник ID=7 найден: {employee_7}\n"
+    else:
+        report += "❌ Сотрудник ID=7 не найден\n"
+    
+    cache_stats = admin_cache.stats()
+    report += (f"✅ Кэш администраторов: {cache_stats['size']} записей, "
+               f"попаданий {cache_stats['hits']}, промахов {cache_stats['misses']}\n")
+    cache_stats = roster_cache.stats()
+    report += (f"✅ Кэш сотрудников: {cache_stats['orgs']} организаций, {cache_stats['size']} записей, "
+               f"попаданий {cache_stats['hits']}, промахов {cache_stats['misses']}\n")
+    
+    send_message(req.chat_id, report)
+    logger.info("✅ Детальный отчет отладки отправлен")
+
+@router.command('rebuild_rollups', public=True)
+def rebuild_rollups_command(req):
+    """Пересчитывает агрегаты посещаемости с нуля; доступно только владельцу бота (ADMIN_ID).
+    
+    Пересчет блокирует отметки и переписывает агрегаты всех организаций сразу.
+    """
+    if req.user_id != int(ADMIN_ID):
+        send_message(req.chat_id, "❌ У вас нет доступа к этой команде")
+        return
+    
+    send_message(req.chat_id, "🔄 Пересчет агрегатов посещаемости...")
+    if rebuild_rollups():
+        send_message(req.chat_id, "✅ Агрегаты посещаемости пересчитаны")
+    else:
+        send_message(req.chat_id, "❌ Ошибка при пересчете агрегатов")
+
+def parse_admin_command(text):
+    """Достает user_id из команды вида /add_admin 123456"""
+    parts = text.split()
+    if len(parts) != 2 or not parts[1].lstrip('-').isdigit():
+        return None
+    return int(parts[1])
+
+@router.command('add_admin')
+def add_admin_command(req):
+    new_admin_id = parse_admin_command(req.text)
+    if new_admin_id is None:
+        send_message(req.chat_id, "ℹ️ Использование: /add_admin <user_id>")
+        return
+    
+    if add_admin(new_admin_id, req.org_id):
+        send_message(req.chat_id, f"✅ Администратор {new_admin_id} добавлен")
+    else:
+        send_message(req.chat_id,
+            "❌ Не удалось добавить администратора (возможно, он уже администратор другой организации)"
+        )
+
+@router.command('remove_admin')
+def remove_admin_command(req):
+    admin_id = parse_admin_command(req.text)
+    if admin_id is None:
+        send_message(req.chat_id, "ℹ️ Использование: /remove_admin <user_id>")
+        return
+    if admin_id == req.user_id:
+        send_message(req.chat_id, "❌ Нельзя удалить самого себя")
+        return
+    
+    if remove_admin(admin_id, req.org_id):
+        send_message(req.chat_id, f"✅ Администратор {admin_id} удален")
+    else:
+        send_message(req.chat_id, "❌ Администратор не найден в вашей организации")
+
+@router.command('add_org', public=True)
+def add_org_command(req):
+    """Создает организацию; доступно только владельцу бота (ADMIN_ID)"""
+    if req.user_id != int(ADMIN_ID):
+        send_message(req.chat_id, "❌ У вас нет доступа к этой команде")
+        return
+    
+    parts = req.text.split(maxsplit=2)
+    if len(parts) != 3 or not parts[1].isdigit():
+        send_message(req.chat_id, "ℹ️ Использование: /add_org <user_id администратора> <название>")
+        return
+    
+    org_id = create_organization(parts[2].strip(), int(parts[1]))
+    if org_id:
+        send_message(req.chat_id, f"✅ Организация «{parts[2].strip()}» создана (ID {org_id})")
+    else:
+        send_message(req.chat_id,
+            "❌ Не удалось создать организацию (возможно, пользователь уже администратор другой)"
+        )
+
+@timed_handler('show_main_menu')
+def show_main_menu(chat_id):
+    menu_text = "🏠 ГЛАВНОЕ МЕНЮ\n\nВыберите действие:"
+    send_message(chat_id, menu_text, reply_markup=create_main_menu(), coalesce='menu')
+
+@timed_handler('show_employees_menu')
+def show_employees_menu(chat_id):
+    menu_text = "👥 УПРАВЛЕНИЕ СОТРУДНИКАМИ\n\nВыберите действие:"
+    send_message(chat_id, menu_text, reply_markup=create_employees_menu(), coalesce='menu')
+
+@timed_handler('show_reports_menu')
+def show_reports_menu(chat_id):
+    menu_text = "📊 ОТЧЕТЫ\n\nВыберите тип отчета:"
+    send_message(chat_id, menu_text, reply_markup=create_reports_menu(), coalesce='menu')
+
+@router.text("👥 Сотрудники")
+def employees_menu(req):
+    show_employees_menu(req.chat_id)
+
+@router.text("📊 Отчеты")
+def reports_menu(req):
+    show_reports_menu(req.chat_id)
+
+@router.text("🔙 Главное меню", "🔙 Назад")
+def main_menu(req):
+    show_main_menu(req.chat_id)
+
+@router.text("❌ Отмена")
+def cancel(req):
+    clear_user_state(req.user_id)
+    show_main_menu(req.chat_id)
+
+@router.fallback
+def unknown_text(req):
+    show_main_menu(req.chat_id)
+
+queries.register('employee_insert', '''
+    INSERT INTO employees (org_id, full_name, position)
+    VALUES (:org_id, :full_name, :position)
+    RETURNING id
+''')
+
+# Шаги диалогов: сообщение пользователя в середине диалога попадает в обработчик его шага
+
+@router.state('waiting_employee_name')
+def enter_employee_name(req):
+    employee_name = req.text
+    set_user_state(req.user_id, 'waiting_employee_position')
+    set_user_data(req.user_id, 'name', employee_name)
+    send_message(req.chat_id, 
+        f"Отлично! Сотрудник: {employee_name}\n\n"
+        f"Теперь введите должность (или отправьте '-' если не нужно):",
+        reply_markup=create_cancel_menu()
+    )
+
+@router.state('waiting_employee_position')
+def enter_employee_position(req):
+    user_id = req.user_id
+    chat_id = req.chat_id
+    org_id = req.org_id
+    position = req.text if req.text != '-' else None
+    employee_name = get_user_data(user_id, 'name')
+    
+    logger.info(f"🎯 ДОБАВЛЕНИЕ СОТРУДНИКА: {employee_name}")
+    
+    result = execute_prepared('employee_insert', fetch=True,
+        org_id=org_id, full_name=employee_name, position=position
+    )
+    
+    logger.info(f"🎯 РЕЗУЛЬТАТ ДОБАВЛЕНИЯ: {result}")
+    
+    if result:
+        invalidate_roster_cache(org_id)
+        employee_id = result[0][0]
+        position_text = f"💼 {position}" if position else "💼 Должность не указана"
+        send_message(chat_id, 
+            f"✅ СОТРУДНИК ДОБАВЛЕН!\n\n"
+            f"👤 Имя: {employee_name}\n"
+            f"{position_text}\n"
+            f"🆔 ID в БД: {employee_id}")
+    else:
+        send_message(chat_id, "❌ Ошибка при добавлении сотрудника")
+    
+    # Очищаем временные данные
+    clear_user_state(user_id)
+    
+    show_employees_menu(chat_id)
+
+@router.state('waiting_mark_date')
+def enter_mark_date(req):
+    chat_id = req.chat_id
+    if req.text == "📅 Другая дата":
+        send_message(chat_id, "Введите дату в формате ДД.ММ.ГГГГ:", reply_markup=create_cancel_menu())
+        return
+    
+    check_date = parse_date(req.text)
+    if not check_date:
+        send_message(chat_id, "❌ Неверный формат даты. Введите дату в формате ДД.ММ.ГГГГ:")
+        return
+    if check_date > date.today():
+        send_message(chat_id, "❌ Нельзя отметить присутствие за будущую дату")
+        return
+    
+    send_message(chat_id, f"📅 Дата: {check_date.strftime('%d.%m.%Y')}", reply_markup=create_main_menu())
+    start_marking(req.user_id, req.org_id, chat_id, check_date)
+
+@router.state('waiting_report_period')
+def enter_report_period(req):
+    period = parse_period(req.text)
+    if not period:
+        send_message(req.chat_id, "❌ Неверный период. Введите его в формате ДД.ММ.ГГГГ - ДД.ММ.ГГГГ:")
+        return
+    
+    clear_user_state(req.user_id)
+    period_report(req.chat_id, req.org_id, *period)
+
+@router.state('waiting_export_period')
+def enter_export_period(req):
+    period = parse_period(req.text)
+    if not period:
+        send_message(req.chat_id, "❌ Неверный период. Введите его в формате ДД.ММ.ГГГГ - ДД.ММ.ГГГГ:")
+        return
+    
+    set_user_state(req.user_id, 'waiting_export_format')
+    set_user_data(req.user_id, 'period', [period[0].isoformat(), period[1].isoformat()])
+    send_message(req.chat_id, "Выберите формат файла:", reply_markup=create_export_format_keyboard())
+
+@router.state('waiting_export_format')
+def enter_export_format(req):
+    text = req.text
+    if text not in EXPORT_FORMATS or (EXPORT_FORMATS[text][0] == 'xlsx' and not openpyxl):
+        send_message(req.chat_id, "❌ Выберите формат на клавиатуре:")
+        return
+    
+    start_date, end_date = (date.fromisoformat(d) for d in get_user_data(req.user_id, 'period'))
+    clear_user_state(req.user_id)
+    export_attendance(req.chat_id, req.org_id, start_date, end_date, text)
+
+# Отметка идет inline-кнопками; кнопка меню или команда завершает ее, остальной текст - поиск
+@router.state('marking', escape=lambda text: text in MENU_BUTTONS or text.startswith('/'))
+def search_marking(req):
+    user_id = req.user_id
+    set_user_data(user_id, 'query', req.text)
+    employees = marking_employees(user_id, req.org_id)
+    if not employees:
+        send_message(req.chat_id, "❌ Никого не найдено. Попробуйте другой запрос")
+        return
+    check_date = date.fromisoformat(get_user_data(user_id, 'date'))
+    selected = set(get_user_data(user_id, 'selected', []))
+    send_message(req.chat_id, marking_text(check_date, len(selected), req.text),
+        reply_markup=create_marking_keyboard(employees, selected, query=req.text)
+    )
+
+@router.text("➕ Добавить сотрудника")
+def add_employee_start(req):
+    set_user_state(req.user_id, 'waiting_employee_name')
+    send_message(req.chat_id,
+        "👤 ДОБАВЛЕНИЕ СОТРУДНИКА\n\n"
+        "Введите ФИО сотрудника:",
+        reply_markup=create_cancel_menu()
+    )
+
+EMPLOYEE_PAGE_SIZE = int(os.environ.get('EMPLOYEE_PAGE_SIZE', 20))
+MESSAGE_LIMIT = 4096
+
+# Список сотрудников листается по ключу (NOT is_active, full_name, id): активные первыми,
+# страница - один запрос по индексу employees_list_idx, без OFFSET
+queries.register('employees_page_first', '''
+    SELECT id, full_name, position, is_active FROM employees
+    WHERE org_id = :org_id
+    ORDER BY NOT is_active, full_name, id
+    LIMIT :limit
+''', retry=True)
+queries.register('employees_page_next', '''
+    SELECT id, full_name, position, is_active FROM employees
+    WHERE org_id = :org_id
+      AND (NOT is_active, full_name, id) >
+          (SELECT NOT is_active, full_name, id FROM employees WHERE id = :anchor_id AND org_id = :org_id)
+    ORDER BY NOT is_active, full_name, id
+    LIMIT :limit
+''', retry=True)
+queries.register('employees_page_prev', '''
+    SELECT id, full_name, position, is_active FROM employees
+    WHERE org_id = :org_id
+      AND (NOT is_active, full_name, id) <
+          (SELECT NOT is_active, full_name, id FROM employees WHERE id = :anchor_id AND org_id = :org_id)
+    ORDER BY NOT is_active DESC, full_name DESC, id DESC
+    LIMIT :limit
+''', retry=True)
+
+def fetch_employees_page(org_id, direction='first', anchor_id=None):
+    """Страница списка сотрудников: (строки, есть предыдущая, есть следующая) или None"""
+    # Берем на одну строку больше, чтобы узнать, есть ли страница дальше
+    params = {'org_id': org_id, 'limit': EMPLOYEE_PAGE_SIZE + 1}
+    if direction != 'first':
+        params['anchor_id'] = anchor_id
+    rows = execute_prepared(f'employees_page_{direction}', fetch=True, **params)
+    if rows is None:
+        return None
+    
+    more = len(rows) > EMPLOYEE_PAGE_SIZE
+    rows = rows[:EMPLOYEE_PAGE_SIZE]
+    if direction == 'prev':
+        return rows[::-1], more, True
+    return rows, direction == 'next', more
+
+def format_employee_entry(emp):
+    emp_id, full_name, position, is_active = emp
+    status = "✅" if is_active else "❌"
+    # Обрезаем очень длинные значения, чтобы страница всегда помещалась в сообщение
+    position_text = f"💼 {position[:200]}" if position else "💼 Должность не указана"
+    return f"{status} {full_name[:200]}\n{position_text}\n🆔 ID: {emp_id}\n\n"
+
+def render_employees_page(rows, has_prev, has_next):
+    """Текст и клавиатура страницы; строки, не влезшие в лимит сообщения, уходят на следующую"""
+    text = "👥 СПИСОК СОТРУДНИКОВ\n\n"
+    shown = 0
+    for emp in rows:
+        entry = format_employee_entry(emp)
+        if len(text) + len(entry) > MESSAGE_LIMIT:
+            has_next = True
+            break
+        text += entry
+        shown += 1
+    
+    keyboard = None
+    buttons = []
+    if has_prev:
+        buttons.append(types.InlineKeyboardButton("◀️ Назад", callback_data=f"emp:prev:{rows[0][0]}"))
+    if has_next:
+        buttons.append(types.InlineKeyboardButton("Вперед ▶️", callback_data=f"emp:next:{rows[shown - 1][0]}"))
+    if buttons:
+        keyboard = types.InlineKeyboardMarkup()
+        keyboard.row(*buttons)
+    return text, keyboard
+
+@router.text("📋 Список сотрудников")
+def view_employees(req):
+    page = fetch_employees_page(req.org_id)
+    if page is None:
+        send_message(req.chat_id, "❌ Ошибка при загрузке списка")
+        return
+    if not page[0]:
+        send_message(req.chat_id, "❌ Сотрудники не найдены")
+        return
+    
+    text, keyboard = render_employees_page(*page)
+    send_message(req.chat_id, text, reply_markup=keyboard)
+
+@router.callback('emp')
+def handle_employees_page_callback(req):
+    call = req.call
+    chat_id = req.chat_id
+    message_id = call.message.message_id
+    org_id = req.org_id
+    
+    _, direction, anchor_id = call.data.split(':')
+    page = fetch_employees_page(org_id, direction, int(anchor_id))
+    if page is None:
+        bot.answer_callback_query(call.id, "❌ Ошибка при загрузке списка")
+        return
+    if not page[0]:
+        # Сотрудник-якорь пропал или страница опустела - начинаем сначала
+        page = fetch_employees_page(org_id)
+    
+    bot.answer_callback_query(call.id)
+    text, keyboard = render_employees_page(*page)
+    edit_message_text(text, chat_id, message_id, reply_markup=keyboard)
+
+# Массовый импорт сотрудников из CSV/XLSX: файл читается построчно, строки проверяются
+# и очищаются от повторов на лету и тем же потоком уходят через COPY во временную
+# таблицу; затем один запрос сливает ее с employees организации
+IMPORT_MAX_ROWS = int(os.environ.get('IMPORT_MAX_ROWS', 10000))
+IMPORT_MAX_BYTES = int(os.environ.get('IMPORT_MAX_BYTES', 20 * 2 ** 20))  # Bot API отдает файлы до 20 МБ
+IMPORT_FIELD_MAX_LENGTH = 200
+IMPORT_COPY_CHUNK = 64 * 1024
+IMPORT_HEADERS = frozenset({'фио', 'имя', 'сотрудник', 'full_name', 'name'})
+
+def file_encoding(path):
+    """utf-8-sig, если файл целиком читается как UTF-8, иначе cp1251 (CSV из русского Excel)"""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    with open(path, 'rb') as f:
+        try:
+            for chunk in iter(lambda: f.read(65536), b''):
+                decoder.decode(chunk)
+            decoder.decode(b'', final=True)
+        except UnicodeDecodeError:
+            return 'cp1251'
+    return 'utf-8-sig'
+
+def read_csv_rows(path):
+    """Строки CSV-файла; разделитель (, ; или табуляция) определяется по началу файла"""
+    with open(path, encoding=file_encoding(path), newline='') as f:
+        sample = f.read(4096)
+        f.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+        except csv.Error:
+            dialect = csv.excel
+        yield from csv.reader(f, dialect)
+
+def read_xlsx_rows(path):
+    """Строки первого листа Excel-файла в режиме потокового чтения"""
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        for row in workbook.worksheets[0].iter_rows(values_only=True):
+            yield ['' if value is None else str(value) for value in row]
+    finally:
+        workbook.close()
+
+IMPORT_FORMATS = {'.csv': read_csv_rows, '.xlsx': read_xlsx_rows}
+
+class ImportResult:
+    __slots__ = ('rows', 'inserted', 'updated', 'unchanged', 'rejected', 'error')
+
+    def __init__(self):
+        self.rows = 0
+        self.inserted = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.rejected = []  # (номер строки, причина)
+        self.error = None
+
+def import_copy_data(rows, existing, result):
+    """Данные для COPY (CSV: id найденного сотрудника, ФИО, должность) из строк файла.
+    
+    Ошибку чтения файла не пробрасывает - она попала бы в середину COPY -
+    а записывает в result.error и завершает поток.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    seen = set()
+    try:
+        for line_no, row in enumerate(rows, 1):
+            cells = [' '.join(str(cell).split()) for cell in row[:2]]
+            if not any(cells):
+                continue
+            name = cells[0]
+            position = cells[1] if len(cells) > 1 and cells[1] not in ('', '-') else None
+            key = normalize_name(name)
+            if line_no == 1 and key in IMPORT_HEADERS:
+                continue
+            
+            result.rows += 1
+            if result.rows > IMPORT_MAX_ROWS:
+                result.error = f"в файле больше {IMPORT_MAX_ROWS} строк"
+                return
+            if not any(ch.isalpha() for ch in name):
+                result.rejected.append((line_no, "нет ФИО"))
+                continue
+            if len(name) > IMPORT_FIELD_MAX_LENGTH or len(position or '') > IMPORT_FIELD_MAX_LENGTH:
+                result.rejected.append((line_no, "слишком длинное значение"))
+                continue
+            if key in seen:
+                result.rejected.append((line_no, "повтор в файле"))
+                continue
+            seen.add(key)
+            
+            writer.writerow((existing.get(key, ''), name, position))
+            if buffer.tell() >= IMPORT_COPY_CHUNK:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+    except Exception as e:
+        result.error = f"не удалось прочитать файл: {e}"
+        return
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def import_employees(org_id, rows):
+    """Загружает сотрудников организации из строк файла (ФИО, должность).
+    
+    Новые ФИО добавляются, у известных обновляется должность и они снова становятся
+    активными. Возвращает ImportResult или None, если база недоступна.
+    """
+    result = ImportResult()
+    try:
+        with db_pool.connection() as conn:
+            if not conn:
+                logger.error("❌ Нет соединения с БД")
+                return None
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute('BEGIN')
+                    # Сотрудники сопоставляются по тому же ключу ФИО, что и в поиске;
+                    # при совпадении нескольких берется активный с меньшим id
+                    cursor.execute(
+                        'SELECT id, full_name FROM employees WHERE org_id = %s ORDER BY is_active, id DESC',
+                        (org_id,)
+                    )
+                    existing = {normalize_name(full_name): employee_id for employee_id, full_name in cursor.fetchall()}
+                    cursor.execute(
+                        'CREATE TEMP TABLE employee_import (employee_id INT, full_name TEXT NOT NULL, position TEXT) '
+                        'ON COMMIT DROP'
+                    )
+                    cursor.execute(
+                        'COPY employee_import FROM STDIN WITH (FORMAT csv)',
+                        stream=import_copy_data(rows, existing, result)
+                    )
+                    if result.error:
+                        conn.rollback()
+                        return result
+                    
+                    cursor.execute(
+                        '''
+                        WITH updated AS (
+                            UPDATE employees e
+                            SET position = COALESCE(s.position, e.position), is_active = TRUE
+                            FROM employee_import s
+                            WHERE e.id = s.employee_id
+                              AND e.org_id = %s
+                              AND (NOT e.is_active OR COALESCE(s.position, e.position) IS DISTINCT FROM e.position)
+                            RETURNING e.id
+                        ),
+                        inserted AS (
+                            INSERT INTO employees (org_id, full_name, position)
+                            SELECT %s, full_name, position FROM employee_import
+                            WHERE employee_id IS NULL
+                            RETURNING id
+                        )
+                        SELECT (SELECT COUNT(*) FROM inserted),
+                               (SELECT COUNT(*) FROM updated),
+                               (SELECT COUNT(*) FROM employee_import WHERE employee_id IS NOT NULL)
+                        ''',
+                        (org_id, org_id)
+                    )
+                    result.inserted, result.updated, matched = cursor.fetchone()
+                    result.unchanged = matched - result.updated
+                conn.commit()
+            except pg8000.InterfaceError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Ошибка импорта сотрудников: {e}")
+                conn.rollback()
+                return None
+    except pg8000.InterfaceError as e:
+        logger.error(f"❌ Соединение с БД разорвано при импорте сотрудников: {e}")
+        return None
+    
+    if result.inserted or result.updated:
+        invalidate_roster_cache(org_id)
+    return result
+
+@router.text("📥 Импорт сотрудников")
+def import_employees_start(req):
+    send_message(req.chat_id,
+        "📥 ИМПОРТ СОТРУДНИКОВ\n\n"
+        "Отправьте файл CSV или Excel (.xlsx): в первом столбце ФИО, во втором - должность "
+        "(необязательно). Строка заголовка допускается.\n\n"
+        "Новые сотрудники добавляются, у сотрудников с тем же ФИО обновляется должность."
+    )
+
+def format_import_result(result, seconds):
+    text = (
+        f"✅ ИМПОРТ ЗАВЕРШЕН за {seconds:.1f} с\n\n"
+        f"📄 Строк в файле: {result.rows}\n"
+        f"➕ Добавлено: {result.inserted}\n"
+        f"🔄 Обновлено: {result.updated}\n"
+        f"▫️ Без изменений: {result.unchanged}\n"
+        f"❌ Отклонено: {len(result.rejected)}\n"
+    )
+    for line_no, reason in result.rejected[:20]:
+        text += f"• строка {line_no}: {reason}\n"
+    if len(result.rejected) > 20:
+        text += f"• ... и еще {len(result.rejected) - 20}\n"
+    return text
+
+@router.document
+def import_employees_document(req):
+    document = req.message.document
+    ext = os.path.splitext(document.file_name or '')[1].lower()
+    if ext not in IMPORT_FORMATS or (ext == '.xlsx' and not openpyxl):
+        formats = "CSV или .xlsx" if openpyxl else "CSV"
+        send_message(req.chat_id, f"❌ Для импорта сотрудников отправьте файл {formats}")
+        return
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        send_message(req.chat_id, f"❌ Файл больше {IMPORT_MAX_BYTES // 2 ** 20} МБ")
+        return
+    
+    send_message(req.chat_id, "⏳ Импортирую сотрудников...")
+    fd, path = tempfile.mkstemp(suffix=ext)
+    os.close(fd)
+    try:
+        with open(path, 'wb') as f:
+            f.write(bot.download_file(bot.get_file(document.file_id).file_path))
+        started = time.monotonic()
+        result = import_employees(req.org_id, IMPORT_FORMATS[ext](path))
+        elapsed = time.monotonic() - started
+    finally:
+        os.remove(path)
+    
+    if result is None:
+        send_message(req.chat_id, "❌ Ошибка при импорте сотрудников", reply_markup=create_employees_menu())
+        return
+    if result.error:
+        send_message(req.chat_id, f"❌ Импорт отменен: {result.error}", reply_markup=create_employees_menu())
+        return
+    
+    logger.info(f"✅ Импорт сотрудников (организация {req.org_id}): добавлено {result.inserted}, "
+                f"обновлено {result.updated}, отклонено {len(result.rejected)} за {elapsed:.1f} с")
+    send_long_message(req.chat_id, format_import_result(result, elapsed), reply_markup=create_employees_menu())
+
+def marking_text(check_date, selected_count, query=None):
+    search_text = f"🔎 Поиск: {query}\n" if query else ""
+    return (
+        f"✅ ОТМЕТКА ПРИСУТСТВИЯ\n\n"
+        f"Дата: {check_date.strftime('%d.%m.%Y')}\n"
+        f"Выбрано: {selected_count}\n"
+        f"{search_text}\n"
+        f"Отметьте присутствующих и нажмите «Подтвердить».\n"
+        f"Чтобы найти сотрудника, введите часть ФИО"
+    )
+
+def marking_employees(user_id, org_id):
+    """Сотрудники для клавиатуры отметки: весь ростер или результаты поиска"""
+    query = get_user_data(user_id, 'query')
+    if not query:
+        return roster_cache.employees(org_id)
+    return roster_cache.index(org_id).search(query, MARK_PAGE_SIZE)[1]
+
+def start_marking(user_id, org_id, chat_id, check_date):
+    """Открывает множественный выбор сотрудников для отметки за дату"""
+    employees = roster_cache.employees(org_id)
+    if not employees:
+        clear_user_state(user_id)
+        send_message(chat_id, "❌ Нет сотрудников для отметки", reply_markup=create_main_menu())
+        return
+    
+    set_user_state(user_id, 'marking')
+    set_user_data(user_id, 'date', check_date.isoformat())
+    set_user_data(user_id, 'selected', [])
+    set_user_data(user_id, 'query', None)
+    send_message(chat_id, marking_text(check_date, 0),
+        reply_markup=create_marking_keyboard(employees, set())
+    )
+
+@router.text("✅ Отметить сегодня")
+def mark_attendance_today(req):
+    start_marking(req.user_id, req.org_id, req.chat_id, date.today())
+
+@router.text("📅 Отметить за дату")
+def mark_attendance_date(req):
+    set_user_state(req.user_id, 'waiting_mark_date')
+    send_message(req.chat_id,
+        "📅 ОТМЕТКА ПРИСУТСТВИЯ (ЗА ДАТУ)\n\nВыберите дату:",
+        reply_markup=create_date_keyboard()
+    )
+
+# Журнал отметок: отметка сначала записывается в локальный SQLite (WAL, fsync при коммите),
+# и администратор сразу получает ответ. Фоновый поток переносит журнал в PostgreSQL пачками;
+# вставка идемпотентна, поэтому повтор после сбоя не создает дублей. Пока база недоступна,
+# отметки копятся в журнале, а не теряются
+MARK_JOURNAL = os.environ.get('MARK_JOURNAL', '1') != '0'
+MARK_JOURNAL_PATH = os.environ.get('MARK_JOURNAL_PATH', os.path.join(os.getcwd(), 'data', 'marks.db'))
+MARK_JOURNAL_FLUSH_INTERVAL = float(os.environ.get('MARK_JOURNAL_FLUSH_INTERVAL', 1))
+MARK_JOURNAL_BATCH_SIZE = int(os.environ.get('MARK_JOURNAL_BATCH_SIZE', 1000))
+# Попыток записать пачку, которую отвергает работающая база, прежде чем разобрать ее по одной отметке
+MARK_JOURNAL_MAX_ATTEMPTS = int(os.environ.get('MARK_JOURNAL_MAX_ATTEMPTS', 5))
+MARK_JOURNAL_REJECTED = Counter('bot_mark_journal_rejected_total',
+                                'Отметки журнала, не перенесенные в БД: сотрудник неактивен или из другой организации')
+MARK_JOURNAL_DEAD = Counter('bot_mark_journal_dead_letters_total',
+                            'Отметки журнала, которые база не принимает: перенесены в dead_marks')
+
+# Вставляет пачку журнала и возвращает отклоненные отметки - их сотрудник не активен в организации отметки
+queries.register('attendance_journal_flush', '''
+    WITH marks AS (
+        SELECT * FROM unnest(:org_ids::int[], :employee_ids::int[], :check_dates::date[], :marked_at::float8[])
+            AS m(org_id, employee_id, check_date, marked_at)
+    ),
+    inserted AS (
+        INSERT INTO attendance (org_id, employee_id, check_date, marked_date)
+        SELECT e.org_id, e.id, m.check_date, to_timestamp(m.marked_at)::timestamp
+        FROM marks m
+        JOIN employees e ON e.id = m.employee_id AND e.org_id = m.org_id AND e.is_active = TRUE
+        ON CONFLICT (employee_id, check_date) DO NOTHING
+    )
+    SELECT m.org_id, m.employee_id, m.check_date
+    FROM marks m
+    WHERE NOT EXISTS (
+        SELECT 1 FROM employees e WHERE e.id = m.employee_id AND e.org_id = m.org_id AND e.is_active = TRUE
+    )
+''', retry=True)
+
+class MarkJournal:
+    """Локальный журнал отметок с отложенной записью в таблицу attendance"""
+
+    def __init__(self, path, flush_interval=1, batch_size=1000, max_attempts=5):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._flusher = None
+        self._failed_seq = None  # первая запись пачки, которую отвергает база, и число попыток
+        self._attempts = 0
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            # FULL: коммит возвращается только после fsync журнала WAL
+            self._conn.execute('PRAGMA synchronous=FULL')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS marks (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    org_id INTEGER NOT NULL,
+                    employee_id INTEGER NOT NULL,
+                    check_date TEXT NOT NULL,
+                    marked_at REAL NOT NULL
+                )
+            ''')
+            # Отметки, которые работающая база отвергает: разбираются вручную, перенос за ними не стоит
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS dead_marks (
+                    seq INTEGER PRIMARY KEY,
+                    org_id INTEGER NOT NULL,
+                    employee_id INTEGER NOT NULL,
+                    check_date TEXT NOT NULL,
+                    marked_at REAL NOT NULL,
+                    failed_at REAL NOT NULL
+                )
+            ''')
+
+    def append(self, org_id, employee_ids, check_date):
+        """Записывает отметки в журнал одной транзакцией; возвращает их число"""
+        marked_at = time.time()
+        records = [(org_id, emp_id, check_date.isoformat(), marked_at) for emp_id in employee_ids]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT INTO marks (org_id, employee_id, check_date, marked_at) VALUES (?, ?, ?, ?)',
+                records
+            )
+        # Не ждем интервала: при живой базе отметка попадет в отчеты за миллисекунды
+        self._wakeup.set()
+        return len(records)
+
+    def pending(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM marks').fetchone()[0]
+
+    def dead(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM dead_marks').fetchone()[0]
+
+    def _write(self, rows):
+        """Вставляет записи журнала; возвращает отклоненные отметки или None при ошибке"""
+        # Сотрудник должен быть активен и принадлежать той же организации, что и отметка
+        rejected = execute_prepared('attendance_journal_flush', fetch=True,
+            org_ids=[row[1] for row in rows],
+            employee_ids=[row[2] for row in rows],
+            check_dates=[row[3] for row in rows],
+            marked_at=[row[4] for row in rows],
+        )
+        if rejected:
+            # Сотрудника успели уволить или перевести после отметки - запись отбрасывается, но не молча
+            MARK_JOURNAL_REJECTED.inc(len(rejected))
+            logger.warning(f"⚠️ Журнал отметок: отклонено {len(rejected)} (организация/сотрудник/дата): "
+                           + ', '.join(f"{org_id}/{emp_id}/{day}" for org_id, emp_id, day in rejected[:20]))
+        return rejected
+
+    def _poisoned(self, rows):
+        """Пачка не записалась: True - ее отвергает работающая база уже max_attempts раз подряд"""
+        if execute_prepared('ready', fetch=True) is None:
+            return False  # База недоступна - пачка ни при чем, ждем базу
+        if self._failed_seq == rows[0][0]:
+            self._attempts += 1
+        else:
+            self._failed_seq, self._attempts = rows[0][0], 1
+        if self._attempts < self.max_attempts:
+            logger.warning(f"⚠️ Журнал отметок: пачка с записи {rows[0][0]} не записана, "
+                           f"попытка {self._attempts} из {self.max_attempts}")
+            return False
+        return True
+
+    def _salvage(self, rows):
+        """Пишет пачку по одной записи; отвергнутые базой - в dead_marks. False - база пропала"""
+        for row in rows:
+            written = self._write([row]) is not None
+            if not written and execute_prepared('ready', fetch=True) is None:
+                return False
+            with self._lock, self._conn:
+                if not written:
+                    self._conn.execute('INSERT OR REPLACE INTO dead_marks VALUES (?, ?, ?, ?, ?, ?)',
+                                       (*row, time.time()))
+                self._conn.execute('DELETE FROM marks WHERE seq = ?', (row[0],))
+            if not written:
+                MARK_JOURNAL_DEAD.inc()
+                logger.error(f"❌ Журнал отметок: запись {row[0]} (организация {row[1]}, сотрудник {row[2]}, "
+                             f"дата {row[3]}) не принимается базой - перенесена в dead_marks")
+        return True
+
+    def flush(self):
+        """Переносит журнал в PostgreSQL; False - база недоступна, записи остались в журнале.
+        
+        Пачку, которую работающая база отвергает max_attempts раз подряд, переносит по одной записи:
+        так остальные отметки не застревают за ней, а отвергнутые уходят в dead_marks.
+        """
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    rows = self._conn.execute(
+                        'SELECT seq, org_id, employee_id, check_date, marked_at FROM marks ORDER BY seq LIMIT ?',
+                        (self.batch_size,)
+                    ).fetchall()
+                if not rows:
+                    return True
+                
+                if self._write(rows) is None:
+                    if not self._poisoned(rows) or not self._salvage(rows):
+                        return False
+                    self._failed_seq, self._attempts = None, 0
+                else:
+                    # Если процесс упадет до удаления, следующий перенос повторит вставку без дублей
+                    with self._lock, self._conn:
+                        self._conn.execute('DELETE FROM marks WHERE seq <= ?', (rows[-1][0],))
+                if len(rows) < self.batch_size:
+                    return True
+
+    def _flush_loop(self):
+        failures = 0
+        while True:
+            # После ошибки ждем дольше, чтобы не долбить недоступную базу
+            self._wakeup.wait(min(60, self.flush_interval * 2 ** failures))
+            self._wakeup.clear()
+            try:
+                ok = self.flush()
+            except Exception as e:
+                logger.error(f"❌ Ошибка переноса журнала отметок: {e}")
+                ok = False
+            if ok:
+                failures = 0
+            else:
+                failures = min(failures + 1, 6)
+                logger.warning(f"⚠️ Отметки ждут записи в БД: {self.pending()}")
+
+    def start(self):
+        """Запускает фоновый перенос (в том числе отметок, оставшихся с прошлого запуска)"""
+        if self._flusher is not None:
+            return
+        self._flusher = threading.Thread(target=self._flush_loop, name='mark-journal', daemon=True)
+        self._flusher.start()
+        atexit.register(self.flush)
+
+mark_journal = MarkJournal(
+    MARK_JOURNAL_PATH,
+    flush_interval=MARK_JOURNAL_FLUSH_INTERVAL,
+    batch_size=MARK_JOURNAL_BATCH_SIZE,
+    max_attempts=MARK_JOURNAL_MAX_ATTEMPTS
+) if MARK_JOURNAL else None
+
+queries.register('attendance_mark_batch', '''
+    INSERT INTO attendance (org_id, employee_id, check_date)
+    SELECT org_id, id, :check_date FROM employees WHERE org_id = :org_id AND id = ANY(:employee_ids) AND is_active = TRUE
+    ON CONFLICT (employee_id, check_date) DO NOTHING
+    RETURNING employee_id
+''', retry=True)
+
+def save_attendance(org_id, employee_ids, check_date):
+    """Сохраняет отметки: в журнал или, если он выключен, сразу в БД.
     
-    keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
+    Возвращает (сохранено, новых отметок) - число новых известно только без журнала - или None.
+    """
+    employees = roster_cache.get(org_id)[0]
+    if employees is not None:
+        # В журнал - только активные сотрудники организации: id приходят из callback-данных
+        roster = {emp_id for emp_id, _ in employees}
+        rejected = set(employee_ids) - roster
+        if rejected:
+            logger.warning(f"⚠️ Отметка (организация {org_id}): нет в списке активных сотрудников {sorted(rejected)}")
+            employee_ids = [emp_id for emp_id in employee_ids if emp_id in roster]
     
-    for emp in employees:
-        keyboard.add(f"👤 {emp[1]}")  # emp[1] - full_name
+    if mark_journal is not None:
+        try:
+            return mark_journal.append(org_id, employee_ids, check_date), None
+        except sqlite3.Error as e:
+            logger.error(f"❌ Ошибка записи в журнал отметок: {e}")
+            return None
     
-    keyboard.add("❌ Отмена")
-    logger.info(f"✅ Создана клавиатура с {len(employees)} сотрудниками")
-    return keyboard
+    result = execute_prepared('attendance_mark_batch', fetch=True,
+        org_id=org_id, employee_ids=list(employee_ids), check_date=check_date
+    )
+    return None if result is None else (len(employee_ids), len(result))
 
-def create_date_keyboard():
-    """Создает клавиатуру с датами"""
-    keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=3)
-    
-    today = date.today()
-    yesterday = today - timedelta(days=1)
-    day_before = today - timedelta(days=2)
+@router.callback('att')
+def handle_marking_callback(req):
+    call = req.call
+    user_id = req.user_id
+    chat_id = req.chat_id
+    message_id = call.message.message_id
+    org_id = req.org_id
     
-    buttons = [
-        f"📅 {today.strftime('%d.%m.%Y')}",
-        f"📅 {yesterday.strftime('%d.%m.%Y')}",
-        f"📅 {day_before.strftime('%d.%m.%Y')}",
-        "📅 Другая дата"
-    ]
-    keyboard.add(*buttons)
-    keyboard.add("❌ Отмена")
+    if req.state != 'marking':
+        bot.answer_callback_query(call.id, "⚠️ Отметка уже завершена")
+        edit_message_reply_markup(chat_id, message_id, reply_markup=None)
+        return
     
-    return keyboard
-
-@bot.message_handler(commands=['start'])
-def start(message):
-    user_id = message.from_user.id
-    chat_id = message.chat.id
+    parts = call.data.split(':')
+    action = parts[1]
+    check_date = date.fromisoformat(get_user_data(user_id, 'date'))
+    selected = set(get_user_data(user_id, 'selected', []))
+    query = get_user_data(user_id, 'query')
+    employees = marking_employees(user_id, req.org_id)
     
-    if not is_admin(user_id):
-        bot.send_message(chat_id, "❌ У вас нет доступа к этому боту")
+    if action == 'noop':
+        bot.answer_callback_query(call.id)
         return
     
-    show_main_menu(chat_id)
-
-@bot.message_handler(commands=['debug'])
-def debug_db(message):
-    """Команда для отладки базы данных"""
-    user_id = message.from_user.id
-    if not is_admin(user_id):
-        bot.send_message(message.chat.id, "❌ У вас нет доступа к этой команде")
+    if action == 'cancel':
+        clear_user_state(user_id)
+        bot.answer_callback_query(call.id)
+        edit_message_text("❌ Отметка отменена", chat_id, message_id)
+        show_main_menu(chat_id)
         return
     
-    logger.info("🔧 ЗАПУСК КОМАНДЫ DEBUG")
-    
-    # Проверяем сотрудников РАЗНЫМИ способами
-    employees1 = execute_query('SELECT * FROM employees', fetch=True)
-    employees2 = execute_query('SELECT id, full_name FROM employees', fetch=True)
-    employees3 = execute_query('SELECT COUNT(*) FROM employees', fetch=True)
-    
-    # Проверяем таблицы
-    tables = execute_query("""
-        SELECT table_name 
-        FROM information_schema.tables 
-        WHERE table_schema = 'public'
-    """, fetch=True)
-    
-    # Формируем отчет
-    report = "🔧 ДЕТАЛЬНЫЙ ОТЧЕТ ОТЛАДКИ\n\n"
-    
-    if employees1:
-        report += f"✅ Способ 1 - Все поля: {len(employees1)} сотрудников\n"
-        for emp in employees1:
-            report += f"   👤 ID:{emp[0]}, Имя:'{emp[1]}', Должность:'{emp[2]}', Активен:{emp[3]}\n"
-    else:
-        report += "❌ Способ 1 - Все поля: 0 сотрудников\n"
-    
-    if employees2:
-        report += f"✅ Способ 2 - Только имя: {len(employees2)} сотрудников\n"
-        for emp in employees2:
-            report += f"   👤 ID:{emp[0]}, Имя:'{emp[1]}'\n"
-    else:
-        report += "❌ Способ 2 - Только имя: 0 сотрудников\n"
-    
-    if employees3:
-        report += f"✅ Способ 3 - COUNT: {employees3[0][0]} сотрудников\n"
-    else:
-        report += "❌ Способ 3 - COUNT: ошибка\n"
-    
-    if tables:
-        table_names = [table[0] for table in tables]
-        report += f"✅ Таблицы в БД: {', '.join(table_names)}\n"
-    else:
-        report += "❌ Таблицы в БД: не найдены\n"
+    if action == 'ok':
+        if not selected:
+            bot.answer_callback_query(call.id, "⚠️ Никто не выбран")
+            return
+        
+        saved = save_attendance(org_id, selected, check_date)
+        if saved is None:
+            bot.answer_callback_query(call.id, "❌ Ошибка при сохранении, попробуйте еще раз")
+            return
+        
+        clear_user_state(user_id)
+        bot.answer_callback_query(call.id)
+        count, inserted = saved
+        logger.info(f"✅ Отмечено {count} сотрудников за {check_date}")
+        text = f"✅ ОТМЕТКА СОХРАНЕНА\n\nДата: {check_date.strftime('%d.%m.%Y')}\n"
+        if inserted is None:
+            text += f"Отмечено: {count}"
+        else:
+            text += f"Новых отметок: {inserted}\nУже были отмечены: {count - inserted}"
+        edit_message_text(text, chat_id, message_id)
+        show_main_menu(chat_id)
+        return
     
-    # Проверяем конкретного сотрудника с ID=7
-    employee_7 = execute_query('SELECT * FROM employees WHERE id = 7', fetch=True)
-    if employee_7:
-        report += f"✅ Сотрудник ID=7 найден: {employee_7}\n"
-    else:
-        report += "❌ Сотрудник ID=7 не найден\n"
+    page = int(parts[-1]) if len(parts) > 2 else 0
+    if action == 't':
+        selected ^= {int(parts[2])}
+    elif action == 'all':
+        selected |= {emp_id for emp_id, _ in employees}
+    elif action == 'none':
+        selected -= {emp_id for emp_id, _ in employees}
+    elif action == 'q':
+        # Сброс поиска - снова весь ростер
+        set_user_data(user_id, 'query', None)
+        query = None
+        employees = roster_cache.employees(org_id)
     
-    bot.send_message(message.chat.id, report)
-    logger.info("✅ Детальный отчет отладки отправлен")
+    set_user_data(user_id, 'selected', sorted(selected))
+    bot.answer_callback_query(call.id)
+    edit_message_text(marking_text(check_date, len(selected), query), chat_id, message_id,
+        reply_markup=create_marking_keyboard(employees, selected, page, query)
+    )
 
-def show_main_menu(chat_id):
-    menu_text = "🏠 ГЛАВНОЕ МЕНЮ\n\nВыберите действие:"
-    bot.send_message(chat_id, menu_text, reply_markup=create_main_menu())
+# Отчеты: вся агрегация выполняется в БД одним запросом на отчет
 
-def show_employees_menu(chat_id):
-    menu_text = "👥 УПРАВЛЕНИЕ СОТРУДНИКАМИ\n\nВыберите действие:"
-    bot.send_message(chat_id, menu_text, reply_markup=create_employees_menu())
+# Предыдущий рабочий день для даты d (для пятничной отметки серия продолжается в понедельник)
+PREV_WORKDAY_SQL = "({d} - CASE EXTRACT(ISODOW FROM {d}) WHEN 1 THEN 3 WHEN 7 THEN 2 ELSE 1 END)"
 
-def show_reports_menu(chat_id):
-    menu_text = "📊 ОТЧЕТЫ\n\nВыберите тип отчета:"
-    bot.send_message(chat_id, menu_text, reply_markup=create_reports_menu())
+queries.register('report_general', '''
+    WITH workdays AS (
+        SELECT COUNT(*) AS n
+        FROM generate_series(date_trunc('month', CURRENT_DATE), CURRENT_DATE, INTERVAL '1 day') d
+        WHERE EXTRACT(ISODOW FROM d) < 6
+    )
+    SELECT e.full_name,
+           COALESCE(m.days_present, 0) AS present,
+           w.n AS workdays,
+           t.employee_id IS NOT NULL AS today
+    FROM employees e
+    CROSS JOIN workdays w
+    LEFT JOIN attendance_monthly m
+           ON m.employee_id = e.id
+          AND m.month = date_trunc('month', CURRENT_DATE)::date
+    LEFT JOIN attendance t
+           ON t.employee_id = e.id
+          AND t.check_date = CURRENT_DATE
+    WHERE e.org_id = :org_id AND e.is_active = TRUE
+    ORDER BY present DESC, e.full_name
+''', retry=True)
 
-@bot.message_handler(func=lambda message: True)
-def handle_messages(message):
-    user_id = message.from_user.id
-    chat_id = message.chat.id
-    text = message.text.strip()
-    
-    if not is_admin(user_id):
-        bot.send_message(chat_id, "❌ У вас нет доступа к этому боту")
+def report_general_stats(org_id):
+    """Статистика по активным сотрудникам за текущий месяц (из месячных агрегатов)"""
+    return execute_prepared('report_general', fetch=True, org_id=org_id)
+
+queries.register('report_daily_totals', '''
+    SELECT d::date, COALESCE(ad.present, 0)
+    FROM generate_series(CURRENT_DATE - :days::int, CURRENT_DATE, INTERVAL '1 day') d
+    LEFT JOIN attendance_daily ad ON ad.org_id = :org_id AND ad.check_date = d::date
+    ORDER BY d DESC
+''', retry=True)
+
+def report_daily_totals(org_id, days=7):
+    """Число отмеченных по дням за последние дни (из дневных агрегатов)"""
+    return execute_prepared('report_daily_totals', fetch=True, org_id=org_id, days=days - 1)
+
+queries.register('report_employee', f'''
+    WITH marks AS (
+        SELECT check_date,
+               CASE WHEN LAG(check_date) OVER (ORDER BY check_date)
+                         >= {PREV_WORKDAY_SQL.format(d='check_date')}
+                    THEN 0 ELSE 1 END AS new_streak
+        FROM attendance
+        WHERE employee_id = :employee_id
+    ),
+    streaks AS (
+        SELECT COUNT(*) AS length, MAX(check_date) AS last_day
+        FROM (
+            SELECT check_date, SUM(new_streak) OVER (ORDER BY check_date) AS streak_id
+            FROM marks
+        ) s
+        GROUP BY streak_id
+    ),
+    recent AS (
+        SELECT COUNT(*) AS workdays,
+               COUNT(*) FILTER (WHERE a.check_date IS NULL) AS absent,
+               string_agg(to_char(d, 'DD.MM'), ', ' ORDER BY d DESC)
+                   FILTER (WHERE a.check_date IS NULL) AS absent_days
+        FROM generate_series(CURRENT_DATE - 29, CURRENT_DATE, INTERVAL '1 day') d
+        LEFT JOIN attendance a ON a.employee_id = :employee_id AND a.check_date = d::date
+        WHERE EXTRACT(ISODOW FROM d) < 6
+    )
+    SELECT e.full_name,
+           e.position,
+           (SELECT COALESCE(SUM(days_present), 0)::int FROM attendance_monthly
+             WHERE employee_id = e.id) AS total,
+           (SELECT COALESCE(SUM(days_present), 0)::int FROM attendance_monthly
+             WHERE employee_id = e.id
+               AND month = date_trunc('month', CURRENT_DATE)::date) AS this_month,
+           (SELECT MAX(check_date) FROM marks) AS last_mark,
+           r.workdays,
+           r.absent,
+           r.absent_days,
+           COALESCE((SELECT MAX(length) FROM streaks), 0) AS longest_streak,
+           COALESCE((SELECT MAX(length) FROM streaks
+                      WHERE last_day >= {PREV_WORKDAY_SQL.format(d='CURRENT_DATE')}), 0) AS current_streak
+    FROM employees e
+    CROSS JOIN recent r
+    WHERE e.id = :employee_id AND e.org_id = :org_id
+''', retry=True)
+
+def report_employee_stats(org_id, employee_id):
+    """Статистика одного сотрудника: отметки, пропуски за 30 дней и серии"""
+    rows = execute_prepared('report_employee', fetch=True, org_id=org_id, employee_id=employee_id)
+    return rows[0] if rows else None
+
+queries.register('report_period', '''
+    WITH bounds AS (
+        SELECT :org_id::int AS org_id, :start_date::date AS start_date, :end_date::date AS end_date
+    ),
+    workdays AS (
+        SELECT COUNT(*) AS n
+        FROM bounds, generate_series(start_date, end_date, INTERVAL '1 day') d
+        WHERE EXTRACT(ISODOW FROM d) < 6
+    ),
+    counts AS (
+        SELECT m.employee_id, m.days_present AS present
+        FROM attendance_monthly m, bounds b
+        WHERE m.org_id = b.org_id
+          AND m.month >= b.start_date
+          AND m.month + INTERVAL '1 month' <= b.end_date + 1
+        UNION ALL
+        SELECT a.employee_id, COUNT(*)
+        FROM attendance a, bounds b
+        WHERE a.org_id = b.org_id
+          AND a.check_date BETWEEN b.start_date AND b.end_date
+          AND NOT (date_trunc('month', a.check_date) >= b.start_date
+                   AND date_trunc('month', a.check_date) + INTERVAL '1 month' <= b.end_date + 1)
+        GROUP BY a.employee_id
+    ),
+    totals AS (
+        SELECT employee_id, SUM(present)::int AS present
+        FROM counts
+        GROUP BY employee_id
+    )
+    SELECT e.full_name,
+           COALESCE(t.present, 0) AS present,
+           w.n AS workdays
+    FROM employees e
+    CROSS JOIN workdays w
+    LEFT JOIN totals t ON t.employee_id = e.id
+    WHERE e.org_id = (SELECT org_id FROM bounds)
+      AND (e.is_active OR t.present > 0)
+    ORDER BY present DESC, e.full_name
+''', retry=True)
+
+def report_period_stats(org_id, start_date, end_date):
+    """Посещаемость каждого сотрудника за период: целые месяцы берутся из агрегатов,
+    сырые отметки читаются только для неполных месяцев на краях периода"""
+    return execute_prepared('report_period', fetch=True,
+        org_id=org_id, start_date=start_date, end_date=end_date
+    )
+
+def format_rate(present, workdays):
+    if not workdays:
+        return "—"
+    return f"{round(100 * present / workdays)}%"
+
+def split_message(text, limit=MESSAGE_LIMIT):
+    """Разбивает текст по строкам на части не длиннее лимита Telegram; пустых частей нет"""
+    chunks = []
+    current = None  # None - часть еще не начата, '' - часть начата пустой строкой
+    for line in text.split('\n'):
+        if current is not None and len(current) + len(line) + 1 > limit:
+            # Пустые строки на стыке частей не нужны, а часть из одних пустых строк
+            # Telegram отклонит как пустое сообщение
+            if current.strip():
+                chunks.append(current.rstrip('\n'))
+            current = None
+        # Строка длиннее лимита режется на куски после уже набранной части
+        while len(line) > limit:
+            chunks.append(line[:limit])
+            line = line[limit:]
+        current = line if current is None else f"{current}\n{line}"
+    if current.strip() or not chunks:
+        chunks.append(current)
+    return chunks
+
+def send_long_message(chat_id, text, priority=PRIORITY_INTERACTIVE, **kwargs):
+    """Отправляет длинный текст несколькими сообщениями"""
+    chunks = split_message(text)
+    # Клавиатуру прикладываем к последней части
+    for chunk in chunks[:-1]:
+        send_message(chat_id, chunk, priority=priority)
+    send_message(chat_id, chunks[-1], priority=priority, **kwargs)
+
+@router.text("📈 Общий отчет")
+def general_report(req):
+    org_id = req.org_id
+    rows = report_general_stats(org_id)
+    if rows is None:
+        send_message(req.chat_id, "❌ Ошибка при построении отчета")
         return
-    
-    # Если пользователь в процессе ввода данных
-    if user_id in user_states:
-        handle_user_state(message)
+    if not rows:
+        send_message(req.chat_id, "❌ Нет активных сотрудников")
         return
     
-    # Обработка основного меню
-    if text == "👥 Сотрудники":
-        show_employees_menu(chat_id)
+    workdays = rows[0][2]
+    present_today = sum(1 for row in rows if row[3])
+    total_present = sum(row[1] for row in rows)
     
-    elif text == "✅ Отметить сегодня":
-        mark_attendance_today(message)
-    
-    elif text == "📅 Отметить за дату":
-        mark_attendance_date(message)
+    text = (
+        f"📈 ОБЩИЙ ОТЧЕТ\n\n"
+        f"📅 Месяц: {date.today().strftime('%m.%Y')}, рабочих дней: {workdays}\n"
+        f"✅ Сегодня отмечены: {present_today} из {len(rows)}\n"
+        f"📊 Средняя посещаемость: {format_rate(total_present, workdays * len(rows))}\n\n"
+    )
+    for full_name, present, _, today in rows:
+        mark = "✅" if today else "▫️"
+        text += f"{mark} {full_name}: {present} дн. ({format_rate(present, workdays)})\n"
     
-    elif text == "📊 Отчеты":
-        show_reports_menu(chat_id)
+    daily = report_daily_totals(org_id)
+    if daily:
+        text += "\n📆 ПОСЛЕДНИЕ 7 ДНЕЙ\n"
+        for day, present in daily:
+            text += f"{day.strftime('%d.%m')}: {present}\n"
     
-    elif text == "ℹ️ Помощь":
-        show_help(message)
+    send_long_message(req.chat_id, text)
+
+@router.text("👤 Отчет по сотруднику")
+def employee_report_start(req):
+    employees = roster_cache.employees(req.org_id)
+    if not employees:
+        send_message(req.chat_id, "❌ Сотрудники не найдены")
+        return
     
-    # Обработка меню сотрудников
-    elif text == "➕ Добавить сотрудника":
-        add_employee_start(message)
+    set_user_state(req.user_id, 'waiting_report_employee')
+    send_message(req.chat_id,
+        "👤 ОТЧЕТ ПО СОТРУДНИКУ\n\nВыберите сотрудника или введите часть ФИО для поиска:",
+        reply_markup=create_employee_picker(employees, 'rep')
+    )
+
+# Кнопка меню во время поиска не считается запросом, а переключает раздел
+@router.state('waiting_report_employee', escape=MENU_BUTTONS.__contains__)
+def search_report_employee(req):
+    """Поиск сотрудника для отчета по введенному тексту"""
+    user_id = req.user_id
+    chat_id = req.chat_id
+    org_id = req.org_id
+    text = req.text
+    total, found = roster_cache.index(org_id).search(text, PICKER_PAGE_SIZE)
+    if not found:
+        send_message(chat_id, "❌ Никого не найдено. Попробуйте еще раз или выберите из списка:",
+            reply_markup=create_employee_picker(roster_cache.employees(org_id), 'rep')
+        )
+        return
+    if total == 1:
+        clear_user_state(user_id)
+        employee_report(chat_id, org_id, found[0][0])
+        return
     
-    elif text == "📋 Список сотрудников":
-        view_employees(message)
+    text = f"🔎 Найдено: {total}"
+    if total > len(found):
+        text += f" (показаны первые {len(found)} - уточните запрос)"
+    send_message(chat_id, text, reply_markup=create_employee_picker(found, 'rep', total=total))
+
+@router.callback('rep')
+def handle_report_pick_callback(req):
+    call = req.call
+    user_id = req.user_id
+    chat_id = req.chat_id
+    message_id = call.message.message_id
+    org_id = req.org_id
     
-    elif text == "🔙 Главное меню":
-        show_main_menu(chat_id)
+    if req.state != 'waiting_report_employee':
+        bot.answer_callback_query(call.id, "⚠️ Выбор уже завершен")
+        edit_message_reply_markup(chat_id, message_id, reply_markup=None)
+        return
     
-    # Обработка меню отчетов
-    elif text == "📈 Общий отчет":
-        general_report(message)
+    parts = call.data.split(':')
+    action = parts[1]
+    bot.answer_callback_query(call.id)
     
-    elif text == "👤 Отчет по сотруднику":
-        employee_report_start(message)
+    if action == 'p':
+        edit_message_reply_markup(chat_id, message_id,
+            reply_markup=create_employee_picker(roster_cache.employees(org_id), 'rep', int(parts[2]))
+        )
+    elif action == 'e':
+        clear_user_state(user_id)
+        edit_message_reply_markup(chat_id, message_id, reply_markup=None)
+        employee_report(chat_id, org_id, int(parts[2]))
+    elif action == 'cancel':
+        clear_user_state(user_id)
+        edit_message_text("❌ Отменено", chat_id, message_id)
+        show_reports_menu(chat_id)
+
+def employee_report(chat_id, org_id, employee_id):
+    stats = report_employee_stats(org_id, employee_id)
+    if not stats:
+        send_message(chat_id, "❌ Сотрудник не найден", reply_markup=create_reports_menu())
+        return
     
-    elif text == "📅 Отчет за период":
-        period_report_start(message)
+    (full_name, position, total, this_month, last_mark, workdays, absent,
+     absent_days, longest_streak, current_streak) = stats
+    position_text = f"💼 {position}" if position else "💼 Должность не указана"
+    last_mark_text = last_mark.strftime('%d.%m.%Y') if last_mark else "нет"
     
-    elif text == "🔙 Назад":
-        show_main_menu(chat_id)
+    text = (
+        f"👤 ОТЧЕТ ПО СОТРУДНИКУ\n\n"
+        f"👤 {full_name}\n"
+        f"{position_text}\n\n"
+        f"✅ Всего отметок: {total}\n"
+        f"📅 В этом месяце: {this_month}\n"
+        f"🕐 Последняя отметка: {last_mark_text}\n\n"
+        f"📊 За 30 дней: {workdays - absent} из {workdays} рабочих дней "
+        f"({format_rate(workdays - absent, workdays)})\n"
+        f"🔥 Текущая серия: {current_streak}\n"
+        f"🏆 Лучшая серия: {longest_streak}\n"
+    )
+    if absent_days:
+        text += f"\n❌ Пропуски: {absent_days}\n"
     
-    elif text == "❌ Отмена":
-        if user_id in user_states:
-            del user_states[user_id]
-        show_main_menu(chat_id)
+    send_long_message(chat_id, text, reply_markup=create_reports_menu())
+
+@router.text("📅 Отчет за период")
+def period_report_start(req):
+    set_user_state(req.user_id, 'waiting_report_period')
+    send_message(req.chat_id,
+        "📅 ОТЧЕТ ЗА ПЕРИОД\n\n"
+        "Выберите период или введите его в формате ДД.ММ.ГГГГ - ДД.ММ.ГГГГ:",
+        reply_markup=create_period_keyboard()
+    )
+
+def parse_period(text):
+    """Возвращает (начало, конец) периода по кнопке или тексту вида ДД.ММ.ГГГГ - ДД.ММ.ГГГГ"""
+    today = date.today()
+    if text == "📅 Эта неделя":
+        return today - timedelta(days=today.weekday()), today
+    if text == "📅 Этот месяц":
+        return today.replace(day=1), today
+    if text == "📅 Прошлый месяц":
+        end_date = today.replace(day=1) - timedelta(days=1)
+        return end_date.replace(day=1), end_date
+    if text == "📅 Этот год":
+        return today.replace(month=1, day=1), today
     
-    else:
-        show_main_menu(chat_id)
+    parts = text.replace("—", "-").split('-')
+    if len(parts) != 2:
+        return None
+    start_date, end_date = parse_date(parts[0]), parse_date(parts[1])
+    if not start_date or not end_date or start_date > end_date:
+        return None
+    return start_date, end_date
 
-def handle_user_state(message):
-    user_id = message.from_user.id
-    chat_id = message.chat.id
-    text = message.text.strip()
-    state = user_states[user_id]
+def period_report(chat_id, org_id, start_date, end_date):
+    rows = report_period_stats(org_id, start_date, end_date)
+    if rows is None:
+        send_message(chat_id, "❌ Ошибка при построении отчета", reply_markup=create_reports_menu())
+        return
     
-    if text == "❌ Отмена":
-        del user_states[user_id]
-        show_main_menu(chat_id)
+    if not rows:
+        period_text = f"{start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')}"
+        send_message(chat_id, f"❌ За период {period_text} нет данных", reply_markup=create_reports_menu())
         return
     
-    if state == 'waiting_employee_name':
-        employee_name = text
-        user_states[user_id] = 'waiting_employee_position'
-        user_states[f'{user_id}_name'] = employee_name
-        bot.send_message(chat_id, 
-            f"Отлично! Сотрудник: {employee_name}\n\n"
-            f"Теперь введите должность (или отправьте '-' если не нужно):",
-            reply_markup=create_cancel_menu()
-        )
+    send_long_message(chat_id, format_period_report("📅 ОТЧЕТ ЗА ПЕРИОД", start_date, end_date, rows),
+        reply_markup=create_reports_menu()
+    )
+
+def format_period_report(title, start_date, end_date, rows):
+    """Текст отчета за период по строкам report_period_stats"""
+    period_text = f"{start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')}"
+    workdays = rows[0][2]
+    total_present = sum(row[1] for row in rows)
+    text = (
+        f"{title}\n\n"
+        f"🗓 {period_text}, рабочих дней: {workdays}\n"
+        f"✅ Всего отметок: {total_present}\n"
+        f"📊 Средняя посещаемость: {format_rate(total_present, workdays * len(rows))}\n\n"
+    )
+    for full_name, present, _ in rows:
+        text += f"👤 {full_name}: {present} дн. ({format_rate(present, workdays)})\n"
+    return text
+
+# Выгрузка посещаемости: строки читаются из БД порциями и сразу пишутся в файл,
+# поэтому память не зависит от объема данных
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 2000))
+EXPORT_COLUMNS = ["Дата", "Сотрудник", "Должность", "Время отметки"]
+
+def stream_attendance_rows(org_id, start_date, end_date, batch_size=EXPORT_BATCH_SIZE):
+    """Генератор строк выгрузки через серверный курсор"""
+    with db_pool.connection() as conn:
+        if not conn:
+            raise RuntimeError("Нет соединения с БД")
+        with conn.cursor() as cursor:
+            cursor.execute('BEGIN')
+            try:
+                cursor.execute(
+                    '''
+                    DECLARE export_cursor NO SCROLL CURSOR FOR
+                    SELECT a.check_date, e.full_name, e.position, a.marked_date
+                    FROM attendance a
+                    JOIN employees e ON e.id = a.employee_id
+                    WHERE a.org_id = %s AND a.check_date BETWEEN %s AND %s
+                    ORDER BY a.check_date, e.full_name
+                    ''',
+                    (org_id, start_date, end_date)
+                )
+                while True:
+                    cursor.execute(f'FETCH FORWARD {int(batch_size)} FROM export_cursor')
+                    rows = cursor.fetchall()
+                    if not rows:
+                        break
+                    yield from rows
+            finally:
+                # Откат закрывает курсор и возвращает соединение в autocommit
+                conn.rollback()
+
+def export_row(row):
+    check_date, full_name, position, marked_date = row
+    return [
+        check_date.strftime('%d.%m.%Y'),
+        full_name,
+        position or '',
+        marked_date.strftime('%d.%m.%Y %H:%M') if marked_date else ''
+    ]
+
+def write_csv(rows, path):
+    """Пишет CSV построчно; возвращает число строк"""
+    count = 0
+    # utf-8-sig и ';' - чтобы файл сразу корректно открывался в Excel
+    with open(path, 'w', newline='', encoding='utf-8-sig') as f:
+        writer = csv.writer(f, delimiter=';')
+        writer.writerow(EXPORT_COLUMNS)
+        for row in rows:
+            writer.writerow(export_row(row))
+            count += 1
+    return count
+
+def write_xlsx(rows, path):
+    """Пишет XLSX в потоковом (write-only) режиме; возвращает число строк"""
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet("Посещаемость")
+    sheet.append(EXPORT_COLUMNS)
+    count = 0
+    for row in rows:
+        sheet.append(export_row(row))
+        count += 1
+    workbook.save(path)
+    return count
+
+EXPORT_FORMATS = {
+    "📄 CSV": ('csv', write_csv),
+    "📊 Excel": ('xlsx', write_xlsx),
+}
+
+def create_export_format_keyboard():
+    """Создает клавиатуру выбора формата выгрузки"""
+    keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
+    keyboard.add(*[label for label, (ext, _) in EXPORT_FORMATS.items() if ext != 'xlsx' or openpyxl])
+    keyboard.add("❌ Отмена")
+    return keyboard
+
+@router.text("📤 Выгрузка")
+def export_start(req):
+    set_user_state(req.user_id, 'waiting_export_period')
+    send_message(req.chat_id,
+        "📤 ВЫГРУЗКА ПОСЕЩАЕМОСТИ\n\n"
+        "Выберите период или введите его в формате ДД.ММ.ГГГГ - ДД.ММ.ГГГГ:",
+        reply_markup=create_period_keyboard()
+    )
+
+def export_attendance(chat_id, org_id, start_date, end_date, label):
+    """Формирует файл выгрузки и отправляет его документом"""
+    ext, writer = EXPORT_FORMATS[label]
+    file_name = f"attendance_{start_date.strftime('%Y%m%d')}_{end_date.strftime('%Y%m%d')}.{ext}"
+    send_message(chat_id, "⏳ Формирую файл...")
     
-    elif state == 'waiting_employee_position':
-        position = text if text != '-' else None
-        employee_name = user_states.get(f'{user_id}_name')
-        
-        logger.info(f"🎯 ДОБАВЛЕНИЕ СОТРУДНИКА: {employee_name}")
+    fd, path = tempfile.mkstemp(suffix=f'.{ext}')
+    os.close(fd)
+    try:
+        started = time.monotonic()
+        count = writer(stream_attendance_rows(org_id, start_date, end_date), path)
+        logger.info(f"✅ Выгрузка {file_name}: {count} строк за {time.monotonic() - started:.1f} с")
         
-        result = execute_query(
-            'INSERT INTO employees (full_name, position) VALUES (%s, %s) RETURNING id',
-            (employee_name, position),
-            fetch=True
+        with open(path, 'rb') as f:
+            # Ждем отправки: файл удаляется сразу после нее
+            outbox.submit(chat_id, bot.send_document, chat_id, f, wait=True,
+                visible_file_name=file_name,
+                caption=f"📤 Посещаемость {start_date.strftime('%d.%m.%Y')} - "
+                        f"{end_date.strftime('%d.%m.%Y')}: {count} записей",
+                reply_markup=create_reports_menu()
+            )
+    except Exception as e:
+        logger.error(f"❌ Ошибка выгрузки: {e}")
+        send_message(chat_id, "❌ Ошибка при формировании выгрузки", reply_markup=create_reports_menu())
+    finally:
+        os.remove(path)
+
+# Плановые задачи: время следующего запуска хранится в scheduled_jobs, поэтому расписание
+# переживает перезапуск, а каждый запуск забирает ровно одна реплика (UPDATE ... RETURNING)
+SCHEDULER_ENABLED = os.environ.get('SCHEDULER_ENABLED', '1') != '0'
+DIGEST_TIME = datetime.strptime(os.environ.get('DIGEST_TIME', '18:00'), '%H:%M').time()
+WEEKLY_SUMMARY_WEEKDAY = int(os.environ.get('WEEKLY_SUMMARY_WEEKDAY', 5))  # ISO: 5 - пятница
+FANOUT_BATCH_SIZE = int(os.environ.get('FANOUT_BATCH_SIZE', 25))
+SCHEDULER_RETRY_SECONDS = 60
+
+def next_run_at(after, at, weekdays=range(1, 8)):
+    """Ближайший после after момент времени at (местное время) в один из дней недели weekdays (ISO)"""
+    day = after.date()
+    while True:
+        candidate = datetime.combine(day, at).astimezone()
+        if candidate > after and candidate.isoweekday() in weekdays:
+            return candidate
+        day += timedelta(days=1)
+
+queries.register('scheduler_claim', '''
+    UPDATE scheduled_jobs SET next_run = :next_run, last_run = now()
+    WHERE name = :job_name AND next_run <= now()
+    RETURNING name
+''')
+
+class ScheduledJob:
+    """Повторяющаяся задача: schedule(after) -> время следующего запуска, run() - сама работа"""
+    __slots__ = ('name', 'schedule', 'run')
+
+    def __init__(self, name, schedule, run):
+        self.name = name
+        self.schedule = schedule
+        self.run = run
+
+class Scheduler:
+    """Куча (время запуска, задача) в памяти процесса; источник истины - таблица scheduled_jobs"""
+
+    def __init__(self, jobs, should_run=None):
+        self._jobs = {job.name: job for job in jobs}
+        self._should_run = should_run  # None или функция: выполнять ли задачи в этом процессе
+        self._heap = []
+        self._cond = threading.Condition()
+        self._started = False
+
+    def start(self):
+        with self._cond:
+            if self._started:
+                return
+            self._started = True
+        for job in self._jobs.values():
+            self._push(job, self._sync(job))
+        threading.Thread(target=self._loop, name='scheduler', daemon=True).start()
+        logger.info(f"✅ Планировщик запущен: {', '.join(self._jobs)}")
+
+    def _sync(self, job):
+        """Регистрирует задачу в БД и возвращает сохраненное время следующего запуска"""
+        now = datetime.now().astimezone()
+        execute_query(
+            'INSERT INTO scheduled_jobs (name, next_run) VALUES (%s, %s) ON CONFLICT (name) DO NOTHING',
+            (job.name, job.schedule(now)),
+            retry=True
         )
-        
-        logger.info(f"🎯 РЕЗУЛЬТАТ ДОБАВЛЕНИЯ: {result}")
-        
-        if result:
-            employee_id = result[0][0]
-            position_text = f"💼 {position}" if position else "💼 Должность не указана"
-            bot.send_message(chat_id, 
-                f"✅ СОТРУДНИК ДОБАВЛЕН!\n\n"
-                f"👤 Имя: {employee_name}\n"
-                f"{position_text}\n"
-                f"🆔 ID в БД: {employee_id}")
-            
-            # СРАЗУ проверяем разными способами
-            check1 = execute_query('SELECT * FROM employees WHERE id = %s', (employee_id,), fetch=True)
-            check2 = execute_query('SELECT COUNT(*) FROM employees', fetch=True)
-            logger.info(f"🔍 ПРОВЕРКА 1 (по ID): {check1}")
-            logger.info(f"🔍 ПРОВЕРКА 2 (COUNT): {check2}")
-        else:
-            bot.send_message(chat_id, "❌ Ошибка при добавлении сотрудника")
-        
-        # Очищаем временные данные
-        del user_states[user_id]
-        if f'{user_id}_name' in user_states:
-            del user_states[f'{user_id}_name']
-        
-        show_employees_menu(chat_id)
+        rows = execute_query('SELECT next_run FROM scheduled_jobs WHERE name = %s', (job.name,),
+                             fetch=True, retry=True)
+        return rows[0][0] if rows else None
 
-def add_employee_start(message):
-    user_id = message.from_user.id
-    chat_id = message.chat.id
-    
-    user_states[user_id] = 'waiting_employee_name'
-    bot.send_message(chat_id,
-        "👤 ДОБАВЛЕНИЕ СОТРУДНИКА\n\n"
-        "Введите ФИО сотрудника:",
-        reply_markup=create_cancel_menu()
-    )
+    def _claim(self, job):
+        """Переносит next_run вперед; строку вернет только той реплике, чей UPDATE прошел первым"""
+        rows = execute_prepared('scheduler_claim', fetch=True,
+            job_name=job.name, next_run=job.schedule(datetime.now().astimezone())
+        )
+        return bool(rows)
 
-def view_employees(message):
-    logger.info("🔍 ВЫЗВАНА ФУНКЦИЯ view_employees")
-    
-    # Проверяем разными способами
-    employees1 = execute_query(
-        'SELECT id, full_name, position, is_active FROM employees ORDER BY is_active DESC, full_name', 
-        fetch=True
+    def _push(self, job, next_run):
+        due = next_run.timestamp() if next_run else 0
+        if due <= time.time():
+            # БД недоступна или запуск уже просрочен и не забран - проверим позже
+            due = time.time() + (SCHEDULER_RETRY_SECONDS if next_run is None else 0)
+        with self._cond:
+            heapq.heappush(self._heap, (due, job.name))
+            self._cond.notify()
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.time():
+                    self._cond.wait(self._heap[0][0] - time.time() if self._heap else None)
+                _, name = heapq.heappop(self._heap)
+            
+            job = self._jobs[name]
+            try:
+                if (self._should_run is None or self._should_run()) and self._claim(job):
+                    logger.info(f"⏰ Плановая задача: {name}")
+                    job.run()
+            except Exception as e:
+                logger.error(f"❌ Ошибка плановой задачи {name}: {e}")
+            
+            next_run = self._sync(job)
+            if next_run is not None and next_run.timestamp() <= time.time():
+                # Забрать запуск не удалось (ошибка БД) - повторим позже, а не в цикле
+                next_run = datetime.now().astimezone() + timedelta(seconds=SCHEDULER_RETRY_SECONDS)
+            self._push(job, next_run)
+
+def fan_out(texts):
+    """Рассылает администраторам каждой организации ее текст (texts: org_id -> текст)
+    пачками через массовую полосу очереди отправки"""
+    if not texts:
+        return
+    rows = execute_query(
+        'SELECT org_id, user_id FROM admins WHERE org_id = ANY(%s) ORDER BY org_id, user_id',
+        (list(texts),),
+        fetch=True,
+        name='admins_fanout',
+        retry=True
     )
-    
-    employees2 = execute_query('SELECT * FROM employees', fetch=True)
-    
-    logger.info(f"🔍 РЕЗУЛЬТАТ 1 (для списка): {employees1}")
-    logger.info(f"🔍 РЕЗУЛЬТАТ 2 (все поля): {employees2}")
-    
-    if not employees1:
-        bot.send_message(message.chat.id, "❌ Сотрудники не найдены")
-        logger.warning("⚠️ В базе нет сотрудников при запросе списка")
+    if rows is None:
+        logger.error("❌ Рассылка не выполнена: нет списка администраторов")
         return
     
-    text = "👥 СПИСОК СОТРУДНИКОВ\n\n"
-    for emp in employees1:
-        emp_id, full_name, position, is_active = emp
-        status = "✅" if is_active else "❌"
-        position_text = f"💼 {position}" if position else "💼 Должность не указана"
-        text += f"{status} {full_name}\n{position_text}\n🆔 ID: {emp_id}\n\n"
-    
-    bot.send_message(message.chat.id, text)
-    logger.info(f"✅ Показан список из {len(employees1)} сотрудников")
+    chunks = {org_id: split_message(text) for org_id, text in texts.items()}
+    for i in range(0, len(rows), FANOUT_BATCH_SIZE):
+        for org_id, admin_id in rows[i:i + FANOUT_BATCH_SIZE]:
+            for chunk in chunks[org_id]:
+                send_message(admin_id, chunk, priority=PRIORITY_BULK)
+        # Следующую пачку ставим, когда предыдущая почти ушла: очередь не разрастается
+        outbox.wait_below(PRIORITY_BULK, FANOUT_BATCH_SIZE)
+    logger.info(f"✅ Рассылка отправлена: организаций {len(texts)}, администраторов {len(rows)}")
 
-def mark_attendance_today(message):
-    user_id = message.from_user.id
-    chat_id = message.chat.id
-    
-    user_states[user_id] = 'waiting_mark_employee'
-    
-    employees_keyboard = create_employees_keyboard()
-    if not employees_keyboard:
-        bot.send_message(chat_id, "❌ Нет сотрудников для отметки")
-        return
-    
-    today = date.today().strftime('%d.%m.%Y')
-    bot.send_message(chat_id,
-        f"✅ ОТМЕТКА ПРИСУТСТВИЯ (СЕГОДНЯ)\n\nДата: {today}\nВыберите сотрудника:",
-        reply_markup=employees_keyboard
+def format_daily_digest(today, rows):
+    """Текст ежедневной сводки по строкам (ФИО, отмечен ли) одной организации"""
+    absent = [full_name for full_name, present in rows if not present]
+    text = (
+        f"🔔 ЕЖЕДНЕВНАЯ СВОДКА\n\n"
+        f"📅 {today.strftime('%d.%m.%Y')}\n"
+        f"✅ Отмечены: {len(rows) - len(absent)} из {len(rows)}\n\n"
     )
+    if absent:
+        text += "❌ Не отметились:\n" + "".join(f"• {full_name}\n" for full_name in absent)
+    else:
+        text += "🎉 Отметились все"
+    return text
 
-def mark_attendance_date(message):
-    user_id = message.from_user.id
-    chat_id = message.chat.id
-    
-    user_states[user_id] = 'waiting_mark_employee'
-    
-    employees_keyboard = create_employees_keyboard()
-    if not employees_keyboard:
-        bot.send_message(chat_id, "❌ Нет сотрудников для отметки")
+queries.register('digest_daily', '''
+    SELECT e.org_id,
+           e.full_name,
+           EXISTS (SELECT 1 FROM attendance a WHERE a.employee_id = e.id AND a.check_date = :today)
+    FROM employees e
+    WHERE e.is_active = TRUE
+    ORDER BY e.org_id, e.full_name
+''', retry=True)
+
+def daily_digest():
+    """Ежедневная сводка: кто сегодня не отметился, по всем организациям одним запросом"""
+    today = date.today()
+    rows = execute_prepared('digest_daily', fetch=True, today=today)
+    if not rows:
         return
     
-    bot.send_message(chat_id,
-        "✅ ОТМЕТКА ПРИСУТСТВИЯ (ЗА ДАТУ)\n\nВыберите сотрудника:",
-        reply_markup=employees_keyboard
-    )
+    by_org = {}
+    for org_id, full_name, present in rows:
+        by_org.setdefault(org_id, []).append((full_name, present))
+    fan_out({org_id: format_daily_digest(today, org_rows) for org_id, org_rows in by_org.items()})
+
+def weekly_summary():
+    """Итоги недели с понедельника по сегодня для каждой организации"""
+    today = date.today()
+    start_date = today - timedelta(days=today.weekday())
+    orgs = execute_query('SELECT DISTINCT org_id FROM admins', fetch=True, retry=True) or []
+    texts = {}
+    for (org_id,) in orgs:
+        rows = report_period_stats(org_id, start_date, today)
+        if rows:
+            texts[org_id] = format_period_report("📅 ИТОГИ НЕДЕЛИ", start_date, today, rows)
+    fan_out(texts)
 
-def show_help(message):
+# Задачи выполняет лидер; на резервной реплике планировщик только следит за расписанием
+scheduler = Scheduler([
+    ScheduledJob('daily_digest', lambda after: next_run_at(after, DIGEST_TIME, range(1, 6)), daily_digest),
+    ScheduledJob('weekly_summary', lambda after: next_run_at(after, DIGEST_TIME, (WEEKLY_SUMMARY_WEEKDAY,)),
+                 weekly_summary),
+], should_run=coordinator.is_leader)
+
+@router.text("ℹ️ Помощь")
+def show_help(req):
     help_text = """ℹ️ ПОМОЩЬ
 
 👥 СОТРУДНИКИ:
 • Добавление новых сотрудников
+• Импорт списка из CSV или Excel: просто отправьте файл
 • Просмотр списка всех сотрудников
 
 ✅ ОТМЕТКА ПРИСУТСТВИЯ:
 • Отметка за сегодняшний день
 • Отметка за любую прошлую дату
+• Выберите присутствующих (или «Отметить всех») и нажмите «Подтвердить»
+• Чтобы найти сотрудника, просто введите часть ФИО
 
 📊 ОТЧЕТЫ:
 • Общая статистика
-• Отчет по сотруднику  
+• Отчет по сотруднику (выбор из списка или поиск по части ФИО)
 • Отчеты за период
+• Выгрузка посещаемости в CSV или Excel
+
+🔑 АДМИНИСТРАТОРЫ:
+• /add_admin <user_id> - добавить администратора вашей организации
+• /remove_admin <user_id> - удалить администратора
+• /add_org <user_id> <название> - создать организацию (только владелец бота)
 
 🔧 ОТЛАДКА:
-• Используйте /debug для проверки БД"""
+• Используйте /debug для проверки БД
+• /rebuild_rollups - пересчитать агрегаты для отчетов всех организаций (только владелец бота)"""
+    
+    send_message(req.chat_id, help_text)
+
+# Показатели пула соединений, очередей и кэшей для /metrics
+CallbackMetric('bot_db_pool_connections', 'Открытых соединений в пуле', lambda: db_pool.size)
+CallbackMetric('bot_db_pool_idle_connections', 'Свободных соединений в пуле', lambda: db_pool.idle_count)
+CallbackMetric('bot_update_queue_depth', 'Обновлений в очереди на обработку', lambda: dispatcher.depth())
+CallbackMetric('bot_outbox_depth', 'Исходящих вызовов в очереди', lambda: outbox.depth())
+CallbackMetric('bot_dialog_states', 'Незавершенных диалогов в памяти', lambda: len(state_store))
+CallbackMetric('bot_admin_cache_hits_total', 'Попадания в кэш администраторов',
+               lambda: admin_cache.hits, 'counter')
+CallbackMetric('bot_admin_cache_misses_total', 'Промахи кэша администраторов',
+               lambda: admin_cache.misses, 'counter')
+CallbackMetric('bot_roster_cache_hits_total', 'Попадания в кэш сотрудников',
+               lambda: roster_cache.hits, 'counter')
+CallbackMetric('bot_roster_cache_misses_total', 'Промахи кэша сотрудников',
+               lambda: roster_cache.misses, 'counter')
+CallbackMetric('bot_mark_journal_pending', 'Отметок в журнале, еще не записанных в БД',
+               lambda: mark_journal.pending() if mark_journal is not None else 0)
+CallbackMetric('bot_leader', 'Реплика - лидер (1) или резерв (0)', lambda: int(coordinator.is_leader()))
+CallbackMetric('bot_roster_cache_orgs', 'Организаций в кэше сотрудников', lambda: roster_cache.stats()['orgs'])
+CallbackMetric('bot_prepared_statements', 'Подготовленных запросов на соединениях пула', queries.prepared_count)
+
+def poll_updates(skip_pending=False):
+    """Получает обновления через getUpdates и раздает их обработчикам, пока реплика - лидер"""
+    offset = None
+    if skip_pending:
+        pending = bot.get_updates(offset=-1, timeout=60, long_polling_timeout=0)
+        if pending:
+            offset = pending[-1].update_id + 1
+    
+    while coordinator.is_leader():
+        # Ожидание не дольше аренды: сложивший полномочия лидер быстро освобождает getUpdates
+        updates = bot.get_updates(offset=offset, timeout=60, long_polling_timeout=LEADER_LEASE_SECONDS)
+        for update in updates:
+            offset = update.update_id + 1
+            # После перезапуска polling Telegram может повторить неподтвержденные обновления
+            if recent_updates.add(update.update_id):
+                UPDATES_RECEIVED.inc(source='polling')
+                # Блокирующая постановка: при переполненной очереди polling притормаживает
+                dispatcher.submit(update)
+
+def run_webhook(flask_thread):
+    """Режим webhook: обновления принимает Flask, обрабатывают рабочие потоки"""
+    dispatcher.start()
+    
+    url = WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH
+    retry_with_backoff(bot.remove_webhook, "Снятие старого webhook")
+    retry_with_backoff(lambda: bot.set_webhook(url=url, secret_token=WEBHOOK_SECRET), "Установка webhook")
+    readiness['bot'] = True
+    logger.info(f"✅ Webhook установлен: {url}")
+    
+    flask_thread.join()
+
+def run_polling():
+    """Режим long polling"""
+    # Снимаем webhook, если бот раньше работал в этом режиме - иначе getUpdates вернет 409
+    retry_with_backoff(bot.remove_webhook, "Снятие webhook")
+    dispatcher.start()
+    readiness['bot'] = True
+    
+    # Накопившиеся обновления пропускаем, только если реплика стала лидером сразу при запуске:
+    # после отказа лидера они - необработанные сообщения пользователей
+    skip_pending = coordinator.is_leader()
+    while True:
+        if not coordinator.is_leader():
+            logger.info("⏸ Резервная реплика: ожидание лидерства")
+            coordinator.wait_leader()
+        try:
+            logger.info("🔄 Запуск polling...")
+            poll_updates(skip_pending=skip_pending)
+        except Exception as e:
+            if "409" in str(e):
+                # getUpdates еще держит прежний лидер - дождемся окончания его запроса
+                logger.warning("⚠️ Ошибка 409: getUpdates занят другим экземпляром, повтор")
+                time.sleep(LEADER_CHECK_INTERVAL)
+            else:
+                logger.error(f"❌ Ошибка бота: {e}")
+                logger.info("🔄 Перезапуск через 15 секунд...")
+                time.sleep(15)
+        skip_pending = False
+
+# Режим asyncio (RUNTIME=asyncio): прием обновлений, HTTP-эндпоинты и long polling живут
+# в одном цикле событий без потока на запрос. Обработчики остаются общими для обоих
+# режимов - синхронными, и выполняются в ограниченном пуле потоков
+RUNTIME = os.environ.get('RUNTIME', 'threads')
+
+class AsyncUpdateDispatcher:
+    """Аналог UpdateDispatcher для цикла событий: обновления одного чата - строго по порядку,
+    разных чатов - параллельно, но не больше workers одновременно"""
+
+    def __init__(self, handler, workers=4, queue_size=1000):
+        self._handler = handler
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='update-worker')
+        self._queue_size = queue_size
+        self._tails = {}  # id чата -> последняя поставленная задача этого чата
+        self._pending = 0
+
+    def submit(self, update):
+        """Ставит обновление в обработку; False - превышен лимит очереди"""
+        if self._pending >= self._queue_size:
+            return False
+        chat_id = update_chat_id(update)
+        self._pending += 1
+        task = asyncio.ensure_future(self._run(self._tails.get(chat_id), update))
+        self._tails[chat_id] = task
+        task.add_done_callback(lambda done: self._finish(chat_id, done))
+        return True
+
+    def depth(self):
+        return self._pending
+
+    async def _run(self, previous, update):
+        # Ждем предыдущее обновление того же чата; ожидание не занимает поток
+        if previous is not None:
+            await asyncio.wait([previous])
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self._executor, self._handler, [update])
+        except Exception as e:
+            logger.error(f"❌ Ошибка обработки обновления {update.update_id}: {e}")
+
+    def _finish(self, chat_id, task):
+        self._pending -= 1
+        if self._tails.get(chat_id) is task:
+            del self._tails[chat_id]
+
+def create_async_app(async_dispatcher):
+    """HTTP-эндпоинты бота на aiohttp: те же пути и ответы, что у Flask"""
+    
+    async def home(request):
+        return web.Response(text="Bot is running!")
+    
+    async def ping(request):
+        return web.Response(text="pong")
+    
+    async def metrics(request):
+        return web.Response(body=render_metrics().encode(),
+            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+    
+    async def ready(request):
+        db_alive = bool(await execute_prepared_async('ready', fetch=True)) if readiness['db'] else None
+        body, status = readiness_report(db_alive)
+        return web.Response(text=body, status=status, content_type='application/json')
+    
+    async def webhook(request):
+        text, status = accept_webhook_update(
+            request.headers.get('X-Telegram-Bot-Api-Secret-Token', ''),
+            await request.text(),
+            async_dispatcher.submit
+        )
+        return web.Response(text=text, status=status)
+    
+    async_app = web.Application()
+    async_app.add_routes([
+        web.get('/', home),
+        web.get('/ping', ping),
+        web.get('/metrics', metrics),
+        web.get('/ready', ready),
+        web.post(WEBHOOK_PATH, webhook),
+    ])
+    return async_app
+
+async def poll_updates_async(async_bot, async_dispatcher, skip_pending=False):
+    """Long polling через AsyncTeleBot: ожидание getUpdates не занимает поток"""
+    offset = None
+    if skip_pending:
+        pending = await async_bot.get_updates(offset=-1, timeout=0)
+        if pending:
+            offset = pending[-1].update_id + 1
+    
+    while coordinator.is_leader():
+        updates = await async_bot.get_updates(offset=offset, timeout=LEADER_LEASE_SECONDS, request_timeout=60)
+        for update in updates:
+            offset = update.update_id + 1
+            if recent_updates.add(update.update_id):
+                UPDATES_RECEIVED.inc(source='polling')
+                # Очередь переполнена - притормаживаем polling, как в потоковом режиме
+                while not async_dispatcher.submit(update):
+                    await asyncio.sleep(0.1)
+
+async def run_asyncio():
+    """Режим asyncio: aiohttp вместо Flask, AsyncTeleBot для приема обновлений"""
+    global dispatcher
+    dispatcher = AsyncUpdateDispatcher(bot.process_new_updates, UPDATE_WORKERS, UPDATE_QUEUE_SIZE)
+    
+    runner = web.AppRunner(create_async_app(dispatcher))
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', PORT).start()
+    logger.info("✅ HTTP сервер (aiohttp) запущен")
     
-    bot.send_message(message.chat.id, help_text)
+    # Инициализация и вызовы Bot API из общего ядра - синхронные, выполняем их вне цикла
+    await asyncio.to_thread(start_services)
+    
+    if WEBHOOK_URL:
+        url = WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH
+        await asyncio.to_thread(retry_with_backoff, bot.remove_webhook, "Снятие старого webhook")
+        await asyncio.to_thread(retry_with_backoff,
+            lambda: bot.set_webhook(url=url, secret_token=WEBHOOK_SECRET), "Установка webhook")
+        readiness['bot'] = True
+        logger.info(f"✅ Webhook установлен: {url}")
+        await asyncio.Event().wait()
+    
+    await asyncio.to_thread(retry_with_backoff, bot.remove_webhook, "Снятие webhook")
+    readiness['bot'] = True
+    async_bot = AsyncTeleBot(BOT_TOKEN)
+    skip_pending = coordinator.is_leader()
+    while True:
+        if not coordinator.is_leader():
+            logger.info("⏸ Резервная реплика: ожидание лидерства")
+            await asyncio.to_thread(coordinator.wait_leader)
+        try:
+            logger.info("🔄 Запуск polling (asyncio)...")
+            await poll_updates_async(async_bot, dispatcher, skip_pending=skip_pending)
+        except Exception as e:
+            if "409" in str(e):
+                logger.warning("⚠️ Ошибка 409: getUpdates занят другим экземпляром, повтор")
+                await asyncio.sleep(LEADER_CHECK_INTERVAL)
+            else:
+                logger.error(f"❌ Ошибка бота: {e}")
+                await asyncio.sleep(15)
+        skip_pending = False
+
+STARTUP_BACKOFF_BASE = float(os.environ.get('STARTUP_BACKOFF_BASE', 0.5))
+STARTUP_BACKOFF_MAX = float(os.environ.get('STARTUP_BACKOFF_MAX', 30))
+
+def retry_with_backoff(action, description):
+    """Повторяет action, пока она не вернет истину: экспоненциальная задержка с джиттером"""
+    attempt = 0
+    while True:
+        try:
+            if action():
+                return
+            error = "неуспешный результат"
+        except Exception as e:
+            error = e
+        # Полный разброс в пределах [0, delay], чтобы реплики не ломились в БД одновременно
+        delay = min(STARTUP_BACKOFF_MAX, STARTUP_BACKOFF_BASE * 2 ** attempt)
+        delay = random.uniform(0, delay)
+        attempt += 1
+        logger.error(f"❌ {description}: попытка {attempt} не удалась ({error}), повтор через {delay:.1f} с")
+        time.sleep(delay)
+
+def start_services():
+    """Инициализирует БД и кэши; повторяет попытки, пока база недоступна"""
+    retry_with_backoff(init_db, "Инициализация базы данных")
+    db_pool.warm_up()
+    admin_cache.refresh()
+    warm_roster_cache()
+    state_store.load()
+    state_store.start()
+    outbox.start()
+    if mark_journal is not None:
+        mark_journal.start()
+    coordinator.start()
+    if SCHEDULER_ENABLED:
+        scheduler.start()
+    readiness['db'] = True
+    logger.info("✅ Бот готов к работе!")
 
 def run_bot():
-    """Запуск бота с обработкой ошибок"""
+    """Запуск бота: HTTP сразу, обработка обновлений - как только готова БД"""
     logger.info("🚀 ЗАПУСК БОТА...")
     
-    # Ждем инициализации
-    time.sleep(10)
+    if RUNTIME == 'asyncio':
+        if web is None or AsyncTeleBot is None:
+            logger.error("❌ Для RUNTIME=asyncio установите aiohttp")
+            sys.exit(1)
+        asyncio.run(run_asyncio())
+        return
     
-    if init_db():
-        logger.info("✅ Бот готов к работе!")
-        
-        # Запускаем Flask в отдельном потоке
-        flask_thread = threading.Thread(target=run_flask)
-        flask_thread.daemon = True
-        flask_thread.start()
-        logger.info("✅ Flask сервер запущен")
-        
-        # Ждем еще немного перед запуском бота
-        time.sleep(5)
-        
-        # Запускаем бота с обработкой ошибок
-        while True:
-            try:
-                logger.info("🔄 Запуск polling...")
-                bot.infinity_polling(timeout=60, long_polling_timeout=30, skip_pending=True)
-            except Exception as e:
-                if "409" in str(e):
-                    logger.error("❌ Ошибка 409: Другой экземпляр бота уже запущен")
-                    logger.info("🔄 Ожидание 30 секунд перед перезапуском...")
-                    time.sleep(30)
-                else:
-                    logger.error(f"❌ Ошибка бота: {e}")
-                    logger.info("🔄 Перезапуск через 15 секунд...")
-                    time.sleep(15)
+    # Порт открываем сразу, чтобы платформа не считала деплой зависшим; готовность - на /ready
+    flask_thread = threading.Thread(target=run_flask)
+    flask_thread.daemon = True
+    flask_thread.start()
+    logger.info("✅ Flask сервер запущен")
+    
+    start_services()
+    
+    if WEBHOOK_URL:
+        run_webhook(flask_thread)
     else:
-        logger.error("❌ Не удалось инициализировать базу данных")
-        time.sleep(30)
-        run_bot()
+        run_polling()
 
 if __name__ == '__main__':
     run_bot()
@@ -0,0 +1,36 @@
+"""Общая настройка тестов: бот импортируется без Telegram и без базы.
+
+Тесты с PostgreSQL запускаются только с TEST_DATABASE_URL (отдельная пустая БД):
+
+    TEST_DATABASE_URL=postgresql://postgres@localhost/bot_test python -m pytest -q tests
+"""
+import os
+import sys
+
+import pytest
+
+TEST_DATABASE_URL = os.environ.get('TEST_DATABASE_URL')
+
+# Рабочая DATABASE_URL из окружения не должна попасть в тесты
+os.environ['DATABASE_URL'] = TEST_DATABASE_URL or 'postgresql://test@127.0.0.1:1/test'
+os.environ.setdefault('BOT_TOKEN', '0:test')
+os.environ.setdefault('ADMIN_ID', '1')
+os.environ.setdefault('MARK_JOURNAL', '0')
+os.environ.setdefault('STATE_BACKEND', 'memory')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+requires_db = pytest.mark.skipif(not TEST_DATABASE_URL, reason='нужна TEST_DATABASE_URL')
+
+
+@pytest.fixture(scope='session')
+def bot():
+    import bot
+    return bot
+
+
+@pytest.fixture(scope='session')
+def db(bot):
+    """Бот со схемой, приведенной к последней версии, на TEST_DATABASE_URL"""
+    assert bot.init_db()
+    return bot
@@ -0,0 +1,30 @@
+"""Служебные команды администраторов - без базы и Telegram."""
+import pytest
+
+
+@pytest.fixture
+def sent(bot, monkeypatch):
+    messages = []
+    monkeypatch.setattr(bot, 'send_message', lambda chat_id, text, **kwargs: messages.append(text))
+    return messages
+
+
+@pytest.fixture
+def rebuilds(bot, monkeypatch):
+    calls = []
+    monkeypatch.setattr(bot, 'rebuild_rollups', lambda: calls.append(1) or True)
+    return calls
+
+
+def test_org_admin_cannot_rebuild_rollups(bot, sent, rebuilds):
+    req = bot.Request('command', int(bot.ADMIN_ID) + 1, 100, '/rebuild_rollups')
+    req.org_id = 2
+    bot.rebuild_rollups_command(req)
+    assert rebuilds == []
+    assert sent == ["❌ У вас нет доступа к этой команде"]
+
+
+def test_owner_rebuilds_rollups(bot, sent, rebuilds):
+    bot.rebuild_rollups_command(bot.Request('command', int(bot.ADMIN_ID), 100, '/rebuild_rollups'))
+    assert rebuilds == [1]
+    assert sent[-1] == "✅ Агрегаты посещаемости пересчитаны"
@@ -0,0 +1,65 @@
+"""Выполнение запросов без базы: пул подменяется, соединение обрывается по команде."""
+import asyncio
+import threading
+
+
+class FakePool:
+    def __init__(self):
+        self.broken = 0
+
+    def acquire(self):
+        return object()
+
+    def release(self, conn, broken=False):
+        self.broken += broken
+
+    def discard_idle(self):
+        pass
+
+
+def dropping_once(bot, calls):
+    """run(conn), у которого первое соединение обрывается после отправки запроса"""
+    def run(conn):
+        calls.append(conn)
+        if len(calls) == 1:
+            raise bot.pg8000.InterfaceError('connection reset by peer')
+        return [(1,)]
+    return run
+
+
+def test_write_is_not_repeated_after_connection_loss(bot, monkeypatch):
+    pool = FakePool()
+    monkeypatch.setattr(bot, 'db_pool', pool)
+    calls = []
+    assert bot.run_with_retry('employee_insert', dropping_once(bot, calls), 'INSERT', ()) is None
+    assert len(calls) == 1
+    assert pool.broken == 1
+
+
+def test_idempotent_query_is_repeated_on_fresh_connection(bot, monkeypatch):
+    monkeypatch.setattr(bot, 'db_pool', FakePool())
+    calls = []
+    assert bot.run_with_retry('roster_load', dropping_once(bot, calls), 'SELECT', (), retry=True) == [(1,)]
+    assert len(calls) == 2
+    assert calls[0] is not calls[1]
+
+
+def test_non_idempotent_registered_queries_are_not_retried(bot):
+    for name in ('employee_insert', 'cache_notify', 'scheduler_claim'):
+        assert not bot.queries.retryable(name)
+    for name in ('ready', 'roster_load', 'attendance_mark_batch', 'attendance_journal_flush', 'report_period'):
+        assert bot.queries.retryable(name)
+
+
+def test_async_prepared_query_runs_off_the_event_loop(bot, monkeypatch):
+    calls = []
+
+    def execute_prepared(query_name, /, fetch=False, **params):
+        calls.append((query_name, fetch, params, threading.current_thread().name))
+        return [(1,)]
+
+    monkeypatch.setattr(bot, 'execute_prepared', execute_prepared)
+    assert asyncio.run(bot.execute_prepared_async('roster_load', fetch=True, org_id=7)) == [(1,)]
+    (name, fetch, params, thread), = calls
+    assert (name, fetch, params) == ('roster_load', True, {'org_id': 7})
+    assert thread.startswith('db')
@@ -0,0 +1,102 @@
+"""Поиск сотрудников по ФИО и постраничный список - без базы."""
+import pytest
+
+EMPLOYEES = [
+    (1, 'Алексеев Петр'),
+    (2, 'Борисова Анна Сергеевна'),
+    (3, 'Иванов Иван'),
+    (4, 'Иванова Мария'),
+    (5, 'Семёнов Олег'),
+]
+
+
+@pytest.fixture
+def index(bot):
+    return bot.EmployeeIndex(EMPLOYEES)
+
+
+def test_search_by_start_of_any_word(index):
+    assert index.search('анна') == (1, [(2, 'Борисова Анна Сергеевна')])
+    assert index.search('сергеевна') == (1, [(2, 'Борисова Анна Сергеевна')])
+
+
+def test_search_is_case_and_yo_insensitive(index):
+    assert index.search('СЕМЕНОВ') == (1, [(5, 'Семёнов Олег')])
+
+
+def test_results_keep_roster_order_and_limit(index):
+    assert index.search('иван', limit=1) == (2, [(3, 'Иванов Иван')])
+    assert index.search('иван') == (2, [(3, 'Иванов Иван'), (4, 'Иванова Мария')])
+
+
+def test_typo_falls_back_to_fuzzy_search(index):
+    found, rows = index.search('ивонов')
+    assert found >= 1
+    assert (3, 'Иванов Иван') in rows
+
+
+def test_blank_query_finds_nothing(index):
+    assert index.search('   ') == (0, [])
+
+
+def page_rows(ids, position='Инженер'):
+    return [(emp_id, f'Сотрудник {emp_id}', position, True) for emp_id in ids]
+
+
+class FakePages:
+    """Вместо запросов страниц: возвращает заданные строки и запоминает параметры"""
+
+    def __init__(self):
+        self.rows = []
+        self.calls = []
+
+    def __call__(self, query_name, /, fetch=False, **params):
+        self.calls.append((query_name, params))
+        return self.rows
+
+
+@pytest.fixture
+def page_query(bot, monkeypatch):
+    pages = FakePages()
+    monkeypatch.setattr(bot, 'execute_prepared', pages)
+    return pages
+
+
+def test_next_page_with_extra_row_has_more(bot, page_query):
+    size = bot.EMPLOYEE_PAGE_SIZE
+    page_query.rows = page_rows(range(100, 100 + size + 1))
+    rows, has_prev, has_next = bot.fetch_employees_page(7, 'next', 99)
+    assert page_query.calls == [('employees_page_next', {'org_id': 7, 'limit': size + 1, 'anchor_id': 99})]
+    assert [row[0] for row in rows] == list(range(100, 100 + size))
+    assert (has_prev, has_next) == (True, True)
+
+
+def test_prev_page_comes_back_in_list_order(bot, page_query):
+    # Запрос назад читает строки в обратном порядке от якоря
+    page_query.rows = page_rows([30, 29, 28])
+    rows, has_prev, has_next = bot.fetch_employees_page(7, 'prev', 31)
+    assert [row[0] for row in rows] == [28, 29, 30]
+    assert (has_prev, has_next) == (False, True)
+
+
+def test_first_page_has_no_prev(bot, page_query):
+    page_query.rows = page_rows([1, 2])
+    assert bot.fetch_employees_page(7)[1:] == (False, False)
+    assert 'anchor_id' not in page_query.calls[0][1]
+
+
+def test_page_buttons_anchor_on_first_and_last_shown_rows(bot):
+    text, keyboard = bot.render_employees_page(page_rows([5, 6, 7]), True, True)
+    buttons = [button.callback_data for button in keyboard.keyboard[0]]
+    assert buttons == ['emp:prev:5', 'emp:next:7']
+    assert 'Сотрудник 6' in text
+
+
+def test_rows_over_message_limit_move_to_next_page(bot):
+    rows = page_rows(range(1, 61), position='д' * 190)
+    text, keyboard = bot.render_employees_page(rows, False, False)
+    assert len(text) <= bot.MESSAGE_LIMIT
+    (next_button,) = keyboard.keyboard[0]
+    shown = text.count('🆔 ID:')
+    assert shown < len(rows)
+    assert next_button.callback_data == f'emp:next:{rows[shown - 1][0]}'
@@ -0,0 +1,40 @@
+"""Постраничный список сотрудников на настоящей PostgreSQL (нужна TEST_DATABASE_URL)."""
+import pytest
+
+from conftest import requires_db
+
+pytestmark = requires_db
+
+
+@pytest.fixture(scope='module')
+def orgs(db):
+    own, other = (
+        db.execute_query('INSERT INTO organizations (name) VALUES (%s) RETURNING id', (name,), fetch=True)[0][0]
+        for name in ('Своя', 'Чужая')
+    )
+    for org_id, prefix in ((own, 'Свой'), (other, 'Чужой')):
+        db.execute_query(
+            "INSERT INTO employees (org_id, full_name) SELECT %s, %s || lpad(g::text, 3, '0') "
+            "FROM generate_series(1, 30) g",
+            (org_id, prefix)
+        )
+    ids = {
+        org_id: [row[0] for row in db.execute_query(
+            'SELECT id FROM employees WHERE org_id = %s ORDER BY full_name, id', (org_id,), fetch=True)]
+        for org_id in (own, other)
+    }
+    return own, other, ids
+
+
+def test_next_page_follows_own_anchor(db, orgs):
+    own, _, ids = orgs
+    rows, has_prev, has_next = db.fetch_employees_page(own, 'next', ids[own][9])
+    assert [row[0] for row in rows] == ids[own][10:10 + db.EMPLOYEE_PAGE_SIZE]
+    assert has_prev
+
+
+@pytest.mark.parametrize('direction', ['next', 'prev'])
+def test_anchor_from_another_org_gives_empty_page(db, orgs, direction):
+    own, other, ids = orgs
+    rows, _, _ = db.fetch_employees_page(own, direction, ids[other][15])
+    assert rows == []
@@ -0,0 +1,84 @@
+"""Журнал отметок и перенос в PostgreSQL - без базы."""
+import datetime
+
+import pytest
+
+BROKEN = 13
+
+
+class FakeDatabase:
+    """Вместо запросов переноса: отвергает пачки с сотрудником BROKEN, может быть недоступна"""
+
+    def __init__(self):
+        self.up = True
+        self.written = []
+
+    def __call__(self, query_name, /, fetch=False, **params):
+        if not self.up:
+            return None
+        if query_name == 'ready':
+            return [(1,)]
+        assert query_name == 'attendance_journal_flush'
+        if BROKEN in params['employee_ids']:
+            return None
+        self.written.extend(params['employee_ids'])
+        return []
+
+
+@pytest.fixture
+def database(bot, monkeypatch):
+    database = FakeDatabase()
+    monkeypatch.setattr(bot, 'execute_prepared', database)
+    return database
+
+
+@pytest.fixture
+def journal(bot, tmp_path):
+    journal = bot.MarkJournal(str(tmp_path / 'marks.db'), batch_size=10, max_attempts=2)
+    journal.append(7, [1, BROKEN, 2], datetime.date(2026, 10, 17))
+    return journal
+
+
+def dead_employees(journal):
+    return [row[0] for row in journal._conn.execute('SELECT employee_id FROM dead_marks ORDER BY seq')]
+
+
+def test_rejected_batch_goes_to_dead_letters_after_max_attempts(journal, database):
+    assert journal.flush() is False
+    assert journal.pending() == 3
+    assert database.written == []
+
+    assert journal.flush() is True
+    assert database.written == [1, 2]
+    assert journal.pending() == 0
+    assert dead_employees(journal) == [BROKEN]
+
+
+def test_outage_does_not_count_as_attempt(journal, database):
+    database.up = False
+    for _ in range(5):
+        assert journal.flush() is False
+    assert journal.pending() == 3
+    assert journal.dead() == 0
+
+    database.up = True
+    assert journal.flush() is False
+    assert journal.dead() == 0
+
+
+def test_outage_during_salvage_keeps_rest_of_batch(journal, database, monkeypatch):
+    assert journal.flush() is False
+    write = journal._write
+
+    def write_then_fail(rows):
+        # Пачка целиком отвергнута, первая запись по одной прошла - и база пропала
+        result = write(rows)
+        if len(rows) == 1:
+            database.up = False
+        return result
+
+    monkeypatch.setattr(journal, '_write', write_then_fail)
+    assert journal.flush() is False
+    assert database.written == [1]
+    assert journal.pending() == 2
+    assert journal.dead() == 0
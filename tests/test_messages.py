@@ -0,0 +1,36 @@
+"""Разбиение длинных ответов на сообщения Telegram."""
+import random
+
+
+def test_line_of_exactly_limit_is_one_message(bot):
+    assert bot.split_message('a' * 10, limit=10) == ['a' * 10]
+
+
+def test_line_of_limit_plus_one_is_split(bot):
+    assert bot.split_message('a' * 11, limit=10) == ['a' * 10, 'a']
+
+
+def test_huge_line_is_cut_after_preceding_text(bot):
+    assert bot.split_message('шапка\n' + 'b' * 25, limit=10) == ['шапка', 'b' * 10, 'b' * 10, 'b' * 5]
+
+
+def test_lines_are_packed_up_to_limit(bot):
+    assert bot.split_message('aaaa\nbbbbb\ncc', limit=10) == ['aaaa\nbbbbb', 'cc']
+
+
+def test_leading_blank_lines_are_kept(bot):
+    assert bot.split_message('\n\nтекст', limit=10) == ['\n\nтекст']
+
+
+def test_blank_lines_at_chunk_boundary_do_not_make_empty_message(bot):
+    assert bot.split_message('a' * 9 + '\n\n\n' + 'b' * 10, limit=10) == ['a' * 9, 'b' * 10]
+
+
+def test_chunks_are_never_empty_or_over_limit(bot):
+    rnd = random.Random(7)
+    for _ in range(200):
+        lines = [rnd.choice(['', 'x' * rnd.randint(1, 40)]) for _ in range(rnd.randint(1, 20))]
+        text = '\n'.join(lines)
+        chunks = bot.split_message(text, limit=16)
+        assert all(0 < len(chunk) <= 16 for chunk in chunks) or text == ''
+        assert ''.join(chunks).replace('\n', '') == text.replace('\n', '')
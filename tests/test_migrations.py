@@ -0,0 +1,71 @@
+"""Список миграций и порядок их применения - без базы."""
+
+
+class FakeCursor:
+    def __init__(self, applied, log):
+        self.applied = applied
+        self.log = log
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, statement, params=None):
+        self.log.append((' '.join(statement.split()), params))
+        self._rows = [(version,) for version in self.applied] if statement == 'SELECT version FROM schema_migrations' else []
+
+    def fetchall(self):
+        return self._rows
+
+
+class FakeConnection:
+    def __init__(self, applied):
+        self.applied = applied
+        self.log = []
+
+    def cursor(self):
+        return FakeCursor(self.applied, self.log)
+
+    def commit(self):
+        self.log.append(('COMMIT', None))
+
+    def rollback(self):
+        self.log.append(('ROLLBACK', None))
+
+
+def test_versions_are_consecutive_from_one(bot):
+    versions = [version for version, _, _ in bot.MIGRATIONS]
+    assert versions == list(range(1, len(versions) + 1))
+    assert bot.SCHEMA_VERSION == versions[-1]
+
+
+def test_shipped_rollup_migration_predates_organizations(bot):
+    statements = bot.MIGRATIONS[1][2]
+    assert statements[-len(bot.ROLLUP_REBUILD_SQL_V2):] == bot.ROLLUP_REBUILD_SQL_V2
+    assert not any('org_id' in statement for statement in statements)
+
+
+def test_org_aware_rollups_come_after_org_columns(bot):
+    statements = bot.MIGRATIONS[7][2]
+    trigger = statements.index(bot.ROLLUP_TRIGGER_SQL[0])
+    for table in ('attendance', 'attendance_daily', 'attendance_monthly'):
+        column = next(i for i, statement in enumerate(statements)
+                      if statement.startswith(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS org_id'))
+        assert column < trigger
+    assert statements[-len(bot.ROLLUP_REBUILD_SQL):] == bot.ROLLUP_REBUILD_SQL
+
+
+def test_only_missing_migrations_are_applied_in_order(bot):
+    conn = FakeConnection(applied=[1, 2, 3])
+    bot.apply_migrations(conn)
+    recorded = [params[0] for statement, params in conn.log
+                if statement.startswith('INSERT INTO schema_migrations')]
+    assert recorded == list(range(4, bot.SCHEMA_VERSION + 1))
+    # Каждая миграция - в своей транзакции
+    assert sum(statement == 'BEGIN' for statement, _ in conn.log) == len(recorded)
+    assert sum(statement == 'COMMIT' for statement, _ in conn.log) == len(recorded)
+    # Блокировка снимается после всех миграций
+    assert conn.log[-1][0] == 'SELECT pg_advisory_unlock(%s)'
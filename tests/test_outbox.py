@@ -0,0 +1,117 @@
+"""Очередь исходящих вызовов Bot API и корзина токенов - без Telegram."""
+import threading
+import time
+
+import pytest
+import telebot
+
+
+def noop(*args, **kwargs):
+    pass
+
+
+def moment():
+    """Момент выбора вызова: корзины чатов создаются при выборе и не должны оказаться в будущем"""
+    return time.monotonic() + 0.001
+
+
+def test_token_bucket_allows_burst_then_paces(bot):
+    bucket = bot.TokenBucket(rate=2, burst=3)
+    now = bucket.updated
+    for _ in range(3):
+        assert bucket.delay(now) == 0
+        bucket.take()
+    assert bucket.delay(now) == pytest.approx(0.5)
+    assert bucket.delay(now + 0.5) == 0
+
+
+def test_token_bucket_does_not_save_up_beyond_burst(bot):
+    bucket = bot.TokenBucket(rate=1, burst=2)
+    bucket.delay(bucket.updated + 3600)
+    assert bucket.tokens == 2
+
+
+def test_coalesced_call_replaces_pending_one(bot):
+    outbox = bot.Outbox(global_rate=100, chat_rate=100, chat_burst=10)
+    outbox.submit(1, noop, 'меню 1', coalesce='menu')
+    outbox.submit(1, noop, 'меню 2', coalesce='menu')
+    assert outbox.depth() == 1
+    call, _ = outbox._pick(moment())
+    assert call.args == ('меню 2',)
+
+
+def test_coalescing_keeps_calls_with_other_keys(bot):
+    outbox = bot.Outbox(global_rate=100, chat_rate=100, chat_burst=10)
+    outbox.submit(1, noop, 'меню', coalesce='menu')
+    outbox.submit(1, noop, 'отчет')
+    outbox.submit(1, noop, 'меню', coalesce='menu')
+    assert outbox.depth() == 3
+
+
+def test_interactive_lane_goes_before_bulk(bot):
+    outbox = bot.Outbox(global_rate=100, chat_rate=100, chat_burst=10)
+    outbox.submit(1, noop, 'дайджест', priority=bot.PRIORITY_BULK)
+    outbox.submit(2, noop, 'ответ')
+    call, _ = outbox._pick(moment())
+    assert (call.chat_id, call.args) == (2, ('ответ',))
+
+
+def test_chat_in_flight_is_not_picked_again(bot):
+    outbox = bot.Outbox(global_rate=100, chat_rate=100, chat_burst=10)
+    outbox.submit(1, noop, 'первое')
+    outbox.submit(1, noop, 'второе')
+    outbox.submit(2, noop, 'другой чат')
+    now = moment()
+    first, _ = outbox._pick(now)
+    second, _ = outbox._pick(now)
+    assert first.args == ('первое',)
+    # Пока первое сообщение чата 1 в пути, второе ждет: порядок в чате не нарушается
+    assert second.chat_id == 2
+    assert outbox._pick(now) == (None, None)
+
+
+def test_chat_rate_limit_reports_wait(bot):
+    outbox = bot.Outbox(global_rate=100, chat_rate=1, chat_burst=1)
+    outbox.submit(1, noop, 'а')
+    outbox.submit(1, noop, 'б')
+    now = moment()
+    call, _ = outbox._pick(now)
+    outbox._busy.discard(call.chat_id)
+    call, wait = outbox._pick(now)
+    assert call is None
+    assert wait == pytest.approx(1, abs=0.01)
+
+
+def test_messages_to_one_chat_arrive_in_order(bot):
+    outbox = bot.Outbox(global_rate=1000, chat_rate=1000, chat_burst=1000, senders=4)
+    delivered = []
+    lock = threading.Lock()
+
+    def send(chat_id, n):
+        with lock:
+            delivered.append((chat_id, n))
+
+    outbox.start()
+    for n in range(50):
+        for chat_id in (1, 2, 3):
+            outbox.submit(chat_id, send, chat_id, n)
+    assert outbox.wait_idle(timeout=10)
+    for chat_id in (1, 2, 3):
+        assert [n for c, n in delivered if c == chat_id] == list(range(50))
+
+
+def test_429_is_retried_after_retry_after(bot):
+    outbox = bot.Outbox(global_rate=1000, chat_rate=1000, chat_burst=1000, senders=1)
+    attempts = []
+
+    def send():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise telebot.apihelper.ApiTelegramException('sendMessage', None, {
+                'error_code': 429, 'description': 'Too Many Requests', 'parameters': {'retry_after': 0.01},
+            })
+        return 'ok'
+
+    outbox.start()
+    assert outbox.submit(1, send, wait=True) == 'ok'
+    assert len(attempts) == 2
@@ -0,0 +1,65 @@
+"""Кэш сотрудников и его прогрев - без базы."""
+import threading
+import time
+
+import pytest
+
+
+@pytest.fixture
+def loads(bot, monkeypatch):
+    """Подменяет загрузку ростера: у организации N - один сотрудник N * 10"""
+    calls = []
+
+    def execute_prepared(query_name, /, fetch=False, **params):
+        assert query_name == 'roster_load'
+        calls.append(params['org_id'])
+        return [(params['org_id'] * 10, f"Сотрудник {params['org_id']}")]
+
+    monkeypatch.setattr(bot, 'execute_prepared', execute_prepared)
+    return calls
+
+
+def test_warm_loads_only_missing_orgs(bot, loads):
+    cache = bot.RosterCache(max_orgs=10)
+    cache.employees(2)
+    assert cache.warm({1, 2, 3}) == 2
+    assert loads == [2, 1, 3]
+    misses = cache.misses
+    assert cache.employees(3) == [(30, 'Сотрудник 3')]
+    assert cache.misses == misses
+
+
+def test_warm_respects_max_orgs(bot, loads):
+    cache = bot.RosterCache(max_orgs=2)
+    assert cache.warm({5, 4, 3}) == 2
+    assert cache.stats()['orgs'] == 2
+
+
+def test_full_reset_rewarms_in_background(bot, loads, monkeypatch):
+    warmed = threading.Event()
+    monkeypatch.setattr(bot.roster_warmup, 'action', warmed.set)
+    bot.reset_roster_cache(None)
+    assert warmed.wait(5)
+
+
+def test_request_during_run_repeats_once(bot):
+    started, release = threading.Event(), threading.Event()
+    runs = []
+
+    def action():
+        runs.append(1)
+        started.set()
+        release.wait(5)
+
+    task = bot.BackgroundTask(action, 'test-task')
+    task.request()
+    assert started.wait(5)
+    task.request()
+    task.request()
+    release.set()
+    for _ in range(100):
+        with task._lock:
+            if not task._running:
+                break
+        time.sleep(0.01)
+    assert runs == [1, 1]
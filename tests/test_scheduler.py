@@ -0,0 +1,21 @@
+"""Планировщик на настоящей PostgreSQL (нужна TEST_DATABASE_URL, см. conftest.py)."""
+from datetime import datetime, timedelta
+
+from conftest import requires_db
+
+pytestmark = requires_db
+
+
+def test_claim_runs_once_per_due_time(db):
+    later = datetime.now().astimezone() + timedelta(hours=1)
+    job = db.ScheduledJob('test_claim', lambda after: later, lambda: None)
+    scheduler = db.Scheduler([job])
+    scheduler._sync(job)
+    assert db.execute_query(
+        "UPDATE scheduled_jobs SET next_run = now() - interval '1 minute' WHERE name = %s", (job.name,)
+    )
+
+    assert scheduler._claim(job) is True
+    # next_run перенесен вперед: вторая реплика (или повтор) запуск не забирает
+    assert scheduler._claim(job) is False
+    assert scheduler._sync(job) == later